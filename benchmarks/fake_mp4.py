@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import struct
+
+from Crypto.Cipher import AES
+
+SAMPLE_DURATION = 1024
+WIDEVINE_SYSTEM_ID = bytes.fromhex("edef8ba979d64acea3c827dcd51d21ed")
+
+
+def box(box_type: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type: bytes, version: int, flags: int, payload: bytes) -> bytes:
+    return box(box_type, struct.pack(">I", (version << 24) | flags) + payload)
+
+
+def get_iv(iv_size: int, sample_index: int) -> bytes:
+    if iv_size == 8:
+        return struct.pack(">Q", sample_index + 1)
+    # Start near the end of the low word so the counter carries into the nonce
+    return struct.pack(">QQ", sample_index + 1, 2**64 - 2)
+
+
+def encrypt_sample(
+    key: bytes,
+    data: bytes,
+    iv: bytes,
+    subsamples: tuple = (),
+) -> bytes:
+    if len(iv) == 8:
+        cipher = AES.new(key, AES.MODE_CTR, nonce=iv, initial_value=0)
+    else:
+        cipher = AES.new(key, AES.MODE_CTR, nonce=b"", initial_value=iv)
+    if not subsamples:
+        return cipher.encrypt(data)
+    encrypted = bytearray()
+    position = 0
+    for clear_size, protected_size in subsamples:
+        encrypted += data[position : position + clear_size]
+        position += clear_size
+        encrypted += cipher.encrypt(data[position : position + protected_size])
+        position += protected_size
+    encrypted += data[position:]
+    return bytes(encrypted)
+
+
+def get_moov(iv_size: int = 8) -> bytes:
+    mvhd = full_box(b"mvhd", 0, 0, bytes(8) + struct.pack(">II", 1000, 0) + bytes(80))
+    tkhd = full_box(b"tkhd", 0, 3, bytes(8) + struct.pack(">I", 1) + bytes(68))
+    mdhd = full_box(b"mdhd", 0, 0, bytes(8) + struct.pack(">II", 44100, 0) + bytes(4))
+    hdlr = full_box(b"hdlr", 0, 0, bytes(4) + b"soun" + bytes(12) + b"SoundHandler\0")
+    esds = full_box(
+        b"esds",
+        0,
+        0,
+        b"\x03\x19\x00\x01\x00\x04\x11\x40\x15"
+        + bytes(11)
+        + b"\x05\x02\x12\x10\x06\x01\x02",
+    )
+    tenc = full_box(b"tenc", 0, 0, b"\0\0\x01" + bytes([iv_size]) + b"\x11" * 16)
+    sinf = box(
+        b"sinf",
+        box(b"frma", b"mp4a")
+        + full_box(b"schm", 0, 0, b"cenc" + struct.pack(">I", 0x10000))
+        + box(b"schi", tenc),
+    )
+    enca = box(
+        b"enca",
+        bytes(6)
+        + struct.pack(">H", 1)
+        + bytes(8)
+        + struct.pack(">HHHHI", 2, 16, 0, 0, 44100 << 16)
+        + esds
+        + sinf,
+    )
+    stbl = box(
+        b"stbl",
+        full_box(b"stsd", 0, 0, struct.pack(">I", 1) + enca)
+        + full_box(b"stts", 0, 0, bytes(4))
+        + full_box(b"stsc", 0, 0, bytes(4))
+        + full_box(b"stsz", 0, 0, bytes(8))
+        + full_box(b"stco", 0, 0, bytes(4)),
+    )
+    minf = box(
+        b"minf",
+        full_box(b"smhd", 0, 0, bytes(4))
+        + box(
+            b"dinf",
+            full_box(
+                b"dref", 0, 0, struct.pack(">I", 1) + full_box(b"url ", 0, 1, b"")
+            ),
+        )
+        + stbl,
+    )
+    trak = box(b"trak", tkhd + box(b"mdia", mdhd + hdlr + minf))
+    mvex = box(
+        b"mvex",
+        full_box(b"trex", 0, 0, struct.pack(">IIIII", 1, 1, SAMPLE_DURATION, 0, 0)),
+    )
+    pssh = full_box(b"pssh", 0, 0, WIDEVINE_SYSTEM_ID + struct.pack(">I", 0))
+    return box(b"moov", mvhd + trak + mvex + pssh)
+
+
+def get_senc(ivs: list[bytes], subsamples: tuple) -> bytes:
+    entries = b""
+    for iv in ivs:
+        entries += iv
+        if subsamples:
+            entries += struct.pack(">H", len(subsamples)) + b"".join(
+                struct.pack(">HI", *subsample) for subsample in subsamples
+            )
+    return full_box(
+        b"senc",
+        0,
+        0x2 if subsamples else 0,
+        struct.pack(">I", len(ivs)) + entries,
+    )
+
+
+def build_encrypted_mp4(
+    key: bytes,
+    samples: list[bytes],
+    samples_per_fragment: int = 64,
+    iv_size: int = 8,
+    subsamples: tuple = (),
+    absolute_offsets: bool = False,
+) -> bytes:
+    mp4 = box(b"ftyp", b"mp42\0\0\0\0mp42isom") + get_moov(iv_size)
+    for fragment_index, first_sample in enumerate(
+        range(0, len(samples), samples_per_fragment)
+    ):
+        sample_indices = range(
+            first_sample, min(first_sample + samples_per_fragment, len(samples))
+        )
+        ivs = [get_iv(iv_size, sample_index) for sample_index in sample_indices]
+        sample_sizes = b"".join(
+            struct.pack(">I", len(samples[sample_index]))
+            for sample_index in sample_indices
+        )
+        senc = get_senc(ivs, subsamples)
+        mdat = box(
+            b"mdat",
+            b"".join(
+                encrypt_sample(key, samples[sample_index], iv, subsamples)
+                for sample_index, iv in zip(sample_indices, ivs)
+            ),
+        )
+
+        def get_moof(data_offset: int) -> bytes:
+            if absolute_offsets:
+                tfhd = full_box(b"tfhd", 0, 0x1, struct.pack(">IQ", 1, data_offset))
+                trun = full_box(
+                    b"trun", 0, 0x200, struct.pack(">I", len(ivs)) + sample_sizes
+                )
+            else:
+                tfhd = full_box(b"tfhd", 0, 0x20000, struct.pack(">I", 1))
+                trun = full_box(
+                    b"trun",
+                    0,
+                    0x201,
+                    struct.pack(">Ii", len(ivs), data_offset) + sample_sizes,
+                )
+            traf = box(
+                b"traf",
+                tfhd
+                + full_box(
+                    b"tfdt", 1, 0, struct.pack(">Q", first_sample * SAMPLE_DURATION)
+                )
+                + trun
+                + senc,
+            )
+            return box(
+                b"moof",
+                full_box(b"mfhd", 0, 0, struct.pack(">I", fragment_index + 1)) + traf,
+            )
+
+        data_offset = len(get_moof(0)) + 8
+        if absolute_offsets:
+            data_offset += len(mp4)
+        mp4 += get_moof(data_offset) + mdat
+    return mp4
@@ -0,0 +1,516 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from spotify_to_jellyfin.spotify_api import SpotifyApi
+
+from .fake_mp4 import build_encrypted_mp4
+
+DECRYPTION_KEY = bytes(range(16))
+ALBUM_GID_BASE = 1 << 120
+PLAYLIST_GID_BASE = 1 << 124
+ALBUM_SIZE = 12
+PAGE_SIZE = 100
+SAMPLE_SIZE = 1024
+JELLYFIN_USER_ID = "0" * 31 + "1"
+
+
+def get_track_gid(index: int) -> str:
+    return f"{index + 1:032x}"
+
+
+def get_track_id(index: int) -> str:
+    return SpotifyApi.gid_to_track_id(get_track_gid(index))
+
+
+def get_track_index(track_id: str) -> int:
+    return int(SpotifyApi.track_id_to_gid(track_id), 16) - 1
+
+
+def get_album_id(album_index: int) -> str:
+    return SpotifyApi.gid_to_track_id(f"{ALBUM_GID_BASE + album_index:032x}")
+
+
+def get_album_index(album_id: str) -> int:
+    return int(SpotifyApi.track_id_to_gid(album_id), 16) - ALBUM_GID_BASE
+
+
+def get_playlist_id(track_count: int) -> str:
+    return SpotifyApi.gid_to_track_id(f"{PLAYLIST_GID_BASE + track_count:032x}")
+
+
+def get_playlist_track_count(playlist_id: str) -> int:
+    return int(SpotifyApi.track_id_to_gid(playlist_id), 16) - PLAYLIST_GID_BASE
+
+
+def get_file_id(index: int) -> str:
+    return f"{index + 1:040x}"
+
+
+class FakeServices:
+    def __init__(
+        self,
+        track_size: int = 256 * 1024,
+        api_latency: float = 0.0,
+        cdn_latency: float = 0.0,
+        bandwidth: float = 0.0,
+    ):
+        self.track_size = track_size
+        self.api_latency = api_latency
+        self.cdn_latency = cdn_latency
+        self.bandwidth = bandwidth
+        self.request_counts = Counter()
+        self.jellyfin_items = []
+        self.jellyfin_playlists = {}
+        self._lock = threading.Lock()
+        self._set_media()
+        self._setup_server()
+
+    def _set_media(self):
+        self.media = build_encrypted_mp4(
+            DECRYPTION_KEY,
+            [
+                os.urandom(SAMPLE_SIZE)
+                for _ in range(max(self.track_size // SAMPLE_SIZE, 1))
+            ],
+        )
+        self.cover = b"\xff\xd8\xff\xe0" + os.urandom(32 * 1024) + b"\xff\xd9"
+
+    def _setup_server(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeServicesHandler)
+        self.server.daemon_threads = True
+        self.server.services = self
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.jellyfin_url = f"{self.base_url}/jellyfin"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, endpoint: str, status: int):
+        with self._lock:
+            self.request_counts[(endpoint, status)] += 1
+
+    def get_request_counts(self) -> dict[str, dict[str, int]]:
+        request_counts = {}
+        for (endpoint, status), count in sorted(self.request_counts.items()):
+            request_counts.setdefault(endpoint, {})[str(status)] = count
+        return request_counts
+
+    def reset_request_counts(self):
+        with self._lock:
+            self.request_counts.clear()
+
+    def get_home_page(self) -> str:
+        expires_at = int((time.time() + 3600) * 1000)
+        return (
+            '{"accessToken":"benchmark","isPremium":true,'
+            f'"accessTokenExpirationTimestampMs":{expires_at},'
+            '"isAnonymous":false}'
+        )
+
+    def get_track(self, index: int) -> dict:
+        album_index = index // ALBUM_SIZE
+        return {
+            "id": get_track_id(index),
+            "name": f"Track {index + 1}",
+            "artists": [{"id": get_album_id(album_index), "name": "Benchmark"}],
+            "disc_number": 1,
+            "track_number": index % ALBUM_SIZE + 1,
+        }
+
+    def get_gid_metadata(self, index: int) -> dict:
+        album_index = index // ALBUM_SIZE
+        return {
+            "gid": get_track_gid(index),
+            "name": f"Track {index + 1}",
+            "number": index % ALBUM_SIZE + 1,
+            "disc_number": 1,
+            "explicit": False,
+            "has_lyrics": True,
+            "artist": [{"name": "Benchmark"}],
+            "album": {
+                "gid": f"{ALBUM_GID_BASE + album_index:032x}",
+                "name": f"Album {album_index + 1}",
+                "date": {"year": 2020, "month": 1, "day": 1},
+                "cover_group": {
+                    "image": [
+                        {"file_id": f"{album_index + 1:040x}", "size": size}
+                        for size in ("DEFAULT", "SMALL", "LARGE", "XXLARGE")
+                    ]
+                },
+            },
+            "file": [
+                {"file_id": get_file_id(index), "format": audio_format}
+                for audio_format in ("MP4_128", "MP4_256")
+            ],
+            "external_id": [{"type": "isrc", "id": f"BENCH{index + 1:07d}"}],
+        }
+
+    def get_album(self, album_index: int) -> dict:
+        track_indexes = range(album_index * ALBUM_SIZE, (album_index + 1) * ALBUM_SIZE)
+        return {
+            "id": get_album_id(album_index),
+            "name": f"Album {album_index + 1}",
+            "album_type": "album",
+            "artists": [{"name": "Benchmark"}],
+            "copyrights": [{"type": "P", "text": "(P) Benchmark"}],
+            "label": "Benchmark",
+            "tracks": {
+                "items": [self.get_track(index) for index in track_indexes],
+                "limit": PAGE_SIZE,
+                "next": None,
+                "total": ALBUM_SIZE,
+            },
+        }
+
+    def get_playlist_tracks(self, playlist_id: str, offset: int, limit: int) -> dict:
+        track_count = get_playlist_track_count(playlist_id)
+        next_offset = offset + limit
+        return {
+            "items": [
+                {"track": self.get_track(index)}
+                for index in range(offset, min(next_offset, track_count))
+            ],
+            "limit": limit,
+            "next": (
+                f"{self.base_url}/v1/playlists/{playlist_id}/tracks"
+                f"?offset={next_offset}&limit={limit}"
+                if next_offset < track_count
+                else None
+            ),
+            "total": track_count,
+        }
+
+    def get_playlist(self, playlist_id: str) -> dict:
+        track_count = get_playlist_track_count(playlist_id)
+        return {
+            "id": playlist_id,
+            "name": f"Benchmark {track_count}",
+            "snapshot_id": f"snapshot-{track_count}",
+            "tracks": self.get_playlist_tracks(playlist_id, 0, PAGE_SIZE),
+        }
+
+    def get_lyrics(self) -> dict:
+        return {
+            "lyrics": {
+                "syncType": "LINE_SYNCED",
+                "lines": [
+                    {"startTimeMs": str(line * 1000), "words": f"Line {line + 1}"}
+                    for line in range(20)
+                ],
+            }
+        }
+
+    def get_track_credits(self) -> dict:
+        return {
+            "roleCredits": [
+                {"roleTitle": "Performers", "artists": [{"name": "Benchmark"}]},
+                {"roleTitle": "Writers", "artists": [{"name": "Writer"}]},
+                {"roleTitle": "Producers", "artists": [{"name": "Producer"}]},
+            ]
+        }
+
+    def add_jellyfin_items(self, paths: list[str]):
+        date_last_saved = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        with self._lock:
+            known_paths = {item["Path"] for item in self.jellyfin_items}
+            self.jellyfin_items.extend(
+                {"Id": uuid.uuid4().hex, "Path": path, "DateLastSaved": date_last_saved}
+                for path in paths
+                if path not in known_paths
+            )
+
+    def get_jellyfin_items(
+        self, start_index: int, limit: int, min_date_last_saved: str = None
+    ) -> dict:
+        with self._lock:
+            items = [
+                item
+                for item in self.jellyfin_items
+                if min_date_last_saved is None
+                or item["DateLastSaved"] >= min_date_last_saved
+            ]
+        return {
+            "Items": items[start_index : start_index + limit],
+            "TotalRecordCount": len(items),
+        }
+
+    def add_jellyfin_playlist_items(self, playlist_id: str, item_ids: list[str]):
+        with self._lock:
+            self.jellyfin_playlists[playlist_id].extend(
+                (uuid.uuid4().hex, item_id) for item_id in item_ids
+            )
+
+
+class FakeServicesHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ROUTES = (
+        ("GET", "home", r"/"),
+        ("GET", "gid_metadata", r"/metadata/4/track/(?P<gid>[0-9a-f]{32})"),
+        ("GET", "album", r"/v1/albums/(?P<id>\w{22})"),
+        ("GET", "playlist", r"/v1/playlists/(?P<id>\w{22})"),
+        ("GET", "playlist_tracks", r"/v1/playlists/(?P<id>\w{22})/tracks"),
+        ("GET", "track", r"/v1/tracks/(?P<id>\w{22})"),
+        (
+            "GET",
+            "track_credits",
+            r"/track-credits-view/v0/experimental/(?P<id>\w{22})/credits",
+        ),
+        ("GET", "lyrics", r"/color-lyrics/v2/track/(?P<id>\w{22})"),
+        (
+            "GET",
+            "storage_resolve",
+            r"/storage-resolve/v2/files/audio/interactive/11/(?P<file_id>[0-9a-f]{40})",
+        ),
+        ("GET", "seektable", r"/seektable/(?P<file_id>[0-9a-f]{40})\.json"),
+        ("POST", "license", r"/widevine-license/v1/(?P<type>\w+)/license"),
+        ("GET", "cdn_audio", r"/audio/(?P<file_id>[0-9a-f]{40})"),
+        ("GET", "cover", r"/image/(?P<file_id>\w+)"),
+        ("GET", "jellyfin_ping", r"/jellyfin/System/Ping"),
+        ("GET", "jellyfin_users", r"/jellyfin/Users"),
+        ("GET", "jellyfin_items", r"/jellyfin/Items"),
+        ("POST", "jellyfin_media_updated", r"/jellyfin/Library/Media/Updated"),
+        ("POST", "jellyfin_library_refresh", r"/jellyfin/Library/Refresh"),
+        ("POST", "jellyfin_create_playlist", r"/jellyfin/Playlists"),
+        ("GET", "jellyfin_playlist_items", r"/jellyfin/Playlists/(?P<id>\w+)/Items"),
+        (
+            "POST",
+            "jellyfin_add_playlist_items",
+            r"/jellyfin/Playlists/(?P<id>\w+)/Items",
+        ),
+        (
+            "DELETE",
+            "jellyfin_remove_playlist_items",
+            r"/jellyfin/Playlists/(?P<id>\w+)/Items",
+        ),
+        (
+            "POST",
+            "jellyfin_move_playlist_item",
+            r"/jellyfin/Playlists/(?P<id>\w+)/Items/(?P<entry_id>\w+)/Move/(?P<index>\d+)",
+        ),
+    )
+
+    def log_message(self, format: str, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_route("GET")
+
+    def do_POST(self):
+        self.handle_route("POST")
+
+    def do_DELETE(self):
+        self.handle_route("DELETE")
+
+    @property
+    def services(self) -> FakeServices:
+        return self.server.services
+
+    def handle_route(self, method: str):
+        url = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        content_length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(content_length) if content_length else b""
+        for route_method, endpoint, pattern in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if route_method == method and match:
+                break
+        else:
+            self.send_payload("unknown", 404, b"")
+            return
+        if endpoint not in ("cdn_audio", "cover") and self.services.api_latency:
+            time.sleep(self.services.api_latency)
+        getattr(self, f"handle_{endpoint}")(endpoint, **match.groupdict())
+
+    def send_payload(
+        self,
+        endpoint: str,
+        status: int,
+        payload,
+        headers: dict = None,
+    ):
+        self.services.count(endpoint, status)
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        elif not isinstance(payload, bytes):
+            payload = json.dumps(payload).encode("utf-8")
+            headers = {"Content-Type": "application/json", **(headers or {})}
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if self.services.bandwidth and status in (200, 206) and len(payload) > 65536:
+            for start in range(0, len(payload), 65536):
+                chunk = payload[start : start + 65536]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / self.services.bandwidth)
+        else:
+            self.wfile.write(payload)
+
+    def handle_home(self, endpoint: str):
+        self.send_payload(endpoint, 200, self.services.get_home_page())
+
+    def handle_gid_metadata(self, endpoint: str, gid: str):
+        self.send_payload(
+            endpoint, 200, self.services.get_gid_metadata(int(gid, 16) - 1)
+        )
+
+    def handle_album(self, endpoint: str, id: str):
+        self.send_payload(endpoint, 200, self.services.get_album(get_album_index(id)))
+
+    def handle_playlist(self, endpoint: str, id: str):
+        playlist = self.services.get_playlist(id)
+        etag = f'"{playlist["snapshot_id"]}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_payload(endpoint, 304, b"", {"ETag": etag})
+            return
+        self.send_payload(endpoint, 200, playlist, {"ETag": etag})
+
+    def handle_playlist_tracks(self, endpoint: str, id: str):
+        self.send_payload(
+            endpoint,
+            200,
+            self.services.get_playlist_tracks(
+                id,
+                int(self.query.get("offset", 0)),
+                int(self.query.get("limit", PAGE_SIZE)),
+            ),
+        )
+
+    def handle_track(self, endpoint: str, id: str):
+        self.send_payload(endpoint, 200, self.services.get_track(get_track_index(id)))
+
+    def handle_track_credits(self, endpoint: str, id: str):
+        self.send_payload(endpoint, 200, self.services.get_track_credits())
+
+    def handle_lyrics(self, endpoint: str, id: str):
+        self.send_payload(endpoint, 200, self.services.get_lyrics())
+
+    def handle_storage_resolve(self, endpoint: str, file_id: str):
+        self.send_payload(
+            endpoint,
+            200,
+            {"cdnurl": [f"{self.services.base_url}/audio/{file_id}"]},
+        )
+
+    def handle_seektable(self, endpoint: str, file_id: str):
+        self.send_payload(endpoint, 200, {"pssh": ""})
+
+    def handle_license(self, endpoint: str, type: str):
+        self.send_payload(endpoint, 501, "Licenses are not emulated")
+
+    def handle_cdn_audio(self, endpoint: str, file_id: str):
+        if self.services.cdn_latency:
+            time.sleep(self.services.cdn_latency)
+        media = self.services.media
+        range_match = re.fullmatch(
+            r"bytes=(\d+)-(\d*)", self.headers.get("Range") or ""
+        )
+        if range_match is None:
+            self.send_payload(endpoint, 200, media)
+            return
+        start = int(range_match.group(1))
+        end = min(int(range_match.group(2) or len(media) - 1), len(media) - 1)
+        self.send_payload(
+            endpoint,
+            206,
+            media[start : end + 1],
+            {"Content-Range": f"bytes {start}-{end}/{len(media)}"},
+        )
+
+    def handle_cover(self, endpoint: str, file_id: str):
+        if self.services.cdn_latency:
+            time.sleep(self.services.cdn_latency)
+        self.send_payload(endpoint, 200, self.services.cover)
+
+    def handle_jellyfin_ping(self, endpoint: str):
+        self.send_payload(endpoint, 200, "Jellyfin Server")
+
+    def handle_jellyfin_users(self, endpoint: str):
+        self.send_payload(
+            endpoint, 200, [{"Name": "benchmark", "Id": JELLYFIN_USER_ID}]
+        )
+
+    def handle_jellyfin_items(self, endpoint: str):
+        self.send_payload(
+            endpoint,
+            200,
+            self.services.get_jellyfin_items(
+                int(self.query.get("StartIndex", 0)),
+                int(self.query.get("Limit", 1000)),
+                self.query.get("MinDateLastSaved"),
+            ),
+        )
+
+    def handle_jellyfin_media_updated(self, endpoint: str):
+        self.services.add_jellyfin_items(
+            [update["Path"] for update in json.loads(self.body)["Updates"]]
+        )
+        self.send_payload(endpoint, 204, b"")
+
+    def handle_jellyfin_library_refresh(self, endpoint: str):
+        self.send_payload(endpoint, 204, b"")
+
+    def handle_jellyfin_create_playlist(self, endpoint: str):
+        playlist_id = uuid.uuid4().hex
+        self.services.jellyfin_playlists[playlist_id] = []
+        self.services.add_jellyfin_playlist_items(
+            playlist_id, json.loads(self.body)["Ids"]
+        )
+        self.send_payload(endpoint, 200, {"Id": playlist_id})
+
+    def handle_jellyfin_playlist_items(self, endpoint: str, id: str):
+        entries = self.services.jellyfin_playlists.get(id)
+        if entries is None:
+            self.send_payload(endpoint, 404, b"")
+            return
+        self.send_payload(
+            endpoint,
+            200,
+            {
+                "Items": [
+                    {"PlaylistItemId": entry_id, "Id": item_id}
+                    for entry_id, item_id in entries
+                ]
+            },
+        )
+
+    def handle_jellyfin_add_playlist_items(self, endpoint: str, id: str):
+        self.services.add_jellyfin_playlist_items(
+            id, [item_id for item_id in self.query.get("Ids", "").split(",") if item_id]
+        )
+        self.send_payload(endpoint, 204, b"")
+
+    def handle_jellyfin_remove_playlist_items(self, endpoint: str, id: str):
+        entry_ids = set(self.query.get("EntryIds", "").split(","))
+        with self.services._lock:
+            self.services.jellyfin_playlists[id] = [
+                entry
+                for entry in self.services.jellyfin_playlists[id]
+                if entry[0] not in entry_ids
+            ]
+        self.send_payload(endpoint, 204, b"")
+
+    def handle_jellyfin_move_playlist_item(
+        self, endpoint: str, id: str, entry_id: str, index: str
+    ):
+        with self.services._lock:
+            entries = self.services.jellyfin_playlists[id]
+            entry = next(entry for entry in entries if entry[0] == entry_id)
+            entries.remove(entry)
+            entries.insert(int(index), entry)
+        self.send_payload(endpoint, 204, b"")
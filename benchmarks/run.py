@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import functools
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import click
+
+from spotify_to_jellyfin import cli
+from spotify_to_jellyfin.downloader import Downloader
+from spotify_to_jellyfin.key_store import KeyStore
+from spotify_to_jellyfin.pipeline import TrackPipeline
+from spotify_to_jellyfin.spotify_api import SpotifyApi
+from spotify_to_jellyfin.token_manager import TokenManager
+
+from .fake_services import (
+    DECRYPTION_KEY,
+    JELLYFIN_USER_ID,
+    FakeServices,
+    get_file_id,
+    get_playlist_id,
+)
+
+SP_DC_COOKIE = "benchmark"
+DISCORD_ID = 1
+
+
+def redirect_services(base_url: str):
+    for cls in (SpotifyApi, TokenManager, Downloader):
+        for name, value in list(vars(cls).items()):
+            if name.endswith("_URL") and isinstance(value, str):
+                setattr(cls, name, re.sub(r"^https://[^/]+", base_url, value))
+
+
+def seed_key_store(key_store_path: Path, track_count: int):
+    key_store = KeyStore(key_store_path, SP_DC_COOKIE)
+    for index in range(track_count):
+        key_store.set("audio", get_file_id(index), DECRYPTION_KEY.hex())
+
+
+def get_percentile(durations: list[float], percentile: float) -> float:
+    durations = sorted(durations)
+    return durations[min(int(len(durations) * percentile), len(durations) - 1)]
+
+
+class PipelineRecorder:
+    def __init__(self):
+        self.stage_durations = defaultdict(list)
+        self.jobs = []
+        self._lock = threading.Lock()
+
+    def install(self):
+        recorder = self
+        set_stages = TrackPipeline._set_stages
+        run = TrackPipeline.run
+
+        def _set_stages(pipeline: TrackPipeline):
+            set_stages(pipeline)
+            pipeline.stages = [
+                (recorder.wrap_stage(stage), worker_count)
+                for stage, worker_count in pipeline.stages
+            ]
+
+        def run_recorded(pipeline: TrackPipeline, *args, **kwargs):
+            jobs = run(pipeline, *args, **kwargs)
+            with recorder._lock:
+                recorder.jobs.extend(jobs)
+            return jobs
+
+        TrackPipeline._set_stages = _set_stages
+        TrackPipeline.run = run_recorded
+
+    def wrap_stage(self, stage):
+        stage_name = re.sub(r"^_stage_", "", stage.__name__)
+
+        @functools.wraps(stage)
+        def timed_stage(job):
+            start_time = time.perf_counter()
+            try:
+                stage(job)
+            finally:
+                with self._lock:
+                    self.stage_durations[stage_name].append(
+                        time.perf_counter() - start_time
+                    )
+
+        return timed_stage
+
+    def reset(self):
+        with self._lock:
+            self.stage_durations.clear()
+            self.jobs.clear()
+
+    def get_stage_stats(self) -> dict[str, dict]:
+        return {
+            stage_name: {
+                "count": len(durations),
+                "mean": sum(durations) / len(durations),
+                "p50": get_percentile(durations, 0.5),
+                "p99": get_percentile(durations, 0.99),
+            }
+            for stage_name, durations in self.stage_durations.items()
+            if durations
+        }
+
+
+def run_cli(
+    services: FakeServices,
+    work_path: Path,
+    track_count: int,
+    cli_args: tuple[str],
+):
+    cli.main.main(
+        [
+            f"https://open.spotify.com/playlist/{get_playlist_id(track_count)}",
+            "--no-config-file",
+            "--config-path",
+            str(work_path / "config" / "config.json"),
+            "--output-path",
+            str(work_path / "Music"),
+            "--temp-path",
+            str(work_path / "temp"),
+            "--sp-dc-cookie",
+            SP_DC_COOKIE,
+            "--remux-mode",
+            "native",
+            "--download-mode-song",
+            "native",
+            "--log-level",
+            "ERROR",
+            *cli_args,
+        ],
+        standalone_mode=False,
+    )
+
+
+def run_bot(
+    services: FakeServices,
+    work_path: Path,
+    track_count: int,
+    cli_args: tuple[str],
+):
+    from spotify_to_jellyfin.notcli import Spotifin
+
+    os.environ.update(
+        SP_DC_COOKIE=SP_DC_COOKIE,
+        JELLYFIN_URL=services.jellyfin_url,
+        JELLYFIN_API_KEY="benchmark",
+    )
+    (work_path / "config" / "users.json").write_text(
+        json.dumps(
+            [
+                {
+                    "name": "benchmark",
+                    "jellyfin_id": JELLYFIN_USER_ID,
+                    "discord_id": DISCORD_ID,
+                }
+            ]
+        )
+    )
+    current_path = Path.cwd()
+    os.chdir(work_path)
+    try:
+        spotifin = Spotifin(work_path / "Music")
+        try:
+            spotifin.request_music(
+                f"https://open.spotify.com/playlist/{get_playlist_id(track_count)}",
+                DISCORD_ID,
+            )
+        finally:
+            spotifin.close()
+    finally:
+        os.chdir(current_path)
+
+
+@click.command()
+@click.option(
+    "--tracks",
+    "-t",
+    type=int,
+    multiple=True,
+    default=(10, 100),
+    help="Playlist sizes to benchmark.",
+)
+@click.option(
+    "--target",
+    type=click.Choice(["cli", "bot"]),
+    default="cli",
+    help="Entry point to benchmark.",
+)
+@click.option(
+    "--passes",
+    type=int,
+    default=2,
+    help="Runs per playlist size, later passes reuse the library and caches.",
+)
+@click.option(
+    "--track-size",
+    type=int,
+    default=256 * 1024,
+    help="Size of the synthetic encrypted tracks in bytes.",
+)
+@click.option(
+    "--api-latency",
+    type=float,
+    default=0.02,
+    help="Latency of the fake API endpoints in seconds.",
+)
+@click.option(
+    "--cdn-latency",
+    type=float,
+    default=0.05,
+    help="Time to first byte of the fake CDN in seconds.",
+)
+@click.option(
+    "--bandwidth",
+    type=float,
+    default=10 * 1024 * 1024,
+    help="Bandwidth per CDN connection in bytes per second, 0 for unlimited.",
+)
+@click.option(
+    "--host-rate",
+    type=float,
+    default=1000,
+    help="Request rate limit towards the fake services.",
+)
+@click.option(
+    "--output",
+    "-o",
+    type=Path,
+    default=None,
+    help="Path to write the JSON results to instead of stdout.",
+)
+@click.argument("cli_args", nargs=-1, type=click.UNPROCESSED)
+def main(
+    tracks: tuple[int],
+    target: str,
+    passes: int,
+    track_size: int,
+    api_latency: float,
+    cdn_latency: float,
+    bandwidth: float,
+    host_rate: float,
+    output: Path,
+    cli_args: tuple[str],
+):
+    # Every fake service shares one host, so its connection pool overflows
+    logging.getLogger("urllib3.connectionpool").setLevel(logging.ERROR)
+    services = FakeServices(track_size, api_latency, cdn_latency, bandwidth)
+    services.start()
+    redirect_services(services.base_url)
+    SpotifyApi.DEFAULT_HOST_RATE = host_rate
+    recorder = PipelineRecorder()
+    recorder.install()
+    run_target = run_bot if target == "bot" else run_cli
+    results = []
+    try:
+        for track_count in tracks:
+            work_path = Path(tempfile.mkdtemp(prefix="spotifin-benchmark-"))
+            try:
+                (work_path / "config").mkdir()
+                seed_key_store(work_path / "config" / "keys.db", track_count)
+                for pass_index in range(1, passes + 1):
+                    services.reset_request_counts()
+                    recorder.reset()
+                    start_time = time.perf_counter()
+                    run_target(services, work_path, track_count, cli_args)
+                    elapsed = time.perf_counter() - start_time
+                    results.append(
+                        {
+                            "target": target,
+                            "tracks": track_count,
+                            "pass": pass_index,
+                            "elapsed": elapsed,
+                            "tracks_per_minute": track_count / elapsed * 60,
+                            "jobs": len(recorder.jobs),
+                            "errors": sum(1 for job in recorder.jobs if job.failed),
+                            "stages": recorder.get_stage_stats(),
+                            "requests": services.get_request_counts(),
+                        }
+                    )
+            finally:
+                shutil.rmtree(work_path, ignore_errors=True)
+    finally:
+        services.stop()
+    report = json.dumps(
+        {
+            "config": {
+                "track_size": track_size,
+                "api_latency": api_latency,
+                "cdn_latency": cdn_latency,
+                "bandwidth": bandwidth,
+                "host_rate": host_rate,
+                "cli_args": list(cli_args),
+            },
+            "results": results,
+        },
+        indent=4,
+    )
+    if output is None:
+        click.echo(report)
+    else:
+        output.write_text(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
+from __future__ import annotations
+
 import os
 import sys
 import asyncio
+import contextlib
+from pathlib import Path
 import discord
 from discord import app_commands
-from spotify_to_jellyfin.notcli import request_music
+from spotify_to_jellyfin.job_queue import JobQueue
+from spotify_to_jellyfin.metrics import Metrics, MetricsServer
+from spotify_to_jellyfin.notcli import Spotifin
+from spotify_to_jellyfin.spotify_api import SpotifyApi
 
 TOKEN = os.getenv("DISCORD_TOKEN")
 MUSIC_LIBRARY_PATH = os.getenv("MUSIC_LIBRARY_PATH")
@@ -13,11 +20,120 @@ tree = app_commands.CommandTree(client)
 spotifin_channel_id = int(os.getenv("SPOTIFIN_CHANNEL_ID"))
 assert spotifin_channel_id, "SPOTIFIN_CHANNEL_ID not set"
 
-request_music_lock = asyncio.Lock()
+HEALTH_CHECK_INTERVAL = 5 * 60
+WORKER_COUNT = int(os.getenv("SPOTIFIN_WORKERS", "1"))
+METRICS_PORT = os.getenv("METRICS_PORT")
+
+spotifin = None
+active_jobs = 0
+job_queue = JobQueue(Path("./config/jobs.db"))
+job_queue_event = None
+services_lock = None
+metrics = Metrics()
+if METRICS_PORT:
+    MetricsServer(metrics, int(METRICS_PORT)).start()
+
+
+@contextlib.asynccontextmanager
+async def use_services():
+    global active_jobs
+    # Waits for a running health check, which may replace the services
+    async with services_lock:
+        active_jobs += 1
+        services = spotifin
+    try:
+        yield services
+    finally:
+        active_jobs -= 1
+
+
+async def check_health():
+    global spotifin
+    loop = asyncio.get_event_loop()
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        async with services_lock:
+            if active_jobs:
+                continue
+            try:
+                await loop.run_in_executor(None, spotifin.check_health)
+            except Exception as e:
+                print(f"Health check failed, restarting services: {e}")
+                try:
+                    new_spotifin = await loop.run_in_executor(
+                        None, Spotifin, Path(MUSIC_LIBRARY_PATH), metrics
+                    )
+                except Exception as e:
+                    print(f"Failed to restart services: {e}")
+                    continue
+                spotifin.close()
+                spotifin = new_spotifin
+
+
+async def notify_subscribers(link: str, subscribers: list[tuple[int, int]], message):
+    for channel_id in dict.fromkeys(channel_id for _, channel_id in subscribers):
+        try:
+            channel = client.get_channel(channel_id) or await client.fetch_channel(
+                channel_id
+            )
+            await channel.send(message)
+        except Exception as e:
+            print(f"Failed to notify channel {channel_id} about {link}: {e}")
+
+
+async def process_jobs():
+    loop = asyncio.get_event_loop()
+    while True:
+        job = job_queue.claim()
+        if job is None:
+            job_queue_event.clear()
+            await job_queue_event.wait()
+            continue
+        try:
+            async with use_services() as services:
+                await loop.run_in_executor(
+                    None, services.request_music, job.link, job.discord_id, job.public
+                )
+        except Exception as e:
+            subscribers = job_queue.complete(job.id, str(e))
+            await notify_subscribers(
+                job.link,
+                subscribers,
+                f":bangbang: An error occurred during the processing of the request for {job.link}: ```{e}```",
+            )
+        else:
+            subscribers = job_queue.complete(job.id)
+            await notify_subscribers(
+                job.link, subscribers, f"{job.link} is now available on jellyfin!"
+            )
+
+
+def get_link_name(spotify_api: SpotifyApi, link_type: str, link_id: str) -> str:
+    if link_type == "track":
+        return spotify_api.get_track(link_id)["name"]
+    elif link_type == "album":
+        return spotify_api.get_album(link_id, extend=False)["name"]
+    elif link_type == "playlist":
+        return spotify_api.get_playlist(link_id, extend=False)["name"]
+    raise ValueError(f"Unsupported link type: {link_type}")
+
 
 @client.event
 async def on_ready():
     print(f"{client.user} has connected to Discord!")
+    global spotifin, job_queue_event, services_lock
+    if spotifin is None:
+        # Created here so they are bound to the loop started by client.run
+        job_queue_event = asyncio.Event()
+        services_lock = asyncio.Lock()
+        loop = asyncio.get_event_loop()
+        spotifin = await loop.run_in_executor(
+            None, Spotifin, Path(MUSIC_LIBRARY_PATH), metrics
+        )
+        job_queue.reset_running()
+        for _ in range(max(WORKER_COUNT, 1)):
+            client.loop.create_task(process_jobs())
+        client.loop.create_task(check_health())
     if sys.argv[1:] and sys.argv[1] == "sync":
         print("Syncing commands...")
         try:
@@ -34,33 +150,61 @@ async def on_ready():
     public="[For playlists] Whether the playlist should be visible to everyone",
 )
 async def request(interaction: discord.Interaction, link: str, public: bool = False):
-    if request_music_lock.locked():
+    if spotifin is None:
         await interaction.response.send_message(
-            "Another request is currently being processed. Please try again later.",
+            "The bot is still starting up. Please try again in a moment.",
             ephemeral=True,
         )
         return
-    async with request_music_lock:
-        link = link.split("?si=")[0]
-        if not public and link.split("/")[-2] == "playlist":
-            channel = interaction.user.dm_channel
-            if not channel:
-                channel = await interaction.user.create_dm()
-        else:
-            channel = client.get_channel(spotifin_channel_id)
+    # Resolving the link can take longer than Discord's response deadline
+    await interaction.response.defer(ephemeral=True)
+    link = link.split("?si=")[0]
+    link_type, link_id = link.split("/")[-2:]
+    loop = asyncio.get_event_loop()
+    try:
+        async with use_services() as services:
+            link_name = await loop.run_in_executor(
+                None, get_link_name, services.spotify_api, link_type, link_id
+            )
+    except Exception as e:
+        await interaction.followup.send(f"Couldn't resolve {link}: {e}", ephemeral=True)
+        return
+    if not public and link_type == "playlist":
+        channel = interaction.user.dm_channel
+        if not channel:
+            channel = await interaction.user.create_dm()
+    else:
+        channel = client.get_channel(spotifin_channel_id)
+    job, is_new = job_queue.enqueue(link, interaction.user.id, channel.id, public)
+    job_queue_event.set()
+    position = job_queue.get_position(job.id)
+    if position is None:
+        status = "It is already being processed"
+    elif is_new:
+        status = f"Position in queue: {position}"
+    else:
+        status = f"It is already queued at position {position}"
+    await interaction.followup.send(
+        f'Request for "{link_name}" ({link}) received! {status}.', ephemeral=True
+    )
+
+
+@tree.command(name="queue")
+async def queue(interaction: discord.Interaction):
+    jobs = job_queue.get_user_jobs(interaction.user.id)
+    if not jobs:
         await interaction.response.send_message(
-            f"Request for {link} received!", ephemeral=True
+            "You have no pending requests.", ephemeral=True
         )
-        try:
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(
-                None, request_music, link, interaction.user.id, MUSIC_LIBRARY_PATH, public
-            )
-            await channel.send(f"{link} is now available on jellyfin!")
-        except Exception as e:
-            await channel.send(
-                f":bangbang: An error occurred during the processing of the request for {link}: ```{e}```"
-            )
+        return
+    lines = []
+    for job in jobs:
+        position = job_queue.get_position(job.id)
+        if position is None:
+            lines.append(f"{job.link}: processing")
+        else:
+            lines.append(f"{job.link}: position {position}")
+    await interaction.response.send_message("\n".join(lines), ephemeral=True)
 
 
 client.run(token=TOKEN)
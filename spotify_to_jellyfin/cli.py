@@ -2,9 +2,12 @@ from __future__ import annotations
 
 import os
 import dotenv
+import heapq
 import inspect
 import json
 import logging
+import random
+import time
 from enum import Enum
 from pathlib import Path
 
@@ -16,13 +19,70 @@ from .downloader import Downloader
 from .downloader_music_video import DownloaderMusicVideo
 from .downloader_song import DownloaderSong
 from .enums import DownloadModeSong, DownloadModeVideo, RemuxMode
-from .models import Lyrics
+from .metrics import Metrics
+from .pipeline import TrackPipeline
 from .spotify_api import SpotifyApi
 
 spotify_api_sig = inspect.signature(SpotifyApi.__init__)
 downloader_sig = inspect.signature(Downloader.__init__)
 downloader_song_sig = inspect.signature(DownloaderSong.__init__)
 downloader_music_video_sig = inspect.signature(DownloaderMusicVideo.__init__)
+track_pipeline_sig = inspect.signature(TrackPipeline.__init__)
+
+
+def download_url(
+    url: str,
+    url_progress: str,
+    downloader: Downloader,
+    track_pipeline: TrackPipeline,
+    logger: logging.Logger,
+    use_playlist_delta: bool,
+    print_exceptions: bool,
+) -> int:
+    playlist_delta = None
+    try:
+        url_info = downloader.get_url_info(url)
+        if url_info.type == "playlist" and use_playlist_delta:
+            playlist_delta = downloader.get_playlist_delta(
+                url_info.id, track_pipeline.get_playlist_scope()
+            )
+            download_queue = playlist_delta.download_queue
+        else:
+            download_queue = downloader.get_download_queue(url_info)
+    except Exception as e:
+        logger.error(
+            f'({url_progress}) Failed to check "{url}"',
+            exc_info=print_exceptions,
+        )
+        return 1
+    if playlist_delta is not None and playlist_delta.unchanged:
+        logger.info(
+            f'({url_progress}) Playlist "{playlist_delta.name}" is unchanged, skipping'
+        )
+        downloader.set_playlist_snapshot(playlist_delta.snapshot)
+        return 0
+    jobs = track_pipeline.run(download_queue, url_progress)
+    error_count = track_pipeline.get_error_count(jobs)
+    if playlist_delta is not None and not error_count:
+        downloader.set_playlist_snapshot(playlist_delta.snapshot)
+    return error_count
+
+
+def get_urls(urls: list[str], read_urls_as_txt: bool) -> list[str]:
+    if read_urls_as_txt:
+        return [url.strip() for url in Path(urls[0]).read_text().splitlines()]
+    return list(urls)
+
+
+def get_watch_delay(watch_interval: int) -> float:
+    return watch_interval * random.uniform(1 - WATCH_JITTER, 1 + WATCH_JITTER)
+
+
+def write_report(report_path: Path, metrics: Metrics, error_count: int) -> None:
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    report_path.write_text(
+        json.dumps({"error_count": error_count, **metrics.get_report()}, indent=4)
+    )
 
 
 def get_param_string(param: click.Parameter) -> str:
@@ -96,6 +156,17 @@ def load_config_file(
     is_flag=True,
     help="Interpret URLs as paths to text files containing URLs.",
 )
+@click.option(
+    "--watch",
+    is_flag=True,
+    help="Keep running and poll the URLs for changes.",
+)
+@click.option(
+    "--watch-interval",
+    type=int,
+    default=3600,
+    help="Seconds between polls of each URL in watch mode.",
+)
 @click.option(
     "--lrc-only",
     "-l",
@@ -124,6 +195,12 @@ def load_config_file(
     is_flag=True,
     help="Print exceptions.",
 )
+@click.option(
+    "--report-path",
+    type=Path,
+    default=None,
+    help="Path to write a JSON report with stage timings and HTTP status counts to.",
+)
 # API specific options
 @click.option(
     "--sp-dc-cookie",
@@ -267,6 +344,31 @@ def load_config_file(
     default=downloader_music_video_sig.parameters["download_mode"].default,
     help="Download mode for videos.",
 )
+# TrackPipeline specific options
+@click.option(
+    "--metadata-workers",
+    type=int,
+    default=track_pipeline_sig.parameters["metadata_workers"].default,
+    help="Number of tracks fetching metadata concurrently.",
+)
+@click.option(
+    "--key-workers",
+    type=int,
+    default=track_pipeline_sig.parameters["key_workers"].default,
+    help="Number of tracks acquiring decryption keys concurrently.",
+)
+@click.option(
+    "--download-workers",
+    type=int,
+    default=track_pipeline_sig.parameters["download_workers"].default,
+    help="Number of tracks downloading concurrently.",
+)
+@click.option(
+    "--remux-workers",
+    type=int,
+    default=track_pipeline_sig.parameters["remux_workers"].default,
+    help="Number of tracks being remuxed and tagged concurrently.",
+)
 # This option should always be last
 @click.option(
     "--no-config-file",
@@ -281,11 +383,14 @@ def main(
     save_cover: bool,
     overwrite: bool,
     read_urls_as_txt: bool,
+    watch: bool,
+    watch_interval: int,
     lrc_only: bool,
     no_lrc: bool,
     config_path: Path,
     log_level: str,
     print_exceptions: bool,
+    report_path: Path,
     sp_dc_cookie: str,
     third_party_lyrics: bool,
     output_path: Path,
@@ -309,6 +414,10 @@ def main(
     template_folder_music_video: str,
     template_file_music_video: str,
     download_mode_video: DownloadModeVideo,
+    metadata_workers: int,
+    key_workers: int,
+    download_workers: int,
+    remux_workers: int,
     no_config_file: bool,
 ) -> None:
     dotenv.load_dotenv()
@@ -326,7 +435,13 @@ def main(
             "Environment variable or commandline argument for sp_dc_cookie not found"
         )
         return
-    spotify_api = SpotifyApi(sp_dc_cookie)
+    metrics = Metrics()
+    spotify_api = SpotifyApi(
+        sp_dc_cookie,
+        config_path.parent / "metadata_cache.db",
+        config_path.parent / "token.json",
+        metrics,
+    )
     downloader = Downloader(
         spotify_api,
         output_path,
@@ -341,6 +456,9 @@ def main(
         date_tag_template,
         exclude_tags,
         truncate,
+        key_store_path=config_path.parent / "keys.db",
+        cover_cache_path=config_path.parent / "covers",
+        manifest_path=config_path.parent / "library.db",
     )
     downloader_song = DownloaderSong(
         downloader,
@@ -350,6 +468,7 @@ def main(
         template_file_multi_disc,
         download_mode_song,
         premium_quality,
+        metadata_workers,
     )
     downloader_music_video = DownloaderMusicVideo(
         downloader,
@@ -374,6 +493,12 @@ def main(
         ):
             logger.critical(X_NOT_FOUND_STRING.format("aria2c", aria2c_path))
             return
+        if (
+            download_mode_song == DownloadModeSong.STREAM
+            and remux_mode == RemuxMode.MP4BOX
+        ):
+            logger.critical("Download mode stream is not supported with MP4Box")
+            return
         if (
             download_mode_video == DownloadModeVideo.NM3U8DLRE
             and not downloader.nm3u8dlre_path_full
@@ -395,246 +520,82 @@ def main(
         if not spotify_api.is_premium and download_music_video:
             logger.critical("Cannot download music videos with a free account")
             return
+    track_pipeline = TrackPipeline(
+        downloader,
+        downloader_song,
+        downloader_music_video,
+        logger,
+        overwrite,
+        lrc_only,
+        no_lrc,
+        save_cover,
+        download_music_video,
+        third_party_lyrics,
+        print_exceptions,
+        metadata_workers,
+        key_workers,
+        download_workers,
+        remux_workers,
+    )
     error_count = 0
-    if read_urls_as_txt:
-        urls = [url.strip() for url in Path(urls[0]).read_text().splitlines()]
-    for url_index, url in enumerate(urls, start=1):
-        url_progress = f"URL {url_index}/{len(urls)}"
-        try:
-            url_info = downloader.get_url_info(url)
-            download_queue = downloader.get_download_queue(url_info)
-        except Exception as e:
-            error_count += 1
-            logger.error(
-                f'({url_progress}) Failed to check "{url}"',
-                exc_info=print_exceptions,
+    use_playlist_delta = not overwrite and not lrc_only
+    if watch:
+        logger.info(f"Watching {len(get_urls(urls, read_urls_as_txt))} URL(s)")
+        schedule = []
+        while True:
+            watched_urls = get_urls(urls, read_urls_as_txt)
+            scheduled_urls = {url for _, url in schedule}
+            schedule = [
+                (due_time, url) for due_time, url in schedule if url in watched_urls
+            ]
+            schedule.extend(
+                (time.monotonic(), url)
+                for url in watched_urls
+                if url not in scheduled_urls
             )
-            continue
-        for queue_index, queue_item in enumerate(download_queue, start=1):
-            queue_progress = f"Track {queue_index}/{len(download_queue)} from URL {url_index}/{len(urls)}"
-            track = queue_item.metadata
-            try:
-                logger.info(f'({queue_progress}) Downloading "{track["name"]}"')
-                track_id = track["id"]
-                logger.debug("Getting GID metadata")
-                gid = spotify_api.track_id_to_gid(track_id)
-                metadata_gid = spotify_api.get_gid_metadata(gid)
-                if download_music_video:
-                    music_video_id = (
-                        downloader_music_video.get_music_video_id_from_song_id(
-                            track_id, queue_item.metadata["artists"][0]["id"]
-                        )
-                    )
-                    if not music_video_id:
-                        logger.warning(
-                            f"({queue_progress}) No music video alternative found, skipping"
-                        )
-                        continue
-                    metadata_gid = spotify_api.get_gid_metadata(
-                        spotify_api.track_id_to_gid(music_video_id)
-                    )
-                    logger.warning(
-                        f"({queue_progress}) Switching to download music video "
-                        f"with title \"{metadata_gid['name']}\""
-                    )
-                if not metadata_gid.get("original_video"):
-                    logger.debug("Getting album metadata")
-                    album_metadata = spotify_api.get_album(
-                        spotify_api.gid_to_track_id(metadata_gid["album"]["gid"])
-                    )
-                    logger.debug("Getting track credits")
-                    track_credits = spotify_api.get_track_credits(track_id)
-                    tags = downloader_song.get_tags(
-                        metadata_gid, album_metadata, track_credits
-                    )
-                    if metadata_gid.get("has_lyrics") and spotify_api.is_premium:
-                        lyrics = downloader_song.get_lyrics(track_id)
-                    if not lyrics.synced and third_party_lyrics:
-                        logger.debug("Getting third-party lyrics")
-                        try:
-                            logger.debug(
-                                f"Searching third-party lyrics for {tags['artist']} - {tags['title']}"
-                            )
-                            tp_lyrics = downloader_song.get_third_party_lyrics(
-                                tags["title"], tags["artist"]
-                            )
-                        except Exception as e:
-                            logger.error(
-                                f"({queue_progress}) Failed to get third-party lyrics {e}",
-                                exc_info=print_exceptions,
-                            )
-                        if tp_lyrics.synced or not lyrics.unsynced:
-                            lyrics = tp_lyrics
-                    tags["lyrics"] = lyrics.unsynced
-                    final_path = downloader_song.get_final_path(tags)
-                    lrc_path = downloader_song.get_lrc_path(final_path)
-                    cover_path = downloader_song.get_cover_path(final_path)
-                    cover_url = downloader.get_cover_url(metadata_gid, "LARGE")
-                    if lrc_only:
-                        pass
-                    elif final_path.exists() and not overwrite:
-                        logger.warning(
-                            f'({queue_progress}) Track already exists at "{final_path}", skipping'
-                        )
-                    else:
-                        logger.debug("Getting file info")
-                        file_id = downloader_song.get_file_id(metadata_gid)
-                        if not file_id:
-                            logger.error(
-                                f"({queue_progress}) Track not available on Spotify's "
-                                "servers and no alternative found, skipping"
-                            )
-                            continue
-                        logger.debug("Getting PSSH")
-                        pssh = spotify_api.get_pssh(file_id)
-                        logger.debug("Getting decryption key")
-                        decryption_key = downloader_song.get_decryption_key(pssh)
-                        logger.debug("Getting stream URL")
-                        stream_url = spotify_api.get_stream_url(file_id)
-                        encrypted_path = downloader.get_encrypted_path(track_id, ".m4a")
-                        decrypted_path = downloader.get_decrypted_path(track_id, ".m4a")
-                        logger.debug(f'Downloading to "{encrypted_path}"')
-                        downloader_song.download(encrypted_path, stream_url)
-                        remuxed_path = downloader.get_remuxed_path(track_id, ".m4a")
-                        logger.debug(f'Decrypting/Remuxing to "{remuxed_path}"')
-                        downloader_song.remux(
-                            encrypted_path,
-                            decrypted_path,
-                            remuxed_path,
-                            decryption_key,
-                        )
-                        logger.debug("Applying tags")
-                        downloader.apply_tags(remuxed_path, tags, cover_url)
-                        logger.debug(f'Moving to "{final_path}"')
-                        downloader.move_to_final_path(remuxed_path, final_path)
-                    if no_lrc or not lyrics.synced:
-                        pass
-                    elif lrc_path.exists() and not overwrite:
-                        logger.debug(
-                            f'Synced lyrics already exists at "{lrc_path}", skipping'
-                        )
-                    else:
-                        logger.debug(f'Saving synced lyrics to "{lrc_path}"')
-                        downloader_song.save_lrc(lrc_path, lyrics.synced)
-                    if lrc_only or not save_cover:
-                        pass
-                    elif cover_path.exists() and not overwrite:
-                        logger.debug(
-                            f'Cover already exists at "{cover_path}", skipping'
-                        )
-                    else:
-                        logger.debug(f'Saving cover to "{cover_path}"')
-                        downloader.save_cover(cover_path, cover_url)
-                elif not spotify_api.is_premium:
-                    logger.error(
-                        f"({queue_progress}) Cannot download music videos with a free account, skipping"
-                    )
-                elif lrc_only:
-                    logger.warn(
-                        f"({queue_progress}) Music videos are not downloadable with "
-                        "current settings, skipping"
-                    )
-                else:
-                    cover_url = downloader.get_cover_url(metadata_gid, "XXLARGE")
-                    logger.debug("Getting album metadata")
-                    album_metadata = spotify_api.get_album(
-                        spotify_api.gid_to_track_id(metadata_gid["album"]["gid"])
-                    )
-                    logger.debug("Getting track credits")
-                    track_credits = spotify_api.get_track_credits(track_id)
-                    tags = downloader_music_video.get_tags(
-                        metadata_gid,
-                        album_metadata,
-                        track_credits,
-                    )
-                    final_path = downloader_music_video.get_final_path(tags)
-                    cover_path = downloader_music_video.get_cover_path(final_path)
-                    if final_path.exists() and not overwrite:
-                        logger.warning(
-                            f'({queue_progress}) Music video already exists at "{final_path}", skipping'
-                        )
-                    else:
-                        logger.debug("Getting video manifest")
-                        manifest = downloader_music_video.get_manifest(metadata_gid)
-                        stream_info = downloader_music_video.get_video_stream_info(
-                            manifest
-                        )
-                        logger.debug("Getting decryption key")
-                        decryption_key = downloader_music_video.get_decryption_key(
-                            stream_info.pssh
-                        )
-                        m3u8 = downloader_music_video.get_m3u8(
-                            stream_info.base_url,
-                            stream_info.initialization_template_url,
-                            stream_info.segment_template_url,
-                            stream_info.end_time_millis,
-                            stream_info.segment_length,
-                            stream_info.profile_id_video,
-                            stream_info.profile_id_audio,
-                            stream_info.file_type_video,
-                            stream_info.file_type_audio,
-                        )
-                        m3u8_path_video = downloader_music_video.get_m3u8_path(
-                            track_id, "video"
-                        )
-                        encrypted_path_video = downloader.get_encrypted_path(
-                            track_id, "_video.ts"
-                        )
-                        decrypted_path_video = downloader.get_decrypted_path(
-                            track_id, "_video.ts"
-                        )
-                        logger.debug(f'Downloading video to "{encrypted_path_video}"')
-                        downloader_music_video.save_m3u8(m3u8.video, m3u8_path_video)
-                        downloader_music_video.download(
-                            m3u8_path_video,
-                            encrypted_path_video,
-                        )
-                        m3u8_path_audio = downloader_music_video.get_m3u8_path(
-                            track_id, "audio"
-                        )
-                        encrypted_path_audio = downloader.get_encrypted_path(
-                            track_id, "_audio.ts"
-                        )
-                        decrypted_path_audio = downloader.get_decrypted_path(
-                            track_id, "_audio.ts"
-                        )
-                        logger.debug(f"Downloading audio to {encrypted_path_audio}")
-                        downloader_music_video.save_m3u8(m3u8.audio, m3u8_path_audio)
-                        downloader_music_video.download(
-                            m3u8_path_audio,
-                            encrypted_path_audio,
-                        )
-                        remuxed_path = downloader.get_remuxed_path(track_id, ".m4v")
-                        logger.debug(f'Decrypting/Remuxing to "{remuxed_path}"')
-                        downloader_music_video.remux(
-                            decryption_key,
-                            encrypted_path_video,
-                            encrypted_path_audio,
-                            decrypted_path_video,
-                            decrypted_path_audio,
-                            remuxed_path,
-                        )
-                        logger.debug("Applying tags")
-                        downloader.apply_tags(remuxed_path, tags, cover_url)
-                        logger.debug(f'Moving to "{final_path}"')
-                        downloader.move_to_final_path(remuxed_path, final_path)
-                    if save_cover:
-                        cover_path = downloader_music_video.get_cover_path(final_path)
-                        if cover_path.exists() and not overwrite:
-                            logger.debug(
-                                f'Cover already exists at "{cover_path}", skipping'
-                            )
-                        else:
-                            logger.debug(f'Saving cover to "{cover_path}"')
-                            downloader.save_cover(cover_path, cover_url)
-            except Exception as e:
-                error_count += 1
-                logger.error(
-                    f'({queue_progress}) Failed to download "{track["name"]}"',
-                    exc_info=print_exceptions,
-                )
-            finally:
-                if temp_path.exists():
-                    logger.debug(f'Cleaning up "{temp_path}"')
-                    downloader.cleanup_temp_path()
+            heapq.heapify(schedule)
+            if not schedule:
+                time.sleep(WATCH_RELOAD_INTERVAL)
+                continue
+            # Wake up regularly so changes to the URLs are picked up before polling
+            due_time, url = schedule[0]
+            delay = due_time - time.monotonic()
+            if delay > 0:
+                time.sleep(min(delay, WATCH_RELOAD_INTERVAL))
+                continue
+            heapq.heappop(schedule)
+            poll_error_count = download_url(
+                url,
+                f'Watching "{url}"',
+                downloader,
+                track_pipeline,
+                logger,
+                use_playlist_delta,
+                print_exceptions,
+            )
+            if poll_error_count:
+                logger.warning(f'Polled "{url}" with {poll_error_count} error(s)')
+            error_count += poll_error_count
+            if report_path:
+                write_report(report_path, metrics, error_count)
+            heapq.heappush(
+                schedule, (time.monotonic() + get_watch_delay(watch_interval), url)
+            )
+    urls = get_urls(urls, read_urls_as_txt)
+    for url_index, url in enumerate(urls, start=1):
+        error_count += download_url(
+            url,
+            f"URL {url_index}/{len(urls)}",
+            downloader,
+            track_pipeline,
+            logger,
+            use_playlist_delta,
+            print_exceptions,
+        )
+    if temp_path.exists():
+        logger.debug(f'Cleaning up "{temp_path}"')
+        downloader.cleanup_temp_path()
+    if report_path:
+        logger.debug(f'Writing report to "{report_path}"')
+        write_report(report_path, metrics, error_count)
     logger.info(f"Done ({error_count} error(s))")
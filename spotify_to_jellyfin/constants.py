@@ -2,6 +2,7 @@ EXCLUDED_CONFIG_FILE_PARAMS = (
     "urls",
     "config_path",
     "read_urls_as_txt",
+    "watch",
     "no_config_file",
     "version",
     "help",
@@ -22,4 +23,7 @@ MP4_TAGS_MAP = {
     "url": "\xa9url",
 }
 
+WATCH_JITTER = 0.1
+WATCH_RELOAD_INTERVAL = 60
+
 X_NOT_FOUND_STRING = "{} not found at {}"
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+
+class CoverCache:
+    EVICTION_RATIO = 0.9
+    PREFETCH_WORKERS = 4
+
+    def __init__(
+        self,
+        fetch: Callable[[str], bytes],
+        path: Path = None,
+        max_size: int = 512 * 1024 * 1024,
+        memory_size: int = 32 * 1024 * 1024,
+    ):
+        self.fetch = fetch
+        self.path = path
+        self.max_size = max_size
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.memory_used = 0
+        self.pending = {}
+        self.executor = None
+        self._lock = threading.Lock()
+        self._setup_path()
+
+    def _setup_path(self):
+        self.size = 0
+        if self.path is None:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        for cover_path in self.path.glob("*/*"):
+            self.size += cover_path.stat().st_size
+
+    @staticmethod
+    def get_file_id(url: str) -> str:
+        return url.rstrip("/").rsplit("/", 1)[-1]
+
+    def get_cover_path(self, file_id: str) -> Path:
+        return self.path / file_id[-2:] / file_id
+
+    def get(self, url: str) -> bytes:
+        file_id = self.get_file_id(url)
+        with self._lock:
+            if file_id in self.memory:
+                self.memory.move_to_end(file_id)
+                return self.memory[file_id]
+            future = self.pending.get(file_id)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.pending[file_id] = future
+        if not is_owner:
+            return future.result()
+        try:
+            image_bytes = self._load(file_id)
+            if image_bytes is None:
+                image_bytes = self.fetch(url)
+                self._store(file_id, image_bytes)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(image_bytes)
+        finally:
+            with self._lock:
+                del self.pending[file_id]
+        self._remember(file_id, image_bytes)
+        return image_bytes
+
+    def prefetch(self, url: str):
+        with self._lock:
+            if self.get_file_id(url) in self.memory:
+                return
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.PREFETCH_WORKERS)
+        self.executor.submit(self.get, url)
+
+    def _load(self, file_id: str) -> bytes | None:
+        if self.path is None:
+            return None
+        cover_path = self.get_cover_path(file_id)
+        try:
+            image_bytes = cover_path.read_bytes()
+        except FileNotFoundError:
+            return None
+        # The modification time doubles as last access time for eviction
+        os.utime(cover_path)
+        return image_bytes
+
+    def _store(self, file_id: str, image_bytes: bytes):
+        if self.path is None:
+            return
+        cover_path = self.get_cover_path(file_id)
+        cover_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = cover_path.with_name(f"{file_id}.{threading.get_ident()}.tmp")
+        temp_path.write_bytes(image_bytes)
+        os.replace(temp_path, cover_path)
+        with self._lock:
+            self.size += len(image_bytes)
+            if self.size > self.max_size:
+                self._evict()
+
+    def _evict(self):
+        cover_paths = []
+        for cover_path in self.path.glob("*/*"):
+            try:
+                stat = cover_path.stat()
+            except FileNotFoundError:
+                continue
+            cover_paths.append((stat.st_mtime, stat.st_size, cover_path))
+        self.size = sum(size for _, size, _ in cover_paths)
+        for _, size, cover_path in sorted(cover_paths):
+            if self.size <= self.max_size * self.EVICTION_RATIO:
+                break
+            cover_path.unlink(missing_ok=True)
+            self.size -= size
+
+    def _remember(self, file_id: str, image_bytes: bytes):
+        if len(image_bytes) > self.memory_size:
+            return
+        with self._lock:
+            if file_id in self.memory:
+                return
+            self.memory[file_id] = image_bytes
+            self.memory_used += len(image_bytes)
+            while self.memory_used > self.memory_size:
+                _, evicted_bytes = self.memory.popitem(last=False)
+                self.memory_used -= len(evicted_bytes)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
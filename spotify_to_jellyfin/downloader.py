@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import datetime
-import functools
+import io
 import re
 import shutil
 import subprocess
+import time
 from pathlib import Path
 
 import requests
@@ -12,14 +13,32 @@ from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
 from pywidevine import Cdm, Device
 
 from .constants import *
+from .cover_cache import CoverCache
 from .enums import RemuxMode
 from .hardcoded_wvd import HARDCODED_WVD
-from .models import DownloadQueueItem, UrlInfo
+from .key_store import KeyStore
+from .library_manifest import LibraryManifest
+from .models import DownloadQueueItem, PlaylistDelta, PlaylistSnapshot, UrlInfo
+from .mp4 import Mp4Remuxer
+from .rate_limiter import get_retry_delay
 from .spotify_api import SpotifyApi
 
 
 class Downloader:
     ILLEGAL_CHARACTERS_REGEX = r'[\\/:*?"<>|;]'
+    CDN_POOL_SIZE = 16
+    CDN_RETRIES = 5
+    CDN_TIMEOUT = 30
+    COVER_URL = "https://i.scdn.co/image/{file_id}"
+    # Smallest file mutagen will tag, used to render ilst boxes
+    ILST_SCRATCH_MP4 = Mp4Remuxer.render_box(
+        b"ftyp", b"M4A \0\0\0\0M4A mp42isom"
+    ) + Mp4Remuxer.render_box(
+        b"moov",
+        Mp4Remuxer.render_box(
+            b"mvhd", bytes(12) + (1000).to_bytes(4, "big") + bytes(84)
+        ),
+    )
 
     def __init__(
         self,
@@ -37,8 +56,12 @@ class Downloader:
         exclude_tags: str = None,
         truncate: int = 40,
         silence: bool = False,
+        key_store_path: Path = None,
+        cover_cache_path: Path = None,
+        manifest_path: Path = None,
     ):
         self.spotify_api = spotify_api
+        self.metrics = spotify_api.metrics
         self.output_path = output_path
         self.temp_path = temp_path
         self.wvd_path = wvd_path
@@ -52,10 +75,17 @@ class Downloader:
         self.exclude_tags = exclude_tags
         self.truncate = truncate
         self.silence = silence
+        self.key_store_path = key_store_path
+        self.cover_cache_path = cover_cache_path
+        self.manifest_path = manifest_path
         self._set_binaries_full_path()
         self._set_exclude_tags_list()
         self._set_truncate()
         self._set_subprocess_additional_args()
+        self._set_key_store()
+        self._set_cdn_session()
+        self._set_cover_cache()
+        self._set_library_manifest()
 
     def _set_binaries_full_path(self):
         self.ffmpeg_path_full = shutil.which(self.ffmpeg_path)
@@ -83,6 +113,69 @@ class Downloader:
         else:
             self.subprocess_additional_args = {}
 
+    def _set_key_store(self):
+        self.key_store = (
+            KeyStore(self.key_store_path, self.spotify_api.sp_dc)
+            if self.key_store_path
+            else None
+        )
+
+    def _set_cdn_session(self):
+        self.cdn_session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.CDN_POOL_SIZE,
+            pool_maxsize=self.CDN_POOL_SIZE,
+        )
+        self.cdn_session.mount("https://", adapter)
+        self.cdn_session.mount("http://", adapter)
+        self.cdn_session.hooks["response"].append(
+            self.metrics.get_response_hook("cdn", self.get_cdn_endpoint)
+        )
+
+    def get_cdn_endpoint(self, url: str) -> str:
+        return "cover" if url.startswith(self.COVER_URL.split("{")[0]) else "media"
+
+    def _set_cover_cache(self):
+        self.cover_cache = CoverCache(self.get_cdn_content, self.cover_cache_path)
+
+    def _set_library_manifest(self):
+        self.library_manifest = (
+            LibraryManifest(self.manifest_path) if self.manifest_path else None
+        )
+
+    def get_cdn_content(self, url: str, headers: dict = None) -> bytes:
+        return self.get_cdn_response(url, headers).content
+
+    def get_cdn_response(self, url: str, headers: dict = None) -> requests.Response:
+        for attempt in range(self.CDN_RETRIES + 1):
+            try:
+                response = self.cdn_session.get(
+                    url, headers=headers, timeout=self.CDN_TIMEOUT
+                )
+                if response.status_code not in SpotifyApi.RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ):
+                if attempt == self.CDN_RETRIES:
+                    raise
+            else:
+                if attempt == self.CDN_RETRIES:
+                    response.raise_for_status()
+            time.sleep(get_retry_delay(attempt))
+
+    def get_stored_key(self, kind: str, id: str) -> str | None:
+        if self.key_store is None:
+            return None
+        return self.key_store.get(kind, id)
+
+    def set_stored_key(self, kind: str, id: str, value: str):
+        if self.key_store is not None:
+            self.key_store.set(kind, id, value)
+
     def set_cdm(self) -> None:
         if self.wvd_path:
             self.cdm = Cdm.from_device(Device.load(self.wvd_path))
@@ -121,6 +214,67 @@ class Downloader:
             )
         return download_queue
 
+    def get_playlist_delta(self, playlist_id: str, scope: str = "") -> PlaylistDelta:
+        previous_snapshot = (
+            self.library_manifest.get_playlist(playlist_id, scope)
+            if self.library_manifest is not None
+            else None
+        )
+        playlist = self.spotify_api.get_playlist(
+            playlist_id,
+            extend=False,
+            etag=previous_snapshot.etag if previous_snapshot is not None else None,
+        )
+        if playlist is None:
+            return PlaylistDelta(
+                name=previous_snapshot.name,
+                snapshot=previous_snapshot,
+                download_queue=[],
+                unchanged=True,
+            )
+        snapshot = PlaylistSnapshot(
+            playlist_id=playlist_id,
+            scope=scope,
+            snapshot_id=playlist.get("snapshot_id"),
+            name=playlist["name"],
+            etag=playlist.get("etag"),
+        )
+        if (
+            previous_snapshot is not None
+            and snapshot.snapshot_id is not None
+            and previous_snapshot.snapshot_id == snapshot.snapshot_id
+        ):
+            snapshot.track_ids = previous_snapshot.track_ids
+            return PlaylistDelta(
+                name=snapshot.name,
+                snapshot=snapshot,
+                download_queue=[],
+                unchanged=True,
+            )
+        tracks = [
+            track_metadata["track"]
+            for track_metadata in self.spotify_api.extend_track_collection(playlist)[
+                "tracks"
+            ]["items"]
+        ]
+        snapshot.track_ids = [track["id"] for track in tracks]
+        previous_track_ids = (
+            set(previous_snapshot.track_ids) if previous_snapshot is not None else set()
+        )
+        return PlaylistDelta(
+            name=snapshot.name,
+            snapshot=snapshot,
+            download_queue=[
+                DownloadQueueItem(metadata=track)
+                for track in tracks
+                if track["id"] not in previous_track_ids
+            ],
+        )
+
+    def set_playlist_snapshot(self, snapshot: PlaylistSnapshot):
+        if self.library_manifest is not None and snapshot.snapshot_id is not None:
+            self.library_manifest.set_playlist(snapshot)
+
     def get_sanitized_string(self, dirty_string: str, is_folder: bool) -> str:
         dirty_string = re.sub(self.ILLEGAL_CHARACTERS_REGEX, "_", dirty_string)
         if is_folder:
@@ -166,32 +320,34 @@ class Downloader:
         )
 
     def get_cover_url(self, metadata_gid: dict, size: str) -> str:
-        return "https://i.scdn.co/image/" + next(
-            i["file_id"]
-            for i in metadata_gid["album"]["cover_group"]["image"]
-            if i["size"] == size
+        return self.COVER_URL.format(
+            file_id=next(
+                i["file_id"]
+                for i in metadata_gid["album"]["cover_group"]["image"]
+                if i["size"] == size
+            )
         )
 
     def get_encrypted_path(
         self,
-        track_id: str,
+        temp_id: str,
         file_extension: str,
     ) -> Path:
-        return self.temp_path / (f"{track_id}_encrypted" + file_extension)
+        return self.temp_path / (f"{temp_id}_encrypted" + file_extension)
 
     def get_decrypted_path(
         self,
-        track_id: str,
+        temp_id: str,
         file_extension: str,
     ) -> Path:
-        return self.temp_path / (f"{track_id}_decrypted" + file_extension)
+        return self.temp_path / (f"{temp_id}_decrypted" + file_extension)
 
     def get_remuxed_path(
         self,
-        track_id: str,
+        temp_id: str,
         file_extension: str,
     ) -> Path:
-        return self.temp_path / (f"{track_id}_remuxed" + file_extension)
+        return self.temp_path / (f"{temp_id}_remuxed" + file_extension)
 
     def decrypt_mp4decrypt(
         self,
@@ -211,12 +367,25 @@ class Downloader:
             **self.subprocess_additional_args,
         )
 
-    @staticmethod
-    @functools.lru_cache()
-    def get_image_bytes(url: str) -> bytes:
-        return requests.get(url).content
+    def decrypt_native(
+        self,
+        encrypted_path: Path,
+        decrypted_path: Path,
+        decryption_key: str,
+        ilst: bytes = None,
+    ):
+        with encrypted_path.open("rb") as encrypted_file, decrypted_path.open(
+            "wb"
+        ) as decrypted_file:
+            Mp4Remuxer(decryption_key, ilst).remux(encrypted_file, decrypted_file)
 
-    def apply_tags(self, fixed_location: Path, tags: dict, cover_url: str):
+    def get_image_bytes(self, url: str) -> bytes:
+        return self.cover_cache.get(url)
+
+    def prefetch_cover(self, url: str):
+        self.cover_cache.prefetch(url)
+
+    def get_mp4_tags(self, tags: dict, cover_url: str) -> dict:
         to_apply_tags = [
             tag_name
             for tag_name in tags.keys()
@@ -259,18 +428,45 @@ class Downloader:
                     self.get_image_bytes(cover_url), imageformat=MP4Cover.FORMAT_JPEG
                 )
             ]
+        return mp4_tags
+
+    @classmethod
+    def get_ilst(cls, mp4_tags: dict) -> bytes:
+        # Let mutagen tag an empty file and take the ilst it wrote
+        scratch_file = io.BytesIO(cls.ILST_SCRATCH_MP4)
+        mp4 = MP4(scratch_file)
+        mp4.add_tags()
+        mp4.update(mp4_tags)
+        mp4.save(scratch_file)
+        scratch = scratch_file.getvalue()
+        start, end = 0, len(scratch)
+        for box_type in (b"moov", b"udta", b"meta", b"ilst"):
+            offset, header_size, size = Mp4Remuxer.find_box(
+                scratch, start, end, box_type
+            )
+            # meta is a full box
+            start = offset + header_size + (4 if box_type == b"meta" else 0)
+            end = offset + size
+        return scratch[offset:end]
+
+    def apply_tags(self, fixed_location: Path, tags: dict, cover_url: str):
         mp4 = MP4(fixed_location)
         mp4.clear()
-        mp4.update(mp4_tags)
+        mp4.update(self.get_mp4_tags(tags, cover_url))
         mp4.save()
 
     def move_to_final_path(self, fixed_path: Path, final_path: Path):
         final_path.parent.mkdir(parents=True, exist_ok=True)
         shutil.move(fixed_path, final_path)
 
-    @functools.lru_cache()
     def save_cover(self, cover_path: Path, cover_url: str):
         cover_path.write_bytes(self.get_image_bytes(cover_url))
 
     def cleanup_temp_path(self):
         shutil.rmtree(self.temp_path)
+
+    def cleanup_temp_files(self, temp_id: str):
+        if not self.temp_path.exists():
+            return
+        for temp_file in self.temp_path.glob(f"{temp_id}_*"):
+            temp_file.unlink(missing_ok=True)
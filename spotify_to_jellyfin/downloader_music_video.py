@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from pywidevine import PSSH
@@ -17,6 +18,7 @@ class DownloaderMusicVideo:
 #EXT-X-PLAYLIST-TYPE:VOD
 #EXT-X-MEDIA-SEQUENCE:0
 #EXT-X-TARGETDURATION:1"""
+    SEGMENT_WORKERS = 8
 
     def __init__(
         self,
@@ -111,11 +113,21 @@ class DownloaderMusicVideo:
         )
 
     def get_decryption_key(self, pssh: str) -> str:
+        decryption_key = self.downloader.get_stored_key("video", pssh)
+        if decryption_key is None:
+            decryption_key = self.get_decryption_key_from_license(pssh)
+            self.downloader.set_stored_key("video", pssh, decryption_key)
+        return decryption_key
+
+    def get_decryption_key_from_license(self, pssh: str) -> str:
         try:
             pssh = PSSH(pssh)
             cdm_session = self.downloader.cdm.open()
             challenge = self.downloader.cdm.get_license_challenge(cdm_session, pssh)
-            license = self.downloader.spotify_api.get_widevine_license_video(challenge)
+            with self.downloader.metrics.time("spotifin_step_seconds", step="license"):
+                license = self.downloader.spotify_api.get_widevine_license_video(
+                    challenge
+                )
             self.downloader.cdm.parse_license(cdm_session, license)
             decryption_key = next(
                 i
@@ -126,8 +138,8 @@ class DownloaderMusicVideo:
             self.downloader.cdm.close(cdm_session)
         return decryption_key
 
-    def get_m3u8_path(self, track_id: str, type: str) -> Path:
-        return self.downloader.temp_path / f"{track_id}_{type}.m3u8"
+    def get_m3u8_path(self, temp_id: str, type: str) -> Path:
+        return self.downloader.temp_path / f"{temp_id}_{type}.m3u8"
 
     def get_cover_path(self, final_path: Path) -> Path:
         return final_path.with_suffix(".jpg")
@@ -254,6 +266,59 @@ class DownloaderMusicVideo:
         elif self.download_mode == DownloadModeVideo.NM3U8DLRE:
             self.download_nm3u8dlre(m3u8_path, encrypted_path)
 
+    def download_native(
+        self,
+        segment_urls_video: list[str],
+        encrypted_path_video: Path,
+        segment_urls_audio: list[str],
+        encrypted_path_audio: Path,
+    ) -> None:
+        with ThreadPoolExecutor(self.SEGMENT_WORKERS) as segment_executor:
+            with ThreadPoolExecutor(2) as rendition_executor:
+                renditions = [
+                    rendition_executor.submit(
+                        self.download_segments,
+                        segment_executor,
+                        segment_urls,
+                        encrypted_path,
+                    )
+                    for segment_urls, encrypted_path in (
+                        (segment_urls_video, encrypted_path_video),
+                        (segment_urls_audio, encrypted_path_audio),
+                    )
+                ]
+                for rendition in renditions:
+                    rendition.result()
+
+    def download_segments(
+        self,
+        executor: ThreadPoolExecutor,
+        segment_urls: list[str],
+        encrypted_path: Path,
+    ) -> None:
+        encrypted_path.parent.mkdir(parents=True, exist_ok=True)
+        window = self.SEGMENT_WORKERS * 2
+        segments = [
+            executor.submit(self.downloader.get_cdn_content, segment_url)
+            for segment_url in segment_urls[:window]
+        ]
+        try:
+            with encrypted_path.open("wb") as file:
+                for index in range(len(segment_urls)):
+                    if index + window < len(segment_urls):
+                        segments.append(
+                            executor.submit(
+                                self.downloader.get_cdn_content,
+                                segment_urls[index + window],
+                            )
+                        )
+                    file.write(segments[index].result())
+                    segments[index] = None
+        finally:
+            for segment in segments:
+                if segment is not None:
+                    segment.cancel()
+
     def download_ytdlp(self, m3u8_path: Path, encrypted_path: Path) -> None:
         with YoutubeDL(
             {
@@ -324,32 +389,55 @@ class DownloaderMusicVideo:
                 decrypted_path_audio,
                 remuxed_path,
             )
+        elif self.downloader.remux_mode == RemuxMode.NATIVE:
+            if not self.downloader.ffmpeg_path_full:
+                raise Exception("ffmpeg is required to remux music videos")
+            self.downloader.decrypt_native(
+                encrypted_path_video,
+                decrypted_path_video,
+                decryption_key,
+            )
+            self.downloader.decrypt_native(
+                encrypted_path_audio,
+                decrypted_path_audio,
+                decryption_key,
+            )
+            # moov stays at the end so tagging only rewrites the tail of the file
+            self.remux_ffmpeg(
+                None,
+                decrypted_path_video,
+                decrypted_path_audio,
+                remuxed_path,
+                False,
+            )
 
     def remux_ffmpeg(
         self,
-        decryption_key: str,
+        decryption_key: str | None,
         encrypted_path_video: Path,
         encrypted_path_audio: Path,
         remuxed_path: Path,
+        faststart: bool = True,
     ) -> None:
+        decryption_args = (
+            ["-decryption_key", decryption_key] if decryption_key is not None else []
+        )
+        faststart_args = ["-movflags", "+faststart"] if faststart else []
         subprocess.run(
             [
                 self.downloader.ffmpeg_path_full,
                 "-loglevel",
                 "error",
                 "-y",
-                "-decryption_key",
-                decryption_key,
+                *decryption_args,
                 "-i",
                 encrypted_path_video,
-                "-decryption_key",
-                decryption_key,
+                *decryption_args,
                 "-i",
                 encrypted_path_audio,
                 "-c",
                 "copy",
-                "-movflags",
-                "+faststart",
+                *faststart_args,
                 remuxed_path,
             ],
             check=True,
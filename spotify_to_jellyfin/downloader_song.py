@@ -1,21 +1,38 @@
+from __future__ import annotations
+
 import datetime
 import re
+import shutil
 import subprocess
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from pathlib import Path
 
+import requests
 import syncedlyrics
+import urllib3
 
 from pywidevine import PSSH
 from yt_dlp import YoutubeDL
 
 from .downloader import Downloader
+from .metadata_cache import MetadataCache
 from .enums import DownloadModeSong, RemuxMode
-from .models import Lyrics
+from .models import DownloadStats, Lyrics
+from .mp4 import Mp4Remuxer
+from .rate_limiter import get_retry_delay
 
 TIMESTAMP_REGEX = r'\[\d{2}:\d{2}\.\d+\] '
 
 
 class DownloaderSong:
+    RANGE_SIZE = 1024 * 1024
+    RANGE_WORKERS = 4
+    THIRD_PARTY_LYRICS_PROVIDERS = ("musixmatch", "lrclib", "netease", "genius")
+    THIRD_PARTY_LYRICS_TIMEOUT = 15
+    THIRD_PARTY_LYRICS_POLL_INTERVAL = 0.5
+
     def __init__(
         self,
         downloader: Downloader,
@@ -25,6 +42,7 @@ class DownloaderSong:
         template_file_multi_disc: str = "{disc}-{track:02d} {title}",
         download_mode: DownloadModeSong = DownloadModeSong.YTDLP,
         premium_quality: bool = False,
+        lyrics_search_workers: int = 4,
     ):
         self.downloader = downloader
         self.template_folder_album = template_folder_album
@@ -33,11 +51,18 @@ class DownloaderSong:
         self.template_file_multi_disc = template_file_multi_disc
         self.download_mode = download_mode
         self.premium_quality = premium_quality
+        self.lyrics_search_workers = lyrics_search_workers
         self._set_codec()
+        self._set_lyrics_executor()
 
     def _set_codec(self):
         self.codec = "MP4_256" if self.premium_quality else "MP4_128"
 
+    def _set_lyrics_executor(self):
+        self.lyrics_executor = ThreadPoolExecutor(
+            len(self.THIRD_PARTY_LYRICS_PROVIDERS) * max(self.lyrics_search_workers, 1)
+        )
+
     def get_final_path(self, tags: dict) -> Path:
         final_path_folder = (
             self.template_folder_compilation.split("/")
@@ -71,7 +96,10 @@ class DownloaderSong:
             pssh = PSSH(pssh)
             cdm_session = self.downloader.cdm.open()
             challenge = self.downloader.cdm.get_license_challenge(cdm_session, pssh)
-            license = self.downloader.spotify_api.get_widevine_license_music(challenge)
+            with self.downloader.metrics.time("spotifin_step_seconds", step="license"):
+                license = self.downloader.spotify_api.get_widevine_license_music(
+                    challenge
+                )
             self.downloader.cdm.parse_license(cdm_session, license)
             decryption_key = next(
                 i
@@ -82,6 +110,21 @@ class DownloaderSong:
             self.downloader.cdm.close(cdm_session)
         return decryption_key
 
+    def get_pssh(self, file_id: str) -> str:
+        pssh = self.downloader.get_stored_key("pssh", file_id)
+        if pssh is None:
+            with self.downloader.metrics.time("spotifin_step_seconds", step="pssh"):
+                pssh = self.downloader.spotify_api.get_pssh(file_id)
+            self.downloader.set_stored_key("pssh", file_id, pssh)
+        return pssh
+
+    def get_decryption_key_from_file_id(self, file_id: str) -> str:
+        decryption_key = self.downloader.get_stored_key("audio", file_id)
+        if decryption_key is None:
+            decryption_key = self.get_decryption_key(self.get_pssh(file_id))
+            self.downloader.set_stored_key("audio", file_id, decryption_key)
+        return decryption_key
+
     def get_file_id(self, metadata_gid: dict) -> str:
         audio_files = metadata_gid.get("file")
         if audio_files is None:
@@ -149,11 +192,163 @@ class DownloaderSong:
         }
         return tags
 
-    def download(self, encrypted_path: Path, stream_url: str):
+    def download(self, encrypted_path: Path, stream_url: str) -> DownloadStats:
+        if self.download_mode == DownloadModeSong.NATIVE:
+            return self.download_native(encrypted_path, stream_url)
+        start_time = time.perf_counter()
         if self.download_mode == DownloadModeSong.YTDLP:
             self.download_ytdlp(encrypted_path, stream_url)
         elif self.download_mode == DownloadModeSong.ARIA2C:
             self.download_aria2c(encrypted_path, stream_url)
+        return DownloadStats(
+            encrypted_path.stat().st_size, time.perf_counter() - start_time
+        )
+
+    def download_stream(
+        self,
+        remuxed_path: Path,
+        stream_url: str,
+        decryption_key: str,
+        ilst: bytes = None,
+    ) -> DownloadStats:
+        start_time = time.perf_counter()
+        remuxed_path.parent.mkdir(parents=True, exist_ok=True)
+        for attempt in range(self.downloader.CDN_RETRIES + 1):
+            try:
+                with self.downloader.cdn_session.get(
+                    stream_url,
+                    stream=True,
+                    timeout=self.downloader.CDN_TIMEOUT,
+                ) as response:
+                    response.raise_for_status()
+                    response.raw.decode_content = True
+                    self.remux_stream(
+                        response.raw, remuxed_path, decryption_key, ilst
+                    )
+                    # Bytes read off the wire, not the size of the remuxed file
+                    size = response.raw.tell()
+                break
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                urllib3.exceptions.HTTPError,
+            ):
+                if attempt == self.downloader.CDN_RETRIES:
+                    raise
+                time.sleep(get_retry_delay(attempt))
+        return DownloadStats(size, time.perf_counter() - start_time)
+
+    def remux_stream(
+        self,
+        input_file,
+        remuxed_path: Path,
+        decryption_key: str,
+        ilst: bytes = None,
+    ):
+        if self.downloader.remux_mode == RemuxMode.NATIVE:
+            with remuxed_path.open("wb") as remuxed_file:
+                Mp4Remuxer(decryption_key, ilst).remux(input_file, remuxed_file)
+        elif self.downloader.remux_mode == RemuxMode.FFMPEG:
+            self.remux_ffmpeg_stream(input_file, remuxed_path, decryption_key)
+        else:
+            raise Exception(
+                f"Remux mode {self.downloader.remux_mode.value} does not support streaming"
+            )
+
+    def remux_ffmpeg_stream(
+        self,
+        input_file,
+        remuxed_path: Path,
+        decryption_key: str,
+    ) -> None:
+        process = subprocess.Popen(
+            [
+                self.downloader.ffmpeg_path_full,
+                "-loglevel",
+                "error",
+                "-y",
+                "-decryption_key",
+                decryption_key,
+                "-i",
+                "pipe:0",
+                "-c",
+                "copy",
+                "-f",
+                "mp4",
+                remuxed_path,
+            ],
+            stdin=subprocess.PIPE,
+            **self.downloader.subprocess_additional_args,
+        )
+        try:
+            shutil.copyfileobj(input_file, process.stdin)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    @staticmethod
+    def get_range_header(start: int, end: int) -> dict:
+        return {"Range": f"bytes={start}-{end - 1}"}
+
+    def download_native(self, encrypted_path: Path, stream_url: str) -> DownloadStats:
+        start_time = time.perf_counter()
+        encrypted_path.parent.mkdir(parents=True, exist_ok=True)
+        response = self.downloader.get_cdn_response(
+            stream_url, self.get_range_header(0, self.RANGE_SIZE)
+        )
+        if response.status_code != 206:
+            encrypted_path.write_bytes(response.content)
+            return DownloadStats(
+                len(response.content), time.perf_counter() - start_time
+            )
+        size = int(response.headers["Content-Range"].rsplit("/", 1)[1])
+        ranges = [
+            (start, min(start + self.RANGE_SIZE, size))
+            for start in range(len(response.content), size, self.RANGE_SIZE)
+        ]
+        lock = threading.Lock()
+        with encrypted_path.open("wb") as file:
+            file.truncate(size)
+            file.write(response.content)
+            with ThreadPoolExecutor(self.RANGE_WORKERS) as executor:
+                for _ in executor.map(
+                    lambda range_: self._download_range(
+                        file, lock, stream_url, *range_
+                    ),
+                    ranges,
+                ):
+                    pass
+        return DownloadStats(
+            size,
+            time.perf_counter() - start_time,
+            min(self.RANGE_WORKERS, len(ranges)) or 1,
+        )
+
+    def _download_range(
+        self,
+        file,
+        lock: threading.Lock,
+        stream_url: str,
+        start: int,
+        end: int,
+    ):
+        content = self.downloader.get_cdn_content(
+            stream_url, self.get_range_header(start, end)
+        )
+        if len(content) != end - start:
+            raise Exception(
+                f"Expected {end - start} bytes for range {start}-{end}, "
+                f"got {len(content)}"
+            )
+        with lock:
+            file.seek(start)
+            file.write(content)
 
     def download_ytdlp(self, encrypted_path: Path, stream_url: str) -> None:
         with YoutubeDL(
@@ -194,6 +389,7 @@ class DownloaderSong:
         decrypted_path: Path,
         remuxed_path: Path,
         decryption_key: str,
+        ilst: bytes = None,
     ):
         if self.downloader.remux_mode == RemuxMode.FFMPEG:
             self.remux_ffmpeg(decryption_key, encrypted_path, remuxed_path)
@@ -202,6 +398,10 @@ class DownloaderSong:
                 encrypted_path, decrypted_path, decryption_key
             )
             self.remux_mp4box(decrypted_path, remuxed_path)
+        elif self.downloader.remux_mode == RemuxMode.NATIVE:
+            self.downloader.decrypt_native(
+                encrypted_path, remuxed_path, decryption_key, ilst
+            )
 
     def remux_mp4box(self, decrypted_path: Path, remuxed_path: Path):
         subprocess.run(
@@ -266,14 +466,97 @@ class DownloaderSong:
         lyrics.unsynced = lyrics.unsynced[:-1]
         return lyrics
 
-    def get_third_party_lyrics(self, title: str, artist: str) -> Lyrics:
+    @staticmethod
+    def is_synced_lyrics_string(lyrics_string: str) -> bool:
+        lines_sample = lyrics_string.split('\n')[5:10]
+        return all(re.match(TIMESTAMP_REGEX, line) for line in lines_sample)
+
+    @staticmethod
+    def _search_third_party_provider(
+        query: str, provider: str, start_times: dict[str, float]
+    ) -> str | None:
+        start_times[provider] = time.monotonic()
+        return syncedlyrics.search(query, providers=[provider])
+
+    def search_third_party_lyrics(self, query: str) -> tuple[str | None, bool]:
+        start_times = {}
+        futures = {
+            self.lyrics_executor.submit(
+                self._search_third_party_provider, query, provider, start_times
+            ): provider
+            for provider in self.THIRD_PARTY_LYRICS_PROVIDERS
+        }
+        pending = set(futures)
+        results = {}
+        is_complete = True
+        try:
+            while pending:
+                # Each provider gets the full timeout from when it actually starts
+                now = time.monotonic()
+                deadlines = {
+                    future: (
+                        start_times[futures[future]] + self.THIRD_PARTY_LYRICS_TIMEOUT
+                        if futures[future] in start_times
+                        else now + self.THIRD_PARTY_LYRICS_POLL_INTERVAL
+                    )
+                    for future in pending
+                }
+                expired = {
+                    future for future, deadline in deadlines.items() if deadline <= now
+                }
+                if expired:
+                    is_complete = False
+                    pending -= expired
+                    continue
+                done, pending = wait(
+                    pending, min(deadlines.values()) - now, FIRST_COMPLETED
+                )
+                for future in done:
+                    try:
+                        lyrics_string = future.result()
+                    except Exception:
+                        is_complete = False
+                        continue
+                    if lyrics_string is None:
+                        continue
+                    if self.is_synced_lyrics_string(lyrics_string):
+                        return lyrics_string, True
+                    results[futures[future]] = lyrics_string
+        finally:
+            for future in futures:
+                future.cancel()
+        lyrics_string = next(
+            (
+                results[provider]
+                for provider in self.THIRD_PARTY_LYRICS_PROVIDERS
+                if provider in results
+            ),
+            None,
+        )
+        return lyrics_string, is_complete
+
+    def get_third_party_lyrics(self, title: str, artist: str, isrc: str = None) -> Lyrics:
         query = f"{artist} - {title}"[:50]
+        cache = self.downloader.spotify_api.cache
+        cache_key = isrc or query.lower()
+        lyrics_string = (
+            cache.get("third_party_lyrics", cache_key)
+            if cache is not None
+            else MetadataCache.MISSING
+        )
+        if lyrics_string is MetadataCache.MISSING:
+            lyrics_string, is_complete = self.search_third_party_lyrics(query)
+            if cache is not None and is_complete:
+                cache.set(
+                    "third_party_lyrics",
+                    cache_key,
+                    lyrics_string,
+                    lyrics_string is None,
+                )
         lyrics = Lyrics()
-        lyrics_string = syncedlyrics.search(query, providers=["musixmatch", "lrclib", "netease", "genius"])
         if lyrics_string is None:
             return lyrics
-        lines_sample = lyrics_string.split('\n')[5:10]
-        if all(re.match(TIMESTAMP_REGEX, line) for line in lines_sample):
+        if self.is_synced_lyrics_string(lyrics_string):
             lyrics.synced = lyrics_string
             lyrics.unsynced = re.sub(TIMESTAMP_REGEX, '', lyrics_string)
         else:
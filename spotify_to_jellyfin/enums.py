@@ -4,13 +4,17 @@ from enum import Enum
 class RemuxMode(Enum):
     FFMPEG = "ffmpeg"
     MP4BOX = "mp4box"
+    NATIVE = "native"
 
 
 class DownloadModeSong(Enum):
     YTDLP = "ytdlp"
     ARIA2C = "aria2c"
+    NATIVE = "native"
+    STREAM = "stream"
 
 
 class DownloadModeVideo(Enum):
     YTDLP = "ytdlp"
     NM3U8DLRE = "nm3u8dlre"
+    NATIVE = "native"
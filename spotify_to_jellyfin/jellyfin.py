@@ -1,18 +1,42 @@
+from __future__ import annotations
+
 import os
+import bisect
 import json
 import requests
+import threading
 import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from .metrics import Metrics
 
 
 class JellyfinApi:
-    def __init__(self, base_url: str, api_token: str):
+    INDEX_PAGE_SIZE = 1000
+    INDEX_UPDATE_MARGIN = timedelta(minutes=1)
+    PLAYLIST_CHUNK_SIZE = 200
+
+    def __init__(
+        self,
+        base_url: str,
+        api_token: str,
+        index_path: Path = None,
+        metrics: Metrics = None,
+    ):
         self.auth = {"Authorization": f'MediaBrowser Token="{api_token}"'}
         self.base_url = base_url
+        self.index_path = index_path
+        self.metrics = metrics or Metrics()
+        self._index_lock = threading.Lock()
+        self._setup_session()
+        self._load_index()
         if not os.path.exists("./config/users.json"):
             print(
                 "[Jellyfin API] No users.json found, creating one. Remember to fill in the discord ids."
             )
-            jellyfin_users = requests.get(f"{base_url}/Users", headers=self.auth).json()
+            jellyfin_users = self.session.get(f"{base_url}/Users", headers=self.auth).json()
             self.users = []
             for user in jellyfin_users:
                 self.users.append(
@@ -28,26 +52,111 @@ class JellyfinApi:
             with open("./config/users.json", "r") as f:
                 self.users = json.load(f)
 
+    def _setup_session(self):
+        self.session = requests.Session()
+        self.session.hooks["response"].append(
+            self.metrics.get_response_hook("jellyfin", self.get_endpoint)
+        )
+
+    def get_endpoint(self, url: str) -> str:
+        if url.startswith(self.base_url):
+            url = url[len(self.base_url) :]
+        return self.metrics.get_url_path_endpoint(url)
+
     def lookup_jellyfin_userid(self, discord_id: int) -> str:
         assert discord_id is not None, "Valid discord id required"
+        for user in self.users:
+            if user["discord_id"] == discord_id:
+                return user["jellyfin_id"]
+        # users.json may have been edited since startup
+        with open("./config/users.json", "r") as f:
+            self.users = json.load(f)
         for user in self.users:
             if user["discord_id"] == discord_id:
                 return user["jellyfin_id"]
         raise ValueError("User not found in users.json")
 
+    @staticmethod
+    def get_index_key(path: str) -> str:
+        return "/".join(path.replace("\\", "/").rsplit("/", maxsplit=3)[1:])
+
+    def _load_index(self):
+        self.path_index = {}
+        self.index_updated_at = None
+        if self.index_path is None or not self.index_path.exists():
+            return
+        try:
+            index = json.loads(self.index_path.read_text())
+        except ValueError:
+            return
+        if index.get("base_url") != self.base_url:
+            return
+        self.path_index = index["items"]
+        self.index_updated_at = index["updated_at"]
+
+    def _save_index(self):
+        if self.index_path is None:
+            return
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        self.index_path.write_text(
+            json.dumps(
+                {
+                    "base_url": self.base_url,
+                    "updated_at": self.index_updated_at,
+                    "items": self.path_index,
+                }
+            )
+        )
+
+    def update_index(self, full: bool = False) -> None:
+        with self._index_lock:
+            if full:
+                self.path_index = {}
+                self.index_updated_at = None
+            updated_at = (
+                datetime.now(timezone.utc) - self.INDEX_UPDATE_MARGIN
+            ).strftime("%Y-%m-%dT%H:%M:%SZ")
+            params = {
+                "IncludeItemTypes": "Audio",
+                "Recursive": "true",
+                "Fields": "Path,DateLastSaved",
+                "EnableImages": "false",
+                "EnableUserData": "false",
+                "Limit": self.INDEX_PAGE_SIZE,
+            }
+            if self.index_updated_at:
+                params["MinDateLastSaved"] = self.index_updated_at
+            start_index = 0
+            while True:
+                response = self.session.get(
+                    f"{self.base_url}/Items",
+                    headers=self.auth,
+                    params={**params, "StartIndex": start_index},
+                )
+                response.raise_for_status()
+                items = response.json()["Items"]
+                for item in items:
+                    if item.get("Path"):
+                        self.path_index[self.get_index_key(item["Path"])] = item["Id"]
+                start_index += len(items)
+                if len(items) < self.INDEX_PAGE_SIZE:
+                    break
+            self.index_updated_at = updated_at
+            self._save_index()
+
+    def lookup_song_ids(self, paths: list[str]) -> list[str]:
+        keys = [self.get_index_key(path) for path in paths]
+        if any(key not in self.path_index for key in keys):
+            self.update_index()
+        song_ids = []
+        for path, key in zip(paths, keys):
+            if key not in self.path_index:
+                raise ValueError(f"Couldn't find song in Jellyfin: {path}")
+            song_ids.append(self.path_index[key])
+        return song_ids
+
     def lookup_song_id(self, path: str) -> str:
-        relative_path = path.rsplit("/", maxsplit=3)[1:]
-        title = " ".join(relative_path[2][:-4].split(" ")[1:])
-        searchTerm = longest_ascii_substring(title)
-        search_res = requests.get(
-                f"{self.base_url}/Items?searchTerm={searchTerm}&includeItemTypes=Audio&Recursive=true&fields=Path",
-                headers=self.auth,
-            ).json()["Items"]
-        for song in search_res:
-            relative_song_path = song["Path"].rsplit("/", maxsplit=3)[1:]
-            if relative_path == relative_song_path:
-                return song["Id"]
-        raise ValueError(f"Couldn't find song in Jellyfin: {title}")
+        return self.lookup_song_ids([path])[0]
 
     def create_playlist(
         self,
@@ -58,7 +167,7 @@ class JellyfinApi:
     ):
         body = {
             "Name": playlist_name,
-            "Ids": songs,
+            "Ids": songs[: self.PLAYLIST_CHUNK_SIZE],
             "UserId": jellyfin_id,
             "MediaType": "Audio",
             # Works but currently not implemented
@@ -68,48 +177,170 @@ class JellyfinApi:
             # ],
             "IsPublic": public,
         }
-        response = requests.post(
+        response = self.session.post(
             f"{self.base_url}/Playlists", headers=self.auth, json=body
         ).json()
+        self.add_playlist_items(
+            response["Id"], songs[self.PLAYLIST_CHUNK_SIZE :], jellyfin_id
+        )
         return response["Id"]
 
-    def update_playlist(
-        self,
-        playlist_id: str,
-        playlist_name: str,
-        songs: list[str],
-        public: bool = False,
-    ) -> None:
-        raise Exception(
-            "Updating existing playlists is not supported because of jellyfin bug #12092"
+    def get_playlist_entries(
+        self, playlist_id: str, jellyfin_id: str
+    ) -> list[tuple[str, str]] | None:
+        response = self.session.get(
+            f"{self.base_url}/Playlists/{playlist_id}/Items",
+            headers=self.auth,
+            params={
+                "UserId": jellyfin_id,
+                "EnableImages": "false",
+                "EnableUserData": "false",
+            },
         )
-        body = {
-            "Name": playlist_name,
-            "Ids": songs,
-            "IsPublic": public,
-        }
-        response = requests.post(
-            f"{self.base_url}/Playlists/{playlist_id}",
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        return [(item["PlaylistItemId"], item["Id"]) for item in response.json()["Items"]]
+
+    def add_playlist_items(
+        self, playlist_id: str, songs: list[str], jellyfin_id: str
+    ) -> None:
+        for i in range(0, len(songs), self.PLAYLIST_CHUNK_SIZE):
+            response = self.session.post(
+                f"{self.base_url}/Playlists/{playlist_id}/Items",
+                headers=self.auth,
+                params={
+                    "Ids": ",".join(songs[i : i + self.PLAYLIST_CHUNK_SIZE]),
+                    "UserId": jellyfin_id,
+                },
+            )
+            response.raise_for_status()
+
+    def remove_playlist_entries(self, playlist_id: str, entry_ids: list[str]) -> None:
+        for i in range(0, len(entry_ids), self.PLAYLIST_CHUNK_SIZE):
+            response = self.session.delete(
+                f"{self.base_url}/Playlists/{playlist_id}/Items",
+                headers=self.auth,
+                params={
+                    "EntryIds": ",".join(entry_ids[i : i + self.PLAYLIST_CHUNK_SIZE])
+                },
+            )
+            response.raise_for_status()
+
+    def move_playlist_entry(self, playlist_id: str, entry_id: str, index: int) -> None:
+        response = self.session.post(
+            f"{self.base_url}/Playlists/{playlist_id}/Items/{entry_id}/Move/{index}",
             headers=self.auth,
-            json=body,
         )
-        assert response.status_code == 204, "Failed to update playlist"
+        response.raise_for_status()
 
-    def refresh_library(self) -> None:
-        requests.post(f"{self.base_url}/Library/Refresh", headers=self.auth)
-        time.sleep(10)
+    @staticmethod
+    def get_playlist_diff(
+        entries: list[tuple[str, str]], songs: list[str]
+    ) -> tuple[list[str], list[str]]:
+        positions = {}
+        for index, song in enumerate(songs):
+            positions.setdefault(song, []).append(index)
+        removed = []
+        for entry_id, song in entries:
+            if positions.get(song):
+                positions[song].pop(0)
+            else:
+                removed.append(entry_id)
+        added_positions = sorted(
+            index for song_positions in positions.values() for index in song_positions
+        )
+        return removed, [songs[index] for index in added_positions]
 
+    @staticmethod
+    def get_playlist_moves(
+        entries: list[tuple[str, str]], songs: list[str]
+    ) -> list[tuple[str, int]]:
+        if Counter(song for _, song in entries) != Counter(songs):
+            return []
+        positions = {}
+        for index, song in enumerate(songs):
+            positions.setdefault(song, []).append(index)
+        order = [positions[song].pop(0) for _, song in entries]
+        # Entries on the longest increasing run of target positions stay put
+        tails = []
+        tails_index = []
+        previous = [None] * len(order)
+        for i, position in enumerate(order):
+            j = bisect.bisect_left(tails, position)
+            previous[i] = tails_index[j - 1] if j else None
+            if j == len(tails):
+                tails.append(position)
+                tails_index.append(i)
+            else:
+                tails[j] = position
+                tails_index[j] = i
+        keep = set()
+        i = tails_index[-1] if tails_index else None
+        while i is not None:
+            keep.add(i)
+            i = previous[i]
+        current = list(range(len(order)))
+        entry_at = {position: i for i, position in enumerate(order)}
+        moves = []
+        for target in range(len(songs)):
+            i = entry_at[target]
+            if i in keep:
+                continue
+            current.remove(i)
+            index = current.index(entry_at[target - 1]) + 1 if target else 0
+            current.insert(index, i)
+            moves.append((entries[i][0], index))
+        return moves
 
-def longest_ascii_substring(s: str) -> str:
-    longest_substring = ""
-    current_substring = ""
+    def update_playlist(
+        self,
+        playlist_id: str,
+        songs: list[str],
+        jellyfin_id: str,
+    ) -> bool:
+        entries = self.get_playlist_entries(playlist_id, jellyfin_id)
+        if entries is None:
+            return False
+        removed, added = self.get_playlist_diff(entries, songs)
+        self.remove_playlist_entries(playlist_id, removed)
+        self.add_playlist_items(playlist_id, added, jellyfin_id)
+        if removed or added:
+            entries = self.get_playlist_entries(playlist_id, jellyfin_id)
+        for entry_id, index in self.get_playlist_moves(entries, songs):
+            self.move_playlist_entry(playlist_id, entry_id, index)
+        return True
 
-    for char in s:
-        if ord(char) < 128:  # ASCII characters have an ordinal value less than 128
-            current_substring += char
-            if len(current_substring) > len(longest_substring):
-                longest_substring = current_substring
-        else:
-            current_substring = ""
+    def ping(self) -> None:
+        response = self.session.get(
+            f"{self.base_url}/System/Ping", headers=self.auth, timeout=10
+        )
+        response.raise_for_status()
+
+    def notify_updated(self, paths: list[str]) -> None:
+        response = self.session.post(
+            f"{self.base_url}/Library/Media/Updated",
+            headers=self.auth,
+            json={
+                "Updates": [
+                    {"Path": path, "UpdateType": "Created"} for path in paths
+                ]
+            },
+        )
+        response.raise_for_status()
 
-    return longest_substring
+    def wait_for_items(
+        self,
+        paths: list[str],
+        timeout: float = 120,
+        interval: float = 2,
+    ) -> bool:
+        keys = [self.get_index_key(path) for path in paths]
+        deadline = time.monotonic() + timeout
+        while True:
+            self.update_index()
+            if all(key in self.path_index for key in keys):
+                return True
+            if time.monotonic() + interval > deadline:
+                return False
+            time.sleep(interval)
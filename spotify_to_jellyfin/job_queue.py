@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .models import QueuedJob
+
+
+class JobQueue:
+    FAIR_ORDER = (
+        "ORDER BY "
+        "(SELECT COUNT(*) FROM jobs r "
+        "WHERE r.discord_id = j.discord_id AND r.status = 'running'), "
+        "(SELECT COUNT(*) FROM jobs q "
+        "WHERE q.discord_id = j.discord_id AND q.status = 'queued' AND q.id < j.id), "
+        "j.id"
+    )
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._setup_database()
+
+    def _setup_database(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "link TEXT NOT NULL, "
+            "dedup_key TEXT NOT NULL, "
+            "discord_id INTEGER NOT NULL, "
+            "public INTEGER NOT NULL, "
+            "status TEXT NOT NULL, "
+            "error TEXT, "
+            "created_at REAL NOT NULL, "
+            "started_at REAL, "
+            "finished_at REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, dedup_key)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS subscribers ("
+            "job_id INTEGER NOT NULL, "
+            "discord_id INTEGER NOT NULL, "
+            "channel_id INTEGER NOT NULL, "
+            "PRIMARY KEY (job_id, discord_id, channel_id))"
+        )
+
+    @staticmethod
+    def get_dedup_key(link: str, discord_id: int, public: bool) -> str:
+        # Playlists are synced to the requesting user's jellyfin account
+        if "/playlist/" in link:
+            return f"{link}:{discord_id}:{int(public)}"
+        return link
+
+    @staticmethod
+    def _to_job(row: tuple) -> QueuedJob:
+        return QueuedJob(
+            id=row[0],
+            link=row[1],
+            discord_id=row[2],
+            public=bool(row[3]),
+            status=row[4],
+            error=row[5],
+        )
+
+    def reset_running(self):
+        with self._lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = 'queued', started_at = NULL "
+                "WHERE status = 'running'"
+            )
+
+    def enqueue(
+        self,
+        link: str,
+        discord_id: int,
+        channel_id: int,
+        public: bool = False,
+    ) -> tuple[QueuedJob, bool]:
+        dedup_key = self.get_dedup_key(link, discord_id, public)
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT id, link, discord_id, public, status, error FROM jobs "
+                    "WHERE dedup_key = ? AND status IN ('queued', 'running')",
+                    (dedup_key,),
+                ).fetchone()
+                is_new = row is None
+                if is_new:
+                    job_id = self.connection.execute(
+                        "INSERT INTO jobs "
+                        "(link, dedup_key, discord_id, public, status, created_at) "
+                        "VALUES (?, ?, ?, ?, 'queued', ?)",
+                        (link, dedup_key, discord_id, int(public), time.time()),
+                    ).lastrowid
+                    row = (job_id, link, discord_id, int(public), "queued", None)
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO subscribers "
+                    "(job_id, discord_id, channel_id) VALUES (?, ?, ?)",
+                    (row[0], discord_id, channel_id),
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return self._to_job(row), is_new
+
+    def claim(self) -> QueuedJob | None:
+        with self._lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute(
+                    "SELECT id, link, discord_id, public, status, error FROM jobs j "
+                    f"WHERE status = 'queued' {self.FAIR_ORDER} LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    self.connection.execute(
+                        "UPDATE jobs SET status = 'running', started_at = ? "
+                        "WHERE id = ?",
+                        (time.time(), row[0]),
+                    )
+                    row = (*row[:4], "running", row[5])
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return self._to_job(row) if row is not None else None
+
+    def complete(self, job_id: int, error: str = None) -> list[tuple[int, int]]:
+        with self._lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                ("failed" if error else "done", error, time.time(), job_id),
+            )
+            return self.connection.execute(
+                "SELECT discord_id, channel_id FROM subscribers WHERE job_id = ?",
+                (job_id,),
+            ).fetchall()
+
+    def get_position(self, job_id: int) -> int | None:
+        with self._lock:
+            queued_ids = [
+                row[0]
+                for row in self.connection.execute(
+                    f"SELECT id FROM jobs j WHERE status = 'queued' {self.FAIR_ORDER}"
+                )
+            ]
+        if job_id not in queued_ids:
+            return None
+        return queued_ids.index(job_id) + 1
+
+    def get_user_jobs(self, discord_id: int) -> list[QueuedJob]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT j.id, j.link, j.discord_id, j.public, j.status, j.error "
+                "FROM jobs j JOIN subscribers s ON s.job_id = j.id "
+                "WHERE s.discord_id = ? AND j.status IN ('queued', 'running') "
+                "GROUP BY j.id ORDER BY j.id",
+                (discord_id,),
+            ).fetchall()
+        return [self._to_job(row) for row in rows]
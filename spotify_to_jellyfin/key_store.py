@@ -0,0 +1,79 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+from pathlib import Path
+
+from Crypto.Cipher import AES
+
+
+class KeyStore:
+    KEY_DERIVATION_SALT = b"spotify-to-jellyfin-key-store"
+    KEY_DERIVATION_ITERATIONS = 100_000
+
+    def __init__(self, path: Path, secret: str):
+        self.path = path
+        self.secret = secret
+        self._lock = threading.Lock()
+        self._set_cipher_key()
+        self._setup_database()
+
+    def _set_cipher_key(self):
+        self.cipher_key = hashlib.pbkdf2_hmac(
+            "sha256",
+            self.secret.encode("utf-8"),
+            self.KEY_DERIVATION_SALT,
+            self.KEY_DERIVATION_ITERATIONS,
+        )
+
+    def _setup_database(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS keys ("
+            "kind TEXT NOT NULL, "
+            "id TEXT NOT NULL, "
+            "nonce BLOB NOT NULL, "
+            "ciphertext BLOB NOT NULL, "
+            "tag BLOB NOT NULL, "
+            "PRIMARY KEY (kind, id))"
+        )
+        self.path.chmod(0o600)
+
+    def _get_cipher(self, kind: str, id: str, nonce: bytes = None):
+        cipher = AES.new(self.cipher_key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(f"{kind}:{id}".encode("utf-8"))
+        return cipher
+
+    def get(self, kind: str, id: str) -> str | None:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT nonce, ciphertext, tag FROM keys WHERE kind = ? AND id = ?",
+                (kind, id),
+            ).fetchone()
+        if row is None:
+            return None
+        nonce, ciphertext, tag = row
+        try:
+            return (
+                self._get_cipher(kind, id, nonce)
+                .decrypt_and_verify(ciphertext, tag)
+                .decode("utf-8")
+            )
+        except ValueError:
+            return None
+
+    def set(self, kind: str, id: str, value: str):
+        cipher = self._get_cipher(kind, id)
+        ciphertext, tag = cipher.encrypt_and_digest(value.encode("utf-8"))
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO keys (kind, id, nonce, ciphertext, tag) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (kind, id, cipher.nonce, ciphertext, tag),
+            )
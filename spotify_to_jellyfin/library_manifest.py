@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from .models import ManifestEntry, PlaylistSnapshot
+
+
+class LibraryManifest:
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._setup_database()
+
+    def _setup_database(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "track_id TEXT NOT NULL, "
+            "kind TEXT NOT NULL, "
+            "path TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "codec TEXT, "
+            "layout_hash TEXT, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (track_id, kind))"
+        )
+        columns = {
+            row[1] for row in self.connection.execute("PRAGMA table_info(tracks)")
+        }
+        if "layout_hash" not in columns:
+            self.connection.execute("ALTER TABLE tracks ADD COLUMN layout_hash TEXT")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS playlists ("
+            "playlist_id TEXT NOT NULL, "
+            "scope TEXT NOT NULL, "
+            "snapshot_id TEXT NOT NULL, "
+            "name TEXT, "
+            "track_ids TEXT NOT NULL, "
+            "etag TEXT, "
+            "updated_at REAL NOT NULL, "
+            "PRIMARY KEY (playlist_id, scope))"
+        )
+
+    @staticmethod
+    def get_layout_hash(layout: dict) -> str:
+        return hashlib.sha256(
+            json.dumps(layout, sort_keys=True, default=str).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, track_id: str, kind: str) -> ManifestEntry | None:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT track_id, kind, path, size, codec, layout_hash FROM tracks "
+                "WHERE track_id = ? AND kind = ?",
+                (track_id, kind),
+            ).fetchone()
+        return ManifestEntry(*row) if row is not None else None
+
+    def set(self, entry: ManifestEntry):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tracks "
+                "(track_id, kind, path, size, codec, layout_hash, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    entry.track_id,
+                    entry.kind,
+                    entry.path,
+                    entry.size,
+                    entry.codec,
+                    entry.layout_hash,
+                    time.time(),
+                ),
+            )
+
+    def remove(self, track_id: str, kind: str):
+        with self._lock:
+            self.connection.execute(
+                "DELETE FROM tracks WHERE track_id = ? AND kind = ?",
+                (track_id, kind),
+            )
+
+    def get_playlist(self, playlist_id: str, scope: str) -> PlaylistSnapshot | None:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT snapshot_id, name, track_ids, etag FROM playlists "
+                "WHERE playlist_id = ? AND scope = ?",
+                (playlist_id, scope),
+            ).fetchone()
+        if row is None:
+            return None
+        return PlaylistSnapshot(
+            playlist_id=playlist_id,
+            scope=scope,
+            snapshot_id=row[0],
+            name=row[1],
+            track_ids=json.loads(row[2]),
+            etag=row[3],
+        )
+
+    def set_playlist(self, snapshot: PlaylistSnapshot):
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO playlists "
+                "(playlist_id, scope, snapshot_id, name, track_ids, etag, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    snapshot.playlist_id,
+                    snapshot.scope,
+                    snapshot.snapshot_id,
+                    snapshot.name,
+                    json.dumps(snapshot.track_ids),
+                    snapshot.etag,
+                    time.time(),
+                ),
+            )
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+
+class MetadataCache:
+    DAY = 24 * 60 * 60
+    TTLS = {
+        "gid_metadata": 7 * DAY,
+        "album": 7 * DAY,
+        "track": 7 * DAY,
+        "track_credits": 30 * DAY,
+        "lyrics": 30 * DAY,
+        "third_party_lyrics": 30 * DAY,
+    }
+    DEFAULT_TTL = DAY
+    NEGATIVE_TTL = DAY
+    EVICTION_RATIO = 0.9
+    MISSING = object()
+
+    def __init__(
+        self,
+        path: Path,
+        max_size: int = 256 * 1024 * 1024,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._setup_database()
+
+    def _setup_database(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "endpoint TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "value TEXT NOT NULL, "
+            "size INTEGER NOT NULL, "
+            "expires_at REAL NOT NULL, "
+            "accessed_at REAL NOT NULL, "
+            "PRIMARY KEY (endpoint, key))"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+        )
+        self.size = self._get_total_size()
+
+    def _get_total_size(self) -> int:
+        return self.connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()[0]
+
+    def get(self, endpoint: str, key: str):
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT value, size, expires_at FROM entries "
+                "WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is None:
+                return self.MISSING
+            value, size, expires_at = row
+            if expires_at < now:
+                self.connection.execute(
+                    "DELETE FROM entries WHERE endpoint = ? AND key = ?",
+                    (endpoint, key),
+                )
+                self.size -= size
+                return self.MISSING
+            self.connection.execute(
+                "UPDATE entries SET accessed_at = ? WHERE endpoint = ? AND key = ?",
+                (now, endpoint, key),
+            )
+        return json.loads(value)
+
+    def set(
+        self,
+        endpoint: str,
+        key: str,
+        value,
+        negative: bool = False,
+        ttl: float = None,
+    ):
+        if ttl is None:
+            ttl = (
+                self.NEGATIVE_TTL
+                if negative
+                else self.TTLS.get(endpoint, self.DEFAULT_TTL)
+            )
+        value_json = json.dumps(value, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT size FROM entries WHERE endpoint = ? AND key = ?",
+                (endpoint, key),
+            ).fetchone()
+            if row is not None:
+                self.size -= row[0]
+            self.connection.execute(
+                "INSERT OR REPLACE INTO entries "
+                "(endpoint, key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, key, value_json, len(value_json), now + ttl, now),
+            )
+            self.size += len(value_json)
+            if self.size > self.max_size:
+                self._evict(now)
+
+    def _evict(self, now: float):
+        self.connection.execute("DELETE FROM entries WHERE expires_at < ?", (now,))
+        self.size = self._get_total_size()
+        target_size = self.max_size * self.EVICTION_RATIO
+        if self.size <= target_size:
+            return
+        cursor = self.connection.execute(
+            "SELECT endpoint, key, size FROM entries ORDER BY accessed_at"
+        )
+        to_delete = []
+        for endpoint, key, size in cursor:
+            if self.size <= target_size:
+                break
+            to_delete.append((endpoint, key))
+            self.size -= size
+        cursor.close()
+        self.connection.executemany(
+            "DELETE FROM entries WHERE endpoint = ? AND key = ?",
+            to_delete,
+        )
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute("DELETE FROM entries")
+            self.size = 0
@@ -0,0 +1,277 @@
+from __future__ import annotations
+
+import bisect
+import contextlib
+import math
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+from urllib.parse import urlsplit
+
+import requests
+
+
+class Metrics:
+    BUCKETS = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+        60,
+        120,
+        300,
+    )
+    METRICS = {
+        "spotifin_tracks_total": (
+            "counter",
+            "Tracks that left the pipeline, by result.",
+        ),
+        "spotifin_requests_total": (
+            "counter",
+            "Requests handled by the bot, by result.",
+        ),
+        "spotifin_stage_seconds": (
+            "histogram",
+            "Time spent per track in each pipeline stage.",
+        ),
+        "spotifin_step_seconds": (
+            "histogram",
+            "Time spent in each step of processing a track or request.",
+        ),
+        "spotifin_download_bytes_total": (
+            "counter",
+            "Bytes of encrypted media downloaded from the CDN.",
+        ),
+        "spotifin_http_responses_total": (
+            "counter",
+            "HTTP responses received, by service, endpoint and status code.",
+        ),
+        "spotifin_http_response_seconds": (
+            "histogram",
+            "Time until the response headers were received, by service and endpoint.",
+        ),
+    }
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_labels_key(labels: dict) -> tuple:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, self.get_labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, self.get_labels_key(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {
+                    "buckets": [0] * (len(self.BUCKETS) + 1),
+                    "sum": 0.0,
+                    "count": 0,
+                    "max": 0.0,
+                }
+            histogram["buckets"][bisect.bisect_left(self.BUCKETS, value)] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+            histogram["max"] = max(histogram["max"], value)
+
+    @contextlib.contextmanager
+    def time(self, name: str, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def get_response_hook(
+        self,
+        service: str,
+        get_endpoint: Callable[[str], str],
+    ) -> Callable:
+        def response_hook(response: requests.Response, *args, **kwargs):
+            endpoint = get_endpoint(response.url)
+            self.inc(
+                "spotifin_http_responses_total",
+                service=service,
+                endpoint=endpoint,
+                status=response.status_code,
+            )
+            self.observe(
+                "spotifin_http_response_seconds",
+                response.elapsed.total_seconds(),
+                service=service,
+                endpoint=endpoint,
+            )
+
+        return response_hook
+
+    @staticmethod
+    def get_url_path_endpoint(url: str) -> str:
+        return "/".join(
+            (
+                "{id}"
+                if re.fullmatch(r"\d+|[0-9a-fA-F]{32}|[0-9a-fA-F-]{36}", segment)
+                else segment
+            )
+            for segment in urlsplit(url).path.split("/")
+        )
+
+    def get_quantile(self, histogram: dict, quantile: float) -> float:
+        rank = histogram["count"] * quantile
+        cumulative_count = 0
+        for bucket_index, bucket_count in enumerate(histogram["buckets"]):
+            cumulative_count += bucket_count
+            if cumulative_count >= rank:
+                break
+        if bucket_index == len(self.BUCKETS):
+            return histogram["max"]
+        return min(self.BUCKETS[bucket_index], histogram["max"])
+
+    @staticmethod
+    def format_labels(labels: tuple) -> str:
+        if not labels:
+            return ""
+        return (
+            "{"
+            + ",".join(
+                '{}="{}"'.format(
+                    name,
+                    value.replace("\\", "\\\\")
+                    .replace('"', '\\"')
+                    .replace("\n", "\\n"),
+                )
+                for name, value in labels
+            )
+            + "}"
+        )
+
+    @staticmethod
+    def format_value(value: float) -> str:
+        if value == math.inf:
+            return "+Inf"
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def _get_snapshot(self) -> tuple[dict, dict]:
+        with self._lock:
+            return dict(self.counters), {
+                key: {**histogram, "buckets": list(histogram["buckets"])}
+                for key, histogram in self.histograms.items()
+            }
+
+    def render(self) -> str:
+        counters, histograms = self._get_snapshot()
+        lines = []
+        for name, (metric_type, description) in self.METRICS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {metric_type}")
+            if metric_type == "counter":
+                for (counter_name, labels), value in sorted(counters.items()):
+                    if counter_name == name:
+                        lines.append(
+                            f"{name}{self.format_labels(labels)} "
+                            f"{self.format_value(value)}"
+                        )
+                continue
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                cumulative_count = 0
+                for upper_bound, bucket_count in zip(
+                    (*self.BUCKETS, math.inf), histogram["buckets"]
+                ):
+                    cumulative_count += bucket_count
+                    bucket_labels = (*labels, ("le", self.format_value(upper_bound)))
+                    lines.append(
+                        f"{name}_bucket{self.format_labels(bucket_labels)} "
+                        f"{cumulative_count}"
+                    )
+                lines.append(
+                    f"{name}_sum{self.format_labels(labels)} "
+                    f"{self.format_value(histogram['sum'])}"
+                )
+                lines.append(
+                    f"{name}_count{self.format_labels(labels)} {histogram['count']}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def get_report(self) -> dict:
+        counters, histograms = self._get_snapshot()
+        report = {
+            "started_at": self.started_at,
+            "elapsed": time.time() - self.started_at,
+            "counters": {},
+            "histograms": {},
+        }
+        for (name, labels), value in sorted(counters.items()):
+            report["counters"].setdefault(name, []).append(
+                {"labels": dict(labels), "value": value}
+            )
+        for (name, labels), histogram in sorted(histograms.items()):
+            report["histograms"].setdefault(name, []).append(
+                {
+                    "labels": dict(labels),
+                    "count": histogram["count"],
+                    "sum": histogram["sum"],
+                    "mean": histogram["sum"] / histogram["count"],
+                    "p50": self.get_quantile(histogram, 0.5),
+                    "p99": self.get_quantile(histogram, 0.99),
+                    "max": histogram["max"],
+                }
+            )
+        return report
+
+
+class MetricsServer:
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self, metrics: Metrics, port: int, host: str = "0.0.0.0"):
+        self.metrics = metrics
+        self.port = port
+        self.host = host
+        self._setup_server()
+
+    def _setup_server(self):
+        metrics_server = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if urlsplit(self.path).path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics_server.metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", metrics_server.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), MetricsHandler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from pathlib import Path
 
 
 @dataclass
@@ -38,3 +39,93 @@ class VideoStreamInfo:
 class VideoM3U8:
     video: str = None
     audio: str = None
+
+
+@dataclass
+class DownloadStats:
+    size: int = 0
+    elapsed: float = 0.0
+    connections: int = 1
+
+
+@dataclass
+class PipelineJob:
+    queue_item: DownloadQueueItem = None
+    progress: str = None
+    track_id: str = None
+    temp_id: str = None
+    metadata_gid: dict = None
+    is_music_video: bool = False
+    tags: dict = None
+    lyrics: Lyrics = None
+    final_path: Path = None
+    lrc_path: Path = None
+    cover_path: Path = None
+    cover_url: str = None
+    needs_download: bool = False
+    file_id: str = None
+    stream_url: str = None
+    stream_info: VideoStreamInfo = None
+    decryption_key: str = None
+    encrypted_path: Path = None
+    encrypted_path_audio: Path = None
+    remuxed_path: Path = None
+    tagged: bool = False
+    published: bool = False
+    finished: bool = False
+    failed: bool = False
+
+
+@dataclass
+class ManifestEntry:
+    track_id: str = None
+    kind: str = None
+    path: str = None
+    size: int = None
+    codec: str = None
+    layout_hash: str = None
+
+
+@dataclass
+class PlaylistSnapshot:
+    playlist_id: str = None
+    scope: str = None
+    snapshot_id: str = None
+    name: str = None
+    track_ids: list[str] = None
+    etag: str = None
+
+
+@dataclass
+class PlaylistDelta:
+    name: str = None
+    snapshot: PlaylistSnapshot = None
+    download_queue: list[DownloadQueueItem] = None
+    unchanged: bool = False
+
+
+@dataclass
+class QueuedJob:
+    id: int = None
+    link: str = None
+    discord_id: int = None
+    public: bool = False
+    status: str = None
+    error: str = None
+
+
+@dataclass
+class Mp4Track:
+    track_id: int = None
+    is_protected: bool = False
+    iv_size: int = 8
+    default_sample_duration: int = 0
+    default_sample_size: int = 0
+
+
+@dataclass
+class Mp4Sample:
+    offset: int = None
+    size: int = None
+    iv: bytes = None
+    subsamples: list[tuple[int, int]] = None
@@ -0,0 +1,485 @@
+from __future__ import annotations
+
+import struct
+from typing import BinaryIO, Iterator
+
+from Crypto.Cipher import AES
+
+from .models import Mp4Sample, Mp4Track
+
+
+class Mp4Remuxer:
+    COPY_CHUNK_SIZE = 1024 * 1024
+    REMOVED_BOXES = {b"pssh", b"senc", b"saiz", b"saio"}
+    PIFF_SAMPLE_ENCRYPTION_UUID = bytes.fromhex("a2394f525a9b4f14a2446c427c648df4")
+    ENCRYPTED_SAMPLE_ENTRIES = {b"enca": 20, b"encv": 70}
+    SUPPORTED_SCHEMES = {b"cenc"}
+
+    def __init__(self, decryption_key: str, ilst: bytes = None):
+        self.decryption_key = bytes.fromhex(decryption_key)
+        self.ilst = ilst
+        self.tracks = {}
+        self.offset_delta = 0
+
+    @staticmethod
+    def iter_boxes(
+        data: bytearray,
+        start: int,
+        end: int,
+    ) -> Iterator[tuple[bytes, int, int, int]]:
+        offset = start
+        while offset + 8 <= end:
+            size, box_type = struct.unpack_from(">I4s", data, offset)
+            header_size = 8
+            if size == 1:
+                size = struct.unpack_from(">Q", data, offset + 8)[0]
+                header_size = 16
+            elif size == 0:
+                size = end - offset
+            if size < header_size or offset + size > end:
+                raise Exception(f"Invalid {box_type} box at offset {offset}")
+            yield box_type, offset, header_size, size
+            offset += size
+
+    @classmethod
+    def find_box(
+        cls,
+        data: bytearray,
+        start: int,
+        end: int,
+        box_type: bytes,
+    ) -> tuple[int, int, int] | None:
+        return next(
+            (
+                (offset, header_size, size)
+                for child_type, offset, header_size, size in cls.iter_boxes(
+                    data, start, end
+                )
+                if child_type == box_type
+            ),
+            None,
+        )
+
+    @staticmethod
+    def rename_box(data: bytearray, offset: int, box_type: bytes):
+        data[offset + 4 : offset + 8] = box_type
+
+    @staticmethod
+    def render_box(box_type: bytes, payload: bytes) -> bytes:
+        return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+    def get_udta(self) -> bytes:
+        hdlr = self.render_box(b"hdlr", b"\x00" * 8 + b"mdirappl" + b"\x00" * 9)
+        return self.render_box(
+            b"udta", self.render_box(b"meta", b"\x00" * 4 + hdlr + self.ilst)
+        )
+
+    def remux(self, input_file: BinaryIO, output_file: BinaryIO):
+        position = 0
+        samples = []
+        mdat_seen = False
+        while True:
+            header = self._read(input_file, 8)
+            if not header:
+                break
+            size, box_type = struct.unpack(">I4s", header)
+            if size == 1:
+                header += self._read(input_file, 8)
+                size = struct.unpack_from(">Q", header, 8)[0]
+            if box_type in (b"moov", b"moof"):
+                box = bytearray(header + self._read(input_file, size - len(header)))
+                if box_type == b"moov":
+                    box = self._process_moov(box, mdat_seen)
+                else:
+                    samples = self._process_moof(box, position)
+                output_file.write(box)
+            elif box_type == b"mdat":
+                mdat_seen = True
+                output_file.write(header)
+                self._copy_mdat(
+                    input_file,
+                    output_file,
+                    position + len(header),
+                    position + size if size else None,
+                    samples,
+                )
+            else:
+                # mfra holds absolute offsets which are stale once moov grows
+                if box_type in self.REMOVED_BOXES or (
+                    box_type == b"mfra" and self.offset_delta
+                ):
+                    header = header[:4] + b"free" + header[8:]
+                output_file.write(header)
+                self._copy(input_file, output_file, size - len(header))
+            if not size:
+                break
+            position += size
+
+    @staticmethod
+    def _read(input_file: BinaryIO, size: int) -> bytes:
+        data = bytearray()
+        while len(data) < size:
+            chunk = input_file.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return bytes(data)
+
+    def _copy(self, input_file: BinaryIO, output_file: BinaryIO, size: int = None):
+        while size is None or size > 0:
+            chunk = input_file.read(
+                self.COPY_CHUNK_SIZE
+                if size is None
+                else min(size, self.COPY_CHUNK_SIZE)
+            )
+            if not chunk:
+                if size is not None:
+                    raise Exception("Unexpected end of file")
+                break
+            output_file.write(chunk)
+            if size is not None:
+                size -= len(chunk)
+
+    def _process_moov(self, moov: bytearray, mdat_seen: bool) -> bytearray:
+        udta = self.get_udta() if self.ilst is not None else b""
+        if not mdat_seen:
+            self.offset_delta = len(udta)
+        moov_header_size = 16 if struct.unpack_from(">I", moov)[0] == 1 else 8
+        for box_type, offset, header_size, size in self.iter_boxes(
+            moov, moov_header_size, len(moov)
+        ):
+            if box_type in self.REMOVED_BOXES or (box_type == b"udta" and udta):
+                self.rename_box(moov, offset, b"free")
+            elif box_type == b"trak":
+                self._process_trak(moov, offset + header_size, offset + size)
+            elif box_type == b"mvex":
+                self._process_mvex(moov, offset + header_size, offset + size)
+        if not udta:
+            return moov
+        moov += udta
+        if moov_header_size == 16:
+            struct.pack_into(">Q", moov, 8, len(moov))
+        else:
+            struct.pack_into(">I", moov, 0, len(moov))
+        return moov
+
+    def _get_track(self, track_id: int) -> Mp4Track:
+        if track_id not in self.tracks:
+            self.tracks[track_id] = Mp4Track(track_id)
+        return self.tracks[track_id]
+
+    def _process_trak(self, moov: bytearray, start: int, end: int):
+        tkhd_offset, tkhd_header_size, _ = self.find_box(moov, start, end, b"tkhd")
+        tkhd_version = moov[tkhd_offset + tkhd_header_size]
+        track = self._get_track(
+            struct.unpack_from(
+                ">I",
+                moov,
+                tkhd_offset + tkhd_header_size + (20 if tkhd_version == 1 else 12),
+            )[0]
+        )
+        for box_type in (b"mdia", b"minf", b"stbl"):
+            box = self.find_box(moov, start, end, box_type)
+            if box is None:
+                return
+            offset, header_size, size = box
+            start, end = offset + header_size, offset + size
+        for box_type, offset, header_size, size in self.iter_boxes(moov, start, end):
+            if box_type == b"stsd":
+                self._process_stsd(moov, track, offset + header_size, offset + size)
+            elif box_type in (b"stco", b"co64") and self.offset_delta:
+                self._shift_chunk_offsets(
+                    moov, offset + header_size, ">Q" if box_type == b"co64" else ">I"
+                )
+
+    def _process_stsd(self, moov: bytearray, track: Mp4Track, start: int, end: int):
+        # stsd is a full box followed by an entry count
+        for box_type, offset, header_size, size in self.iter_boxes(
+            moov, start + 8, end
+        ):
+            if box_type in self.ENCRYPTED_SAMPLE_ENTRIES:
+                self._process_encrypted_sample_entry(
+                    moov, track, box_type, offset, header_size, size
+                )
+
+    def _shift_chunk_offsets(self, moov: bytearray, position: int, entry_format: str):
+        entry_count = struct.unpack_from(">I", moov, position + 4)[0]
+        entry_size = struct.calcsize(entry_format)
+        for entry_offset in range(
+            position + 8, position + 8 + entry_count * entry_size, entry_size
+        ):
+            struct.pack_into(
+                entry_format,
+                moov,
+                entry_offset,
+                struct.unpack_from(entry_format, moov, entry_offset)[0]
+                + self.offset_delta,
+            )
+
+    def _process_encrypted_sample_entry(
+        self,
+        moov: bytearray,
+        track: Mp4Track,
+        box_type: bytes,
+        offset: int,
+        header_size: int,
+        size: int,
+    ):
+        children_start = (
+            offset + header_size + 8 + self.ENCRYPTED_SAMPLE_ENTRIES[box_type]
+        )
+        if box_type == b"enca":
+            sound_version = struct.unpack_from(">H", moov, offset + header_size + 8)[0]
+            children_start += {1: 16, 2: 36}.get(sound_version, 0)
+        sinf = self.find_box(moov, children_start, offset + size, b"sinf")
+        if sinf is None:
+            raise Exception("Encrypted sample entry without protection info")
+        sinf_offset, sinf_header_size, sinf_size = sinf
+        sinf_start, sinf_end = sinf_offset + sinf_header_size, sinf_offset + sinf_size
+        frma_offset, frma_header_size, _ = self.find_box(
+            moov, sinf_start, sinf_end, b"frma"
+        )
+        schm = self.find_box(moov, sinf_start, sinf_end, b"schm")
+        if schm is not None:
+            scheme_type = bytes(moov[schm[0] + schm[1] + 4 : schm[0] + schm[1] + 8])
+            if scheme_type not in self.SUPPORTED_SCHEMES:
+                raise Exception(f"Unsupported encryption scheme {scheme_type}")
+        schi_offset, schi_header_size, schi_size = self.find_box(
+            moov, sinf_start, sinf_end, b"schi"
+        )
+        tenc_offset, tenc_header_size, _ = self.find_box(
+            moov, schi_offset + schi_header_size, schi_offset + schi_size, b"tenc"
+        )
+        track.is_protected, track.iv_size = struct.unpack_from(
+            ">BB", moov, tenc_offset + tenc_header_size + 6
+        )
+        self.rename_box(
+            moov,
+            offset,
+            bytes(
+                moov[
+                    frma_offset + frma_header_size : frma_offset + frma_header_size + 4
+                ]
+            ),
+        )
+        self.rename_box(moov, sinf_offset, b"free")
+
+    def _process_mvex(self, moov: bytearray, start: int, end: int):
+        for box_type, offset, header_size, _ in self.iter_boxes(moov, start, end):
+            if box_type != b"trex":
+                continue
+            (
+                track_id,
+                _,
+                default_sample_duration,
+                default_sample_size,
+            ) = struct.unpack_from(">IIII", moov, offset + header_size + 4)
+            track = self._get_track(track_id)
+            track.default_sample_duration = default_sample_duration
+            track.default_sample_size = default_sample_size
+
+    def _process_moof(self, moof: bytearray, moof_start: int) -> list[Mp4Sample]:
+        samples = []
+        data_end = moof_start
+        for box_type, offset, header_size, size in self.iter_boxes(moof, 8, len(moof)):
+            if box_type == b"traf":
+                traf_samples = self._process_traf(
+                    moof,
+                    offset + header_size,
+                    offset + size,
+                    moof_start,
+                    data_end,
+                )
+                if traf_samples:
+                    data_end = traf_samples[-1].offset + traf_samples[-1].size
+                samples.extend(
+                    sample for sample in traf_samples if sample.iv is not None
+                )
+        return sorted(samples, key=lambda sample: sample.offset)
+
+    def _process_traf(
+        self,
+        moof: bytearray,
+        start: int,
+        end: int,
+        moof_start: int,
+        data_end: int,
+    ) -> list[Mp4Sample]:
+        tfhd_offset, tfhd_header_size, _ = self.find_box(moof, start, end, b"tfhd")
+        position = tfhd_offset + tfhd_header_size
+        tfhd_flags, track_id = struct.unpack_from(">II", moof, position)
+        tfhd_flags &= 0xFFFFFF
+        track = self._get_track(track_id)
+        position += 8
+        if tfhd_flags & 0x1:
+            base_data_offset = struct.unpack_from(">Q", moof, position)[0]
+            struct.pack_into(">Q", moof, position, base_data_offset + self.offset_delta)
+            position += 8
+        elif tfhd_flags & 0x20000 or data_end == moof_start:
+            base_data_offset = moof_start
+        else:
+            base_data_offset = data_end
+        if tfhd_flags & 0x2:
+            position += 4
+        default_sample_size = track.default_sample_size
+        if tfhd_flags & 0x8:
+            position += 4
+        if tfhd_flags & 0x10:
+            default_sample_size = struct.unpack_from(">I", moof, position)[0]
+        samples = []
+        sample_encryption = None
+        for box_type, offset, header_size, size in self.iter_boxes(moof, start, end):
+            if box_type == b"trun":
+                samples.extend(
+                    self._parse_trun(
+                        moof,
+                        offset + header_size,
+                        base_data_offset,
+                        (
+                            samples[-1].offset + samples[-1].size
+                            if samples
+                            else base_data_offset
+                        ),
+                        default_sample_size,
+                    )
+                )
+            elif box_type == b"senc":
+                sample_encryption = (
+                    struct.unpack_from(">I", moof, offset + header_size)[0],
+                    offset + header_size + 4,
+                    track.iv_size,
+                )
+                self.rename_box(moof, offset, b"free")
+            elif (
+                box_type == b"uuid"
+                and moof[offset + 8 : offset + 24] == self.PIFF_SAMPLE_ENCRYPTION_UUID
+            ):
+                piff_start = offset + header_size + 16
+                piff_flags = struct.unpack_from(">I", moof, piff_start)[0]
+                iv_size = track.iv_size
+                if piff_flags & 0x1:
+                    iv_size = moof[piff_start + 7]
+                    piff_start += 20
+                sample_encryption = (piff_flags, piff_start + 4, iv_size)
+                self.rename_box(moof, offset, b"free")
+            elif box_type in self.REMOVED_BOXES:
+                self.rename_box(moof, offset, b"free")
+        if track.is_protected and samples:
+            if sample_encryption is None:
+                raise Exception("Encrypted fragment without sample encryption info")
+            self._parse_sample_encryption(moof, *sample_encryption, samples)
+        return samples
+
+    @staticmethod
+    def _parse_trun(
+        moof: bytearray,
+        position: int,
+        base_data_offset: int,
+        data_end: int,
+        default_sample_size: int,
+    ) -> list[Mp4Sample]:
+        trun_flags, sample_count = struct.unpack_from(">II", moof, position)
+        trun_flags &= 0xFFFFFF
+        position += 8
+        sample_offset = data_end
+        if trun_flags & 0x1:
+            sample_offset = (
+                base_data_offset + struct.unpack_from(">i", moof, position)[0]
+            )
+            position += 4
+        if trun_flags & 0x4:
+            position += 4
+        samples = []
+        for _ in range(sample_count):
+            if trun_flags & 0x100:
+                position += 4
+            sample_size = default_sample_size
+            if trun_flags & 0x200:
+                sample_size = struct.unpack_from(">I", moof, position)[0]
+                position += 4
+            if trun_flags & 0x400:
+                position += 4
+            if trun_flags & 0x800:
+                position += 4
+            samples.append(Mp4Sample(sample_offset, sample_size))
+            sample_offset += sample_size
+        return samples
+
+    @staticmethod
+    def _parse_sample_encryption(
+        moof: bytearray,
+        flags: int,
+        position: int,
+        iv_size: int,
+        samples: list[Mp4Sample],
+    ):
+        sample_count = struct.unpack_from(">I", moof, position)[0]
+        position += 4
+        if sample_count != len(samples):
+            raise Exception(
+                f"Sample encryption info for {sample_count} samples, "
+                f"expected {len(samples)}"
+            )
+        for sample in samples:
+            sample.iv = bytes(moof[position : position + iv_size])
+            position += iv_size
+            if flags & 0x2:
+                subsample_count = struct.unpack_from(">H", moof, position)[0]
+                position += 2
+                sample.subsamples = [
+                    struct.unpack_from(">HI", moof, position + i * 6)
+                    for i in range(subsample_count)
+                ]
+                position += subsample_count * 6
+
+    def _copy_mdat(
+        self,
+        input_file: BinaryIO,
+        output_file: BinaryIO,
+        data_start: int,
+        data_end: int | None,
+        samples: list[Mp4Sample],
+    ):
+        position = data_start
+        for sample in samples:
+            if sample.offset < data_start or (
+                data_end is not None and sample.offset + sample.size > data_end
+            ):
+                raise ValueError(
+                    f"Encrypted sample at {sample.offset} is outside of the mdat "
+                    f"at {data_start}"
+                )
+            self._copy(input_file, output_file, sample.offset - position)
+            output_file.write(
+                self.decrypt_sample(self._read(input_file, sample.size), sample)
+            )
+            position = sample.offset + sample.size
+        self._copy(
+            input_file,
+            output_file,
+            data_end - position if data_end is not None else None,
+        )
+
+    def decrypt_sample(self, data: bytes, sample: Mp4Sample) -> bytes:
+        if len(sample.iv) == 8:
+            cipher = AES.new(
+                self.decryption_key, AES.MODE_CTR, nonce=sample.iv, initial_value=0
+            )
+        else:
+            cipher = AES.new(
+                self.decryption_key,
+                AES.MODE_CTR,
+                nonce=b"",
+                initial_value=sample.iv,
+            )
+        if not sample.subsamples:
+            return cipher.decrypt(data)
+        decrypted = bytearray()
+        position = 0
+        for clear_size, protected_size in sample.subsamples:
+            decrypted += data[position : position + clear_size]
+            position += clear_size
+            decrypted += cipher.decrypt(data[position : position + protected_size])
+            position += protected_size
+        decrypted += data[position:]
+        return bytes(decrypted)
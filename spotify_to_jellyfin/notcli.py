@@ -1,188 +1,235 @@
+from __future__ import annotations
+
 import os
 import json
 import logging
+import threading
 
 from .downloader import Downloader
 from .downloader_song import DownloaderSong
 from .spotify_api import SpotifyApi
 from .jellyfin import JellyfinApi
-from .models import Lyrics
+from .metrics import Metrics
+from .pipeline import TrackPipeline
 from pathlib import Path
 
 
-def request_music(
-    url: str, discord_id: int, output_path: str, playlist_public: bool = False
-):
-    third_party_lyrics = os.getenv("THIRD_PARTY_LYRICS") == "true"
-    overwrite = os.getenv("OVERWRITE") == "true"
-    print_exceptions = True
-
-    logging.basicConfig(
-        format="[%(levelname)-8s %(asctime)s] %(message)s",
-        datefmt="%H:%M:%S",
-    )
-    logger = logging.getLogger(__name__)
-    logger.setLevel("INFO")
-    logger.debug("Starting downloader")
-    sp_dc_cookie = os.getenv("SP_DC_COOKIE")
-    if not sp_dc_cookie:
-        logger.critical("Environment variable for sp_dc_cookie not found")
-        return
-    spotify_api = SpotifyApi(sp_dc_cookie)
-    jellyfin_api = JellyfinApi(os.getenv("JELLYFIN_URL"), os.getenv("JELLYFIN_API_KEY"))
-    downloader = Downloader(
-        spotify_api,
-        Path(output_path),
-    )
-    downloader_song = DownloaderSong(
-        downloader,
-        premium_quality=spotify_api.is_premium,
-    )
-    if not spotify_api.is_premium:
-        logger.warning("Free account detected. Premium features are unavailable")
-    logger.debug("Setting up CDM")
-    downloader.set_cdm()
-    if not downloader.ffmpeg_path_full:
-        logger.critical("ffmpeg not found")
-        return
-    error_count = 0
-    pathslist = []
-    try:
-        url_info = downloader.get_url_info(url)
-        download_queue = downloader.get_download_queue(url_info)
-    except Exception as e:
-        error_count += 1
-        logger.error(
-            f'Failed to check "{url}"',
-            exc_info=print_exceptions,
+class Spotifin:
+    def __init__(self, output_path: Path, metrics: Metrics = None):
+        self.output_path = output_path
+        self.metrics = metrics or Metrics()
+        self.third_party_lyrics = os.getenv("THIRD_PARTY_LYRICS") == "true"
+        self.overwrite = os.getenv("OVERWRITE") == "true"
+        self.jellyfin_library_path = os.getenv("JELLYFIN_LIBRARY_PATH")
+        self.print_exceptions = True
+        self._playlists_lock = threading.Lock()
+        self._setup_logger()
+        self._setup_services()
+
+    def _setup_logger(self):
+        logging.basicConfig(
+            format="[%(levelname)-8s %(asctime)s] %(message)s",
+            datefmt="%H:%M:%S",
+        )
+        self.logger = logging.getLogger(__name__)
+        self.logger.setLevel("INFO")
+
+    def _setup_services(self):
+        self.logger.debug("Starting downloader")
+        sp_dc_cookie = os.getenv("SP_DC_COOKIE")
+        if not sp_dc_cookie:
+            raise Exception("Environment variable for sp_dc_cookie not found")
+        self.spotify_api = SpotifyApi(
+            sp_dc_cookie,
+            Path("./config/metadata_cache.db"),
+            Path("./config/token.json"),
+            self.metrics,
+        )
+        self.jellyfin_api = JellyfinApi(
+            os.getenv("JELLYFIN_URL"),
+            os.getenv("JELLYFIN_API_KEY"),
+            Path("./config/jellyfin_index.json"),
+            self.metrics,
+        )
+        self.downloader = Downloader(
+            self.spotify_api,
+            self.output_path,
+            key_store_path=Path("./config/keys.db"),
+            cover_cache_path=Path("./config/covers"),
+            manifest_path=Path("./config/library.db"),
+        )
+        self.downloader_song = DownloaderSong(
+            self.downloader,
+            premium_quality=self.spotify_api.is_premium,
         )
-        return
-    for queue_index, queue_item in enumerate(download_queue, start=1):
-        queue_progress = f"Track {queue_index}/{len(download_queue)}"
-        track = queue_item.metadata
+        if not self.spotify_api.is_premium:
+            self.logger.warning(
+                "Free account detected. Premium features are unavailable"
+            )
+        self.logger.debug("Setting up CDM")
+        self.downloader.set_cdm()
+        if not self.downloader.ffmpeg_path_full:
+            raise Exception("ffmpeg not found")
+        if self.downloader.temp_path.exists():
+            self.logger.debug(f'Cleaning up "{self.downloader.temp_path}"')
+            self.downloader.cleanup_temp_path()
+        self.track_pipeline = TrackPipeline(
+            self.downloader,
+            self.downloader_song,
+            logger=self.logger,
+            overwrite=self.overwrite,
+            third_party_lyrics=self.third_party_lyrics,
+            print_exceptions=self.print_exceptions,
+        )
+
+    def check_health(self):
+        self.downloader._set_binaries_full_path()
+        if not self.downloader.ffmpeg_path_full:
+            raise Exception("ffmpeg not found")
+        self.spotify_api.token_manager.get_token()
+        self.jellyfin_api.ping()
+
+    def close(self):
+        self.spotify_api.token_manager.close()
+        self.downloader.cover_cache.close()
+
+    def request_music(self, url: str, discord_id: int, playlist_public: bool = False):
         try:
-            logger.info(f'({queue_progress}) Downloading "{track["name"]}"')
-            track_id = track["id"]
-            logger.debug("Getting GID metadata")
-            gid = spotify_api.track_id_to_gid(track_id)
-            metadata_gid = spotify_api.get_gid_metadata(gid)
-            if not metadata_gid.get("original_video"):
-                logger.debug("Getting album metadata")
-                album_metadata = spotify_api.get_album(
-                    spotify_api.gid_to_track_id(metadata_gid["album"]["gid"])
-                )
-                logger.debug("Getting track credits")
-                track_credits = spotify_api.get_track_credits(track_id)
-                tags = downloader_song.get_tags(
-                    metadata_gid, album_metadata, track_credits
+            error_count = self._request_music(url, discord_id, playlist_public)
+        except Exception:
+            self.metrics.inc("spotifin_requests_total", result="failed")
+            raise
+        self.metrics.inc(
+            "spotifin_requests_total",
+            result="failed" if error_count else "succeeded",
+        )
+
+    def _request_music(self, url: str, discord_id: int, playlist_public: bool) -> int:
+        error_count = 0
+        playlist_delta = None
+        try:
+            url_info = self.downloader.get_url_info(url)
+            if url_info.type == "playlist" and not self.overwrite:
+                playlist_delta = self.downloader.get_playlist_delta(
+                    url_info.id, self.get_playlist_scope(discord_id, playlist_public)
                 )
-                if metadata_gid.get("has_lyrics") and spotify_api.is_premium:
-                    lyrics = downloader_song.get_lyrics(track_id)
-                else:
-                    lyrics = Lyrics
-                if not lyrics.synced and third_party_lyrics:
-                    logger.debug("Getting third-party lyrics")
-                    try:
-                        logger.debug(
-                            f"Searching third-party lyrics for {tags['artist']} - {tags['title']}"
-                        )
-                        tp_lyrics = downloader_song.get_third_party_lyrics(
-                            tags["title"], tags["artist"]
-                        )
-                    except Exception as e:
-                        logger.error(
-                            f"({queue_progress}) Failed to get third-party lyrics {e}",
-                            exc_info=print_exceptions,
-                        )
-                    if tp_lyrics.synced or not lyrics.unsynced:
-                        lyrics = tp_lyrics
-                tags["lyrics"] = lyrics.unsynced
-                final_path = downloader_song.get_final_path(tags)
-                pathslist.append(final_path)
-                lrc_path = downloader_song.get_lrc_path(final_path)
-                cover_path = downloader_song.get_cover_path(final_path)
-                cover_url = downloader.get_cover_url(metadata_gid, "LARGE")
-                if final_path.exists() and not overwrite:
-                    logger.warning(
-                        f'({queue_progress}) Track already exists at "{final_path}", skipping'
-                    )
-                else:
-                    logger.debug("Getting file info")
-                    file_id = downloader_song.get_file_id(metadata_gid)
-                    if not file_id:
-                        logger.error(
-                            f"({queue_progress}) Track not available on Spotify's "
-                            "servers and no alternative found, skipping"
-                        )
-                        continue
-                    logger.debug("Getting PSSH")
-                    pssh = spotify_api.get_pssh(file_id)
-                    logger.debug("Getting decryption key")
-                    decryption_key = downloader_song.get_decryption_key(pssh)
-                    logger.debug("Getting stream URL")
-                    stream_url = spotify_api.get_stream_url(file_id)
-                    encrypted_path = downloader.get_encrypted_path(track_id, ".m4a")
-                    decrypted_path = downloader.get_decrypted_path(track_id, ".m4a")
-                    logger.debug(f'Downloading to "{encrypted_path}"')
-                    downloader_song.download(encrypted_path, stream_url)
-                    remuxed_path = downloader.get_remuxed_path(track_id, ".m4a")
-                    logger.debug(f'Decrypting/Remuxing to "{remuxed_path}"')
-                    downloader_song.remux(
-                        encrypted_path,
-                        decrypted_path,
-                        remuxed_path,
-                        decryption_key,
-                    )
-                    logger.debug("Applying tags")
-                    downloader.apply_tags(remuxed_path, tags, cover_url)
-                    logger.debug(f'Moving to "{final_path}"')
-                    downloader.move_to_final_path(remuxed_path, final_path)
-                if not lyrics.synced:
-                    pass
-                elif lrc_path.exists() and not overwrite:
-                    logger.debug(
-                        f'Synced lyrics already exists at "{lrc_path}", skipping'
-                    )
-                else:
-                    logger.debug(f'Saving synced lyrics to "{lrc_path}"')
-                    downloader_song.save_lrc(lrc_path, lyrics.synced)
+                download_queue = playlist_delta.download_queue
             else:
-                logger.error(
-                    f"({queue_progress}) Cannot download music videos to jellyfin, skipping"
-                )
+                download_queue = self.downloader.get_download_queue(url_info)
         except Exception as e:
             error_count += 1
-            logger.error(
-                f'({queue_progress}) Failed to download "{track["name"]}"',
-                exc_info=print_exceptions,
+            self.logger.error(
+                f'Failed to check "{url}"',
+                exc_info=self.print_exceptions,
             )
-        finally:
-            if downloader.temp_path.exists():
-                logger.debug(f'Cleaning up "{downloader.temp_path}"')
-                downloader.cleanup_temp_path()
-    jellyfin_api.refresh_library()
-    if url_info.type == "playlist" and discord_id:
-        playlist_name = spotify_api.get_playlist(url_info.id)["name"]
-        print(f'Trying to sync playlist "{playlist_name}" to jellyfin')
+            return error_count
+        if playlist_delta is not None and playlist_delta.unchanged:
+            self.logger.info(f'Playlist "{playlist_delta.name}" is unchanged')
+        jobs = self.track_pipeline.run(download_queue)
+        error_count += self.track_pipeline.get_error_count(jobs)
+        published_paths = [job.final_path for job in jobs if job.published]
+        if published_paths:
+            self._refresh_items(published_paths)
+        if url_info.type == "playlist" and discord_id:
+            if playlist_delta is not None:
+                playlist_name = playlist_delta.name
+                pathslist = self._get_playlist_paths(
+                    playlist_delta.snapshot.track_ids, jobs
+                )
+            else:
+                playlist_name = self.spotify_api.get_playlist(
+                    url_info.id, extend=False
+                )["name"]
+                pathslist = self._get_playlist_paths(
+                    [job.track_id for job in jobs], jobs
+                )
+            print(f'Trying to sync playlist "{playlist_name}" to jellyfin')
+            with self.metrics.time("spotifin_step_seconds", step="jellyfin_lookup"):
+                song_ids = self.jellyfin_api.lookup_song_ids(
+                    [str(path) for path in pathslist]
+                )
+            with self._playlists_lock, self.metrics.time(
+                "spotifin_step_seconds", step="jellyfin_playlist"
+            ):
+                self._sync_playlist(
+                    url_info.id, playlist_name, song_ids, discord_id, playlist_public
+                )
+        if playlist_delta is not None and not error_count:
+            self.downloader.set_playlist_snapshot(playlist_delta.snapshot)
+        self.logger.info(f"Done ({error_count} error(s))")
+        return error_count
+
+    def get_playlist_scope(self, discord_id: int, playlist_public: bool) -> str:
+        scope = self.track_pipeline.get_playlist_scope()
+        if discord_id:
+            scope += f":{discord_id}:{int(playlist_public)}"
+        return scope
+
+    def _get_playlist_paths(self, track_ids: list[str], jobs: list) -> list[Path]:
+        job_paths = {
+            job.track_id: job.final_path for job in jobs if job.final_path is not None
+        }
+        pathslist = []
+        for track_id in track_ids:
+            path = job_paths.get(track_id)
+            if path is None and self.downloader.library_manifest is not None:
+                entry = self.downloader.library_manifest.get(
+                    track_id, self.track_pipeline.get_manifest_kind()
+                )
+                path = Path(entry.path) if entry is not None else None
+            if path is not None and path.exists():
+                pathslist.append(path)
+        return pathslist
+
+    def get_jellyfin_path(self, path: Path) -> str:
+        if not self.jellyfin_library_path:
+            return str(path)
+        return str(
+            Path(self.jellyfin_library_path) / path.relative_to(self.output_path)
+        )
+
+    def _refresh_items(self, paths: list[Path]):
+        jellyfin_paths = [self.get_jellyfin_path(path) for path in paths]
+        self.logger.debug(f"Notifying jellyfin about {len(paths)} new item(s)")
+        with self.metrics.time("spotifin_step_seconds", step="jellyfin_refresh"):
+            self.jellyfin_api.notify_updated(jellyfin_paths)
+            indexed = self.jellyfin_api.wait_for_items(jellyfin_paths)
+        if not indexed:
+            self.logger.warning("Timed out waiting for jellyfin to index new items")
+
+    def _sync_playlist(
+        self,
+        playlist_id: str,
+        playlist_name: str,
+        song_ids: list[str],
+        discord_id: int,
+        playlist_public: bool,
+    ):
         if os.path.exists("./config/playlists.json"):
             with open("./config/playlists.json", "r") as f:
                 playlist_lookup = json.load(f)
         else:
             playlist_lookup = {}
-        song_ids = []
-        for path in pathslist:
-            song_ids.append(jellyfin_api.lookup_song_id(str(path)))
-        if url_info.id in playlist_lookup:
-            jellyfin_playlist_id = playlist_lookup[url_info.id]
-            jellyfin_api.update_playlist(jellyfin_playlist_id, playlist_name, song_ids)
-        else:
-            jellyfin_playlist_id = jellyfin_api.create_playlist(
-                playlist_name,
-                song_ids,
-                jellyfin_api.lookup_jellyfin_userid(discord_id),
-                playlist_public,
-            )
-            playlist_lookup[url_info.id] = jellyfin_playlist_id
-            with open("./config/playlists.json", "w") as f:
-                json.dump(playlist_lookup, f, indent=4)
-    logger.info(f"Done ({error_count} error(s))")
+        jellyfin_id = self.jellyfin_api.lookup_jellyfin_userid(discord_id)
+        if playlist_id in playlist_lookup and self.jellyfin_api.update_playlist(
+            playlist_lookup[playlist_id], song_ids, jellyfin_id
+        ):
+            return
+        playlist_lookup[playlist_id] = self.jellyfin_api.create_playlist(
+            playlist_name,
+            song_ids,
+            jellyfin_id,
+            playlist_public,
+        )
+        with open("./config/playlists.json", "w") as f:
+            json.dump(playlist_lookup, f, indent=4)
+
+
+def request_music(
+    url: str, discord_id: int, output_path: str, playlist_public: bool = False
+):
+    spotifin = Spotifin(Path(output_path))
+    try:
+        spotifin.request_music(url, discord_id, playlist_public)
+    finally:
+        spotifin.close()
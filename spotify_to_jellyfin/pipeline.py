@@ -0,0 +1,619 @@
+from __future__ import annotations
+
+import logging
+import queue
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+
+from .downloader import Downloader
+from .downloader_music_video import DownloaderMusicVideo
+from .downloader_song import DownloaderSong
+from .enums import DownloadModeSong, DownloadModeVideo, RemuxMode
+from .library_manifest import LibraryManifest
+from .models import DownloadQueueItem, Lyrics, ManifestEntry, PipelineJob
+
+
+class TrackPipeline:
+    METADATA_FANOUT = 3
+
+    def __init__(
+        self,
+        downloader: Downloader,
+        downloader_song: DownloaderSong,
+        downloader_music_video: DownloaderMusicVideo = None,
+        logger: logging.Logger = None,
+        overwrite: bool = False,
+        lrc_only: bool = False,
+        no_lrc: bool = False,
+        save_cover: bool = False,
+        download_music_video: bool = False,
+        third_party_lyrics: bool = False,
+        print_exceptions: bool = False,
+        metadata_workers: int = 4,
+        key_workers: int = 2,
+        download_workers: int = 4,
+        remux_workers: int = 2,
+        publish_workers: int = 1,
+        queue_size: int = 8,
+    ):
+        self.downloader = downloader
+        self.downloader_song = downloader_song
+        self.downloader_music_video = downloader_music_video
+        self.logger = logger or logging.getLogger(__name__)
+        self.overwrite = overwrite
+        self.lrc_only = lrc_only
+        self.no_lrc = no_lrc
+        self.save_cover = save_cover
+        self.download_music_video = download_music_video
+        self.third_party_lyrics = third_party_lyrics
+        self.print_exceptions = print_exceptions
+        self.metadata_workers = metadata_workers
+        self.key_workers = key_workers
+        self.download_workers = download_workers
+        self.remux_workers = remux_workers
+        self.publish_workers = publish_workers
+        self.queue_size = queue_size
+        self.spotify_api = downloader.spotify_api
+        self.metrics = downloader.metrics
+        self._set_stages()
+        self._set_metadata_executor()
+
+    def _set_stages(self):
+        self.stages = [
+            (self._stage_metadata, self.metadata_workers),
+            (self._stage_keys, self.key_workers),
+            (self._stage_download, self.download_workers),
+            (self._stage_remux, self.remux_workers),
+            (self._stage_publish, self.publish_workers),
+        ]
+
+    def _set_metadata_executor(self):
+        self.metadata_executor = ThreadPoolExecutor(
+            max(self.metadata_workers, 1) * self.METADATA_FANOUT
+        )
+
+    def run(
+        self,
+        download_queue: list[DownloadQueueItem],
+        url_progress: str = None,
+    ) -> list[PipelineJob]:
+        jobs = [
+            PipelineJob(
+                queue_item=queue_item,
+                progress=f"Track {queue_index}/{len(download_queue)}"
+                + (f" from {url_progress}" if url_progress else ""),
+            )
+            for queue_index, queue_item in enumerate(download_queue, start=1)
+        ]
+        queues = [queue.Queue(maxsize=max(self.queue_size, 1)) for _ in self.stages]
+        workers = []
+        for stage_index, (stage, worker_count) in enumerate(self.stages):
+            in_queue = queues[stage_index]
+            out_queue = (
+                queues[stage_index + 1] if stage_index + 1 < len(queues) else None
+            )
+            workers.append(
+                [
+                    threading.Thread(
+                        target=self._work,
+                        args=(stage, in_queue, out_queue),
+                        daemon=True,
+                    )
+                    for _ in range(max(worker_count, 1))
+                ]
+            )
+        for stage_workers in workers:
+            for worker in stage_workers:
+                worker.start()
+        for job in jobs:
+            queues[0].put(job)
+        for stage_index, stage_workers in enumerate(workers):
+            for _ in stage_workers:
+                queues[stage_index].put(None)
+            for worker in stage_workers:
+                worker.join()
+        return jobs
+
+    def _work(
+        self,
+        stage: Callable[[PipelineJob], None],
+        in_queue: queue.Queue,
+        out_queue: queue.Queue | None,
+    ):
+        while True:
+            job = in_queue.get()
+            if job is None:
+                break
+            try:
+                if not job.finished:
+                    self._run_stage(stage, job)
+                if out_queue is None:
+                    self._finish(job)
+            except Exception:
+                job.failed = True
+                job.finished = True
+                self.logger.error(
+                    f"({job.progress}) Failed to process track",
+                    exc_info=self.print_exceptions,
+                )
+            if out_queue is not None:
+                out_queue.put(job)
+
+    def _run_stage(self, stage: Callable[[PipelineJob], None], job: PipelineJob):
+        try:
+            with self.metrics.time(
+                "spotifin_stage_seconds",
+                stage=re.sub(r"^_stage_", "", stage.__name__),
+            ):
+                stage(job)
+        except Exception:
+            job.failed = True
+            job.finished = True
+            self.logger.error(
+                f'({job.progress}) Failed to download "{job.queue_item.metadata.get("name")}"',
+                exc_info=self.print_exceptions,
+            )
+
+    def _finish(self, job: PipelineJob):
+        self.metrics.inc("spotifin_tracks_total", result=self.get_result(job))
+        if job.temp_id:
+            self.logger.debug(f'Cleaning up temporary files of "{job.temp_id}"')
+            self.downloader.cleanup_temp_files(job.temp_id)
+        if job.failed and job.remuxed_path is not None:
+            job.remuxed_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def get_temp_id(track_id: str) -> str:
+        return f"{track_id}_{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def get_result(job: PipelineJob) -> str:
+        if job.failed:
+            return "failed"
+        if job.published:
+            return "published"
+        return "skipped"
+
+    def _timed(self, step: str, function: Callable, *args):
+        with self.metrics.time("spotifin_step_seconds", step=step):
+            return function(*args)
+
+    def _stage_metadata(self, job: PipelineJob):
+        track = job.queue_item.metadata
+        self.logger.info(f'({job.progress}) Downloading "{track["name"]}"')
+        job.track_id = track["id"]
+        job.temp_id = self.get_temp_id(job.track_id)
+        if self._skip_from_manifest(job):
+            return
+        self.logger.debug("Getting GID metadata")
+        gid = self.spotify_api.track_id_to_gid(job.track_id)
+        job.metadata_gid = self._timed(
+            "gid_metadata", self.spotify_api.get_gid_metadata, gid
+        )
+        if self.download_music_video:
+            music_video_id = (
+                self.downloader_music_video.get_music_video_id_from_song_id(
+                    job.track_id, track["artists"][0]["id"]
+                )
+            )
+            if not music_video_id:
+                self.logger.warning(
+                    f"({job.progress}) No music video alternative found, skipping"
+                )
+                job.finished = True
+                return
+            job.metadata_gid = self.spotify_api.get_gid_metadata(
+                self.spotify_api.track_id_to_gid(music_video_id)
+            )
+            self.logger.warning(
+                f"({job.progress}) Switching to download music video "
+                f"with title \"{job.metadata_gid['name']}\""
+            )
+        if not job.metadata_gid.get("original_video"):
+            self._prepare_song(job)
+        elif self.downloader_music_video is None:
+            self.logger.error(
+                f"({job.progress}) Cannot download music videos to jellyfin, skipping"
+            )
+            job.finished = True
+        elif not self.spotify_api.is_premium:
+            self.logger.error(
+                f"({job.progress}) Cannot download music videos with a free account, skipping"
+            )
+            job.finished = True
+        elif self.lrc_only:
+            self.logger.warning(
+                f"({job.progress}) Music videos are not downloadable with "
+                "current settings, skipping"
+            )
+            job.finished = True
+        else:
+            self._prepare_music_video(job)
+
+    def _get_album_and_credits(self, job: PipelineJob):
+        self.logger.debug("Getting album metadata and track credits")
+        album_future = self.metadata_executor.submit(
+            self._timed,
+            "album",
+            self.spotify_api.get_album,
+            self.spotify_api.gid_to_track_id(job.metadata_gid["album"]["gid"]),
+        )
+        credits_future = self.metadata_executor.submit(
+            self._timed, "credits", self.spotify_api.get_track_credits, job.track_id
+        )
+        return album_future, credits_future
+
+    def get_manifest_kind(self) -> str:
+        return "music_video" if self.download_music_video else "song"
+
+    def get_playlist_scope(self) -> str:
+        return f"{self.get_manifest_kind()}:{self.get_layout_hash()}"
+
+    def get_layout_hash(self) -> str:
+        return LibraryManifest.get_layout_hash(
+            {
+                "output_path": self.downloader.output_path.resolve(),
+                "truncate": self.downloader.truncate,
+                "song": (
+                    self.downloader_song.template_folder_album,
+                    self.downloader_song.template_folder_compilation,
+                    self.downloader_song.template_file_single_disc,
+                    self.downloader_song.template_file_multi_disc,
+                ),
+                "music_video": (
+                    (
+                        self.downloader_music_video.template_folder,
+                        self.downloader_music_video.template_file,
+                    )
+                    if self.downloader_music_video is not None
+                    else None
+                ),
+            }
+        )
+
+    def _get_existing_cover_path(self, final_path: Path) -> Path:
+        if final_path.suffix == ".mp4" and self.downloader_music_video is not None:
+            return self.downloader_music_video.get_cover_path(final_path)
+        return self.downloader_song.get_cover_path(final_path)
+
+    def _skip_from_manifest(self, job: PipelineJob) -> bool:
+        library_manifest = self.downloader.library_manifest
+        if library_manifest is None or self.overwrite or self.lrc_only:
+            return False
+        entry = library_manifest.get(job.track_id, self.get_manifest_kind())
+        if entry is None or entry.layout_hash != self.get_layout_hash():
+            return False
+        final_path = Path(entry.path)
+        if self.downloader.output_path.resolve() not in final_path.resolve().parents:
+            return False
+        if not final_path.exists() or final_path.stat().st_size != entry.size:
+            # The published file was deleted or changed outside of the pipeline
+            library_manifest.remove(job.track_id, self.get_manifest_kind())
+            return False
+        if self.save_cover and not self._get_existing_cover_path(final_path).exists():
+            return False
+        self.logger.warning(
+            f'({job.progress}) Track already exists at "{final_path}", skipping'
+        )
+        job.final_path = final_path
+        job.finished = True
+        return True
+
+    def _record_in_manifest(self, job: PipelineJob):
+        if job.is_music_video:
+            codec = (
+                f"{job.stream_info.file_type_video}:{job.stream_info.profile_id_video}"
+                if job.stream_info
+                else None
+            )
+        else:
+            codec = self.downloader_song.codec if job.needs_download else None
+        self.downloader.library_manifest.set(
+            ManifestEntry(
+                track_id=job.track_id,
+                kind=self.get_manifest_kind(),
+                path=str(job.final_path),
+                size=job.final_path.stat().st_size,
+                codec=codec,
+                layout_hash=self.get_layout_hash(),
+            )
+        )
+
+    def _prefetch_cover(self, job: PipelineJob):
+        # Tagging or saving the cover needs it, fetch it alongside the metadata
+        if not self.lrc_only:
+            self.downloader.prefetch_cover(job.cover_url)
+
+    def _prepare_song(self, job: PipelineJob):
+        job.cover_url = self.downloader.get_cover_url(job.metadata_gid, "LARGE")
+        self._prefetch_cover(job)
+        album_future, credits_future = self._get_album_and_credits(job)
+        lyrics_future = (
+            self.metadata_executor.submit(
+                self._timed, "lyrics", self.downloader_song.get_lyrics, job.track_id
+            )
+            if job.metadata_gid.get("has_lyrics") and self.spotify_api.is_premium
+            else None
+        )
+        job.tags = self.downloader_song.get_tags(
+            job.metadata_gid, album_future.result(), credits_future.result()
+        )
+        job.lyrics = lyrics_future.result() if lyrics_future else Lyrics()
+        if not job.lyrics.synced and self.third_party_lyrics:
+            self.logger.debug(
+                f"Searching third-party lyrics for {job.tags['artist']} - {job.tags['title']}"
+            )
+            try:
+                tp_lyrics = self._timed(
+                    "third_party_lyrics",
+                    self.downloader_song.get_third_party_lyrics,
+                    job.tags["title"],
+                    job.tags["artist"],
+                    job.tags.get("isrc"),
+                )
+                if tp_lyrics.synced or not job.lyrics.unsynced:
+                    job.lyrics = tp_lyrics
+            except Exception as e:
+                self.logger.error(
+                    f"({job.progress}) Failed to get third-party lyrics {e}",
+                    exc_info=self.print_exceptions,
+                )
+        job.tags["lyrics"] = job.lyrics.unsynced
+        job.final_path = self.downloader_song.get_final_path(job.tags)
+        job.lrc_path = self.downloader_song.get_lrc_path(job.final_path)
+        job.cover_path = self.downloader_song.get_cover_path(job.final_path)
+        if self.lrc_only:
+            pass
+        elif job.final_path.exists() and not self.overwrite:
+            self.logger.warning(
+                f'({job.progress}) Track already exists at "{job.final_path}", skipping'
+            )
+        else:
+            job.needs_download = True
+
+    def _prepare_music_video(self, job: PipelineJob):
+        job.is_music_video = True
+        job.cover_url = self.downloader.get_cover_url(job.metadata_gid, "XXLARGE")
+        self._prefetch_cover(job)
+        album_future, credits_future = self._get_album_and_credits(job)
+        job.tags = self.downloader_music_video.get_tags(
+            job.metadata_gid,
+            album_future.result(),
+            credits_future.result(),
+        )
+        job.final_path = self.downloader_music_video.get_final_path(job.tags)
+        job.cover_path = self.downloader_music_video.get_cover_path(job.final_path)
+        if job.final_path.exists() and not self.overwrite:
+            self.logger.warning(
+                f'({job.progress}) Music video already exists at "{job.final_path}", skipping'
+            )
+        else:
+            job.needs_download = True
+
+    def _stage_keys(self, job: PipelineJob):
+        if not job.needs_download:
+            return
+        if job.is_music_video:
+            self.logger.debug("Getting video manifest")
+            manifest = self.downloader_music_video.get_manifest(job.metadata_gid)
+            job.stream_info = self.downloader_music_video.get_video_stream_info(
+                manifest
+            )
+            self.logger.debug("Getting decryption key")
+            job.decryption_key = self.downloader_music_video.get_decryption_key(
+                job.stream_info.pssh
+            )
+            return
+        self.logger.debug("Getting file info")
+        job.file_id = self.downloader_song.get_file_id(job.metadata_gid)
+        if not job.file_id:
+            self.logger.error(
+                f"({job.progress}) Track not available on Spotify's "
+                "servers and no alternative found, skipping"
+            )
+            job.finished = True
+            return
+        self.logger.debug("Getting decryption key")
+        job.decryption_key = self.downloader_song.get_decryption_key_from_file_id(
+            job.file_id
+        )
+        self.logger.debug("Getting stream URL")
+        job.stream_url = self._timed(
+            "stream_url", self.spotify_api.get_stream_url, job.file_id
+        )
+
+    def _stage_download(self, job: PipelineJob):
+        if not job.needs_download:
+            return
+        with self.metrics.time("spotifin_step_seconds", step="download"):
+            if job.is_music_video:
+                self._download_music_video(job)
+                self.metrics.inc(
+                    "spotifin_download_bytes_total",
+                    job.encrypted_path.stat().st_size
+                    + job.encrypted_path_audio.stat().st_size,
+                )
+            else:
+                self._download_song(job)
+
+    def _download_song(self, job: PipelineJob):
+        if self.downloader_song.download_mode == DownloadModeSong.STREAM:
+            job.remuxed_path = self.downloader.get_remuxed_path(job.temp_id, ".m4a")
+            self.logger.debug(f'Downloading and remuxing to "{job.remuxed_path}"')
+            download_stats = self.downloader_song.download_stream(
+                job.remuxed_path,
+                job.stream_url,
+                job.decryption_key,
+                self._get_ilst(job),
+            )
+        else:
+            job.encrypted_path = self.downloader.get_encrypted_path(job.temp_id, ".m4a")
+            self.logger.debug(f'Downloading to "{job.encrypted_path}"')
+            download_stats = self.downloader_song.download(
+                job.encrypted_path, job.stream_url
+            )
+        self.metrics.inc("spotifin_download_bytes_total", download_stats.size)
+        size_mib = download_stats.size / 1024 / 1024
+        self.logger.debug(
+            f"Downloaded {size_mib:.2f} MiB in {download_stats.elapsed:.2f}s "
+            f"({size_mib / max(download_stats.elapsed, 1e-6):.2f} MiB/s, "
+            f"{download_stats.connections} connection(s))"
+        )
+
+    def _download_music_video(self, job: PipelineJob):
+        stream_info = job.stream_info
+        if self.downloader_music_video.download_mode == DownloadModeVideo.NATIVE:
+            self._download_music_video_native(job)
+            return
+        m3u8 = self.downloader_music_video.get_m3u8(
+            stream_info.base_url,
+            stream_info.initialization_template_url,
+            stream_info.segment_template_url,
+            stream_info.end_time_millis,
+            stream_info.segment_length,
+            stream_info.profile_id_video,
+            stream_info.profile_id_audio,
+            stream_info.file_type_video,
+            stream_info.file_type_audio,
+        )
+        m3u8_path_video = self.downloader_music_video.get_m3u8_path(
+            job.temp_id, "video"
+        )
+        job.encrypted_path = self.downloader.get_encrypted_path(
+            job.temp_id, "_video.ts"
+        )
+        self.logger.debug(f'Downloading video to "{job.encrypted_path}"')
+        self.downloader_music_video.save_m3u8(m3u8.video, m3u8_path_video)
+        self.downloader_music_video.download(m3u8_path_video, job.encrypted_path)
+        m3u8_path_audio = self.downloader_music_video.get_m3u8_path(
+            job.temp_id, "audio"
+        )
+        job.encrypted_path_audio = self.downloader.get_encrypted_path(
+            job.temp_id, "_audio.ts"
+        )
+        self.logger.debug(f'Downloading audio to "{job.encrypted_path_audio}"')
+        self.downloader_music_video.save_m3u8(m3u8.audio, m3u8_path_audio)
+        self.downloader_music_video.download(m3u8_path_audio, job.encrypted_path_audio)
+
+    def _download_music_video_native(self, job: PipelineJob):
+        stream_info = job.stream_info
+        segment_urls_video, segment_urls_audio = (
+            self.downloader_music_video.get_segment_urls(
+                stream_info.base_url,
+                stream_info.initialization_template_url,
+                stream_info.segment_template_url,
+                stream_info.end_time_millis,
+                stream_info.segment_length,
+                profile_id,
+                file_type,
+            )
+            for profile_id, file_type in (
+                (stream_info.profile_id_video, stream_info.file_type_video),
+                (stream_info.profile_id_audio, stream_info.file_type_audio),
+            )
+        )
+        job.encrypted_path = self.downloader.get_encrypted_path(
+            job.temp_id, "_video.mp4"
+        )
+        job.encrypted_path_audio = self.downloader.get_encrypted_path(
+            job.temp_id, "_audio.mp4"
+        )
+        self.logger.debug(
+            f'Downloading video and audio to "{job.encrypted_path}" '
+            f'and "{job.encrypted_path_audio}"'
+        )
+        self.downloader_music_video.download_native(
+            segment_urls_video,
+            job.encrypted_path,
+            segment_urls_audio,
+            job.encrypted_path_audio,
+        )
+
+    def _stage_remux(self, job: PipelineJob):
+        if not job.needs_download:
+            return
+        if job.is_music_video:
+            job.remuxed_path = self.downloader.get_remuxed_path(job.temp_id, ".m4v")
+            self.logger.debug(f'Decrypting/Remuxing to "{job.remuxed_path}"')
+            self._timed(
+                "remux",
+                self.downloader_music_video.remux,
+                job.decryption_key,
+                job.encrypted_path,
+                job.encrypted_path_audio,
+                self.downloader.get_decrypted_path(job.temp_id, "_video.ts"),
+                self.downloader.get_decrypted_path(job.temp_id, "_audio.ts"),
+                job.remuxed_path,
+            )
+        elif self.downloader_song.download_mode != DownloadModeSong.STREAM:
+            job.remuxed_path = self.downloader.get_remuxed_path(job.temp_id, ".m4a")
+            ilst = self._timed("tag", self._get_ilst, job)
+            self.logger.debug(f'Decrypting/Remuxing to "{job.remuxed_path}"')
+            self._timed(
+                "remux",
+                self.downloader_song.remux,
+                job.encrypted_path,
+                self.downloader.get_decrypted_path(job.temp_id, ".m4a"),
+                job.remuxed_path,
+                job.decryption_key,
+                ilst,
+            )
+        if not job.tagged:
+            self.logger.debug("Applying tags")
+            self._timed(
+                "tag",
+                self.downloader.apply_tags,
+                job.remuxed_path,
+                job.tags,
+                job.cover_url,
+            )
+
+    def _get_ilst(self, job: PipelineJob) -> bytes | None:
+        if self.downloader.remux_mode != RemuxMode.NATIVE:
+            return None
+        job.tagged = True
+        return self.downloader.get_ilst(
+            self.downloader.get_mp4_tags(job.tags, job.cover_url)
+        )
+
+    def _stage_publish(self, job: PipelineJob):
+        if job.needs_download:
+            self.logger.debug(f'Moving to "{job.final_path}"')
+            self._timed(
+                "move",
+                self.downloader.move_to_final_path,
+                job.remuxed_path,
+                job.final_path,
+            )
+            job.published = True
+        if not job.is_music_video:
+            if self.no_lrc or not job.lyrics.synced:
+                pass
+            elif job.lrc_path.exists() and not self.overwrite:
+                self.logger.debug(
+                    f'Synced lyrics already exists at "{job.lrc_path}", skipping'
+                )
+            else:
+                self.logger.debug(f'Saving synced lyrics to "{job.lrc_path}"')
+                self.downloader_song.save_lrc(job.lrc_path, job.lyrics.synced)
+        if self.lrc_only or not self.save_cover:
+            pass
+        elif job.cover_path.exists() and not self.overwrite:
+            self.logger.debug(f'Cover already exists at "{job.cover_path}", skipping')
+        else:
+            self.logger.debug(f'Saving cover to "{job.cover_path}"')
+            self.downloader.save_cover(job.cover_path, job.cover_url)
+        if (
+            self.downloader.library_manifest is not None
+            and not self.lrc_only
+            and job.final_path.exists()
+        ):
+            self._record_in_manifest(job)
+
+    @staticmethod
+    def get_error_count(jobs: list[PipelineJob]) -> int:
+        return sum(1 for job in jobs if job.failed)
@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate,
+        )
+        self.updated_at = now
+
+    def reserve(self) -> float:
+        with self._lock:
+            self._refill()
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        wait_time = self.reserve()
+        if wait_time:
+            time.sleep(wait_time)
+
+    async def acquire_async(self):
+        wait_time = self.reserve()
+        if wait_time:
+            await asyncio.sleep(wait_time)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class HostRateLimiter:
+    def __init__(self, rates: dict[str, float], default_rate: float):
+        self.rates = rates
+        self.default_rate = default_rate
+        self.buckets = {}
+        self._lock = threading.Lock()
+
+    def get_bucket(self, url: str) -> TokenBucket:
+        host = urlsplit(url).hostname
+        with self._lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(
+                    self.rates.get(host, self.default_rate)
+                )
+            return self.buckets[host]
+
+    def acquire(self, url: str):
+        self.get_bucket(url).acquire()
+
+    async def acquire_async(self, url: str):
+        await self.get_bucket(url).acquire_async()
+
+    def pause(self, url: str, seconds: float):
+        self.get_bucket(url).pause(seconds)
+
+
+def get_retry_delay(
+    attempt: int,
+    retry_after: str = None,
+    base_delay: float = 0.5,
+    max_delay: float = 60,
+) -> float:
+    if retry_after:
+        try:
+            return min(max(float(retry_after), 0.0), max_delay)
+        except ValueError:
+            try:
+                retry_at = email.utils.parsedate_to_datetime(retry_after)
+                return min(max(retry_at.timestamp() - time.time(), 0.0), max_delay)
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
@@ -1,13 +1,22 @@
 from __future__ import annotations
 
-import functools
 import json
 import re
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import base62
 import requests
 
+from .metadata_cache import MetadataCache
+from .metrics import Metrics
+from .rate_limiter import HostRateLimiter, get_retry_delay
+from .token_manager import TokenManager
+
 
 class SpotifyApi:
     SPOTIFY_HOME_PAGE_URL = "https://open.spotify.com/"
@@ -27,40 +36,186 @@ class SpotifyApi:
     METADATA_API_URL = "https://api.spotify.com/v1/{type}/{track_id}"
     PATHFINDER_API_URL = "https://api-partner.spotify.com/pathfinder/v1/query"
     TRACK_CREDITS_API_URL = "https://spclient.wg.spotify.com/track-credits-view/v0/experimental/{track_id}/credits"
-    EXTEND_TRACK_COLLECTION_WAIT_TIME = 0.5
+    EXTEND_TRACK_COLLECTION_WORKERS = 4
+    HOST_RATES = {
+        "api.spotify.com": 10,
+        "api-partner.spotify.com": 5,
+        "spclient.wg.spotify.com": 20,
+        "gue1-spclient.spotify.com": 20,
+        "seektables.scdn.co": 20,
+    }
+    DEFAULT_HOST_RATE = 10
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    MAX_RETRIES = 5
+    REQUEST_TIMEOUT = 30
+    SESSION_HEADERS = {
+        "sec-ch-ua": '"Google Chrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"',
+        "accept-language": "en-US",
+        "sec-ch-ua-mobile": "?0",
+        "app-platform": "WebPlayer",
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
+        "accept": "application/json",
+        "Referer": SPOTIFY_HOME_PAGE_URL,
+        "spotify-app-version": "1.2.35.284.g56aba07f",
+        "sec-ch-ua-platform": '"Windows"',
+    }
 
     def __init__(
         self,
         sp_dc_cookie: str,
+        cache_path: Path = None,
+        token_cache_path: Path = None,
+        metrics: Metrics = None,
     ):
         self.sp_dc = sp_dc_cookie
+        self.cache_path = cache_path
+        self.token_cache_path = token_cache_path
+        self.metrics = metrics or Metrics()
+        self._setup_rate_limiter()
+        self._setup_endpoints()
         self._setup_session()
+        self._setup_cache()
+
+    @classmethod
+    def get_session(cls, sp_dc_cookie: str) -> requests.Session:
+        session = requests.Session()
+        session.cookies.set("sp_dc", sp_dc_cookie)
+        session.headers.update(cls.SESSION_HEADERS)
+        return session
+
+    def _setup_endpoints(self):
+        self.endpoints = [
+            (
+                re.sub(r"(_API)?_URL$", "", name).lower(),
+                re.compile(
+                    "".join(
+                        "[^/]+" if part.startswith("{") else re.escape(part)
+                        for part in re.findall(
+                            r"\{\w+\}|[^{]+", getattr(self, name).split("?")[0]
+                        )
+                    )
+                ),
+            )
+            for name in dir(self)
+            if name.endswith("_URL")
+        ]
+
+    def get_endpoint(self, url: str) -> str:
+        url_without_query = url.split("?")[0]
+        for endpoint, pattern in self.endpoints:
+            if pattern.fullmatch(url_without_query):
+                return endpoint
+        return urlsplit(url).netloc
 
     def _setup_session(self):
-        self.session = requests.Session()
-        self.session.cookies.set("sp_dc", self.sp_dc)
-        self.session.headers.update(
-            {
-                "sec-ch-ua": '"Google Chrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"',
-                "accept-language": "en-US",
-                "sec-ch-ua-mobile": "?0",
-                "app-platform": "WebPlayer",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.0.0 Safari/537.36",
-                "accept": "application/json",
-                "Referer": self.SPOTIFY_HOME_PAGE_URL,
-                "spotify-app-version": "1.2.35.284.g56aba07f",
-                "sec-ch-ua-platform": '"Windows"',
-            }
+        self.session = self.get_session(self.sp_dc)
+        self.public_session = requests.Session()
+        token_session = self.get_session(self.sp_dc)
+        response_hook = self.metrics.get_response_hook("spotify", self.get_endpoint)
+        for session in (self.session, self.public_session, token_session):
+            session.hooks["response"].append(response_hook)
+        self.token_manager = TokenManager(
+            token_session,
+            self.token_cache_path,
         )
-        home_page = self.session.get(self.SPOTIFY_HOME_PAGE_URL).text
-        token = re.search(r'accessToken":"(.*?)"', home_page).group(1)
-        self.is_premium = re.search(r'isPremium":(.*?),', home_page).group(1) == "true"
-        self.session.headers.update(
-            {
-                "authorization": f"Bearer {token}",
-            }
+        self.token_manager.setup()
+
+    @property
+    def is_premium(self) -> bool:
+        return self.token_manager.is_premium
+
+    def _setup_cache(self):
+        self.cache = MetadataCache(self.cache_path) if self.cache_path else None
+        self.pending = {}
+        self._pending_lock = threading.Lock()
+
+    def _setup_rate_limiter(self):
+        self.rate_limiter = HostRateLimiter(self.HOST_RATES, self.DEFAULT_HOST_RATE)
+
+    def _get_cached(self, endpoint: str, key: str):
+        if self.cache is None:
+            return MetadataCache.MISSING
+        return self.cache.get(endpoint, key)
+
+    def _set_cached(self, endpoint: str, key: str, value, negative: bool = False):
+        if self.cache is not None:
+            self.cache.set(endpoint, key, value, negative)
+
+    def _get_coalesced(self, key: tuple, fetch: Callable, *args):
+        with self._pending_lock:
+            future = self.pending.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self.pending[key] = future
+        if not is_owner:
+            return future.result()
+        try:
+            result = fetch(*args)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._pending_lock:
+                del self.pending[key]
+        return result
+
+    @staticmethod
+    def _is_unavailable(metadata_gid: dict) -> bool:
+        return (
+            metadata_gid.get("file") is None
+            and metadata_gid.get("alternative") is None
+            and metadata_gid.get("original_video") is None
         )
 
+    def _request(
+        self,
+        method: str,
+        url: str,
+        session: requests.Session = None,
+        **kwargs,
+    ) -> requests.Response:
+        authorize = session is None
+        session = session or self.session
+        for attempt in range(self.MAX_RETRIES + 1):
+            if authorize:
+                token = self.token_manager.get_token()
+                kwargs["headers"] = {
+                    **kwargs.get("headers", {}),
+                    "authorization": f"Bearer {token}",
+                }
+            self.rate_limiter.acquire(url)
+            try:
+                response = session.request(
+                    method,
+                    url,
+                    timeout=self.REQUEST_TIMEOUT,
+                    **kwargs,
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.MAX_RETRIES:
+                    raise
+                time.sleep(get_retry_delay(attempt))
+                continue
+            if authorize and response.status_code == 401 and attempt < self.MAX_RETRIES:
+                self.token_manager.invalidate(token)
+                continue
+            if (
+                response.status_code not in self.RETRY_STATUS_CODES
+                or attempt == self.MAX_RETRIES
+            ):
+                return response
+            retry_delay = get_retry_delay(
+                attempt,
+                response.headers.get("Retry-After"),
+            )
+            if response.status_code == 429:
+                self.rate_limiter.pause(url, retry_delay)
+            else:
+                time.sleep(retry_delay)
+
     @staticmethod
     def _check_response(response: requests.Response):
         try:
@@ -79,97 +234,158 @@ class SpotifyApi:
         return base62.encode(int(gid, 16), charset=base62.CHARSET_INVERTED).zfill(22)
 
     def get_gid_metadata(self, gid: str) -> dict:
-        response = self.session.get(self.GID_METADATA_API_URL.format(gid=gid))
+        metadata_gid = self._get_cached("gid_metadata", gid)
+        if metadata_gid is not MetadataCache.MISSING:
+            return metadata_gid
+        response = self._request("GET", self.GID_METADATA_API_URL.format(gid=gid))
         self._check_response(response)
-        return response.json()
+        metadata_gid = response.json()
+        self._set_cached(
+            "gid_metadata",
+            gid,
+            metadata_gid,
+            self._is_unavailable(metadata_gid),
+        )
+        return metadata_gid
 
     def get_video_manifest(self, gid: str) -> dict:
-        response = self.session.get(self.VIDEO_MANIFEST_API_URL.format(gid=gid))
+        response = self._request("GET", self.VIDEO_MANIFEST_API_URL.format(gid=gid))
         self._check_response(response)
         return response.json()
 
     def get_widevine_license_music(self, challenge: bytes) -> bytes:
-        response = self.session.post(
+        response = self._request(
+            "POST",
             self.WIDEVINE_LICENSE_API_URL.format(type="audio"),
-            challenge,
+            data=challenge,
         )
         self._check_response(response)
         return response.content
 
     def get_widevine_license_video(self, challenge: bytes) -> bytes:
-        response = self.session.post(
+        response = self._request(
+            "POST",
             self.WIDEVINE_LICENSE_API_URL.format(type="video"),
-            challenge,
+            data=challenge,
         )
         self._check_response(response)
         return response.content
 
     def get_lyrics(self, track_id: str) -> dict | None:
-        response = self.session.get(self.LYRICS_API_URL.format(track_id=track_id))
+        lyrics = self._get_cached("lyrics", track_id)
+        if lyrics is not MetadataCache.MISSING:
+            return lyrics
+        response = self._request("GET", self.LYRICS_API_URL.format(track_id=track_id))
         if response.status_code == 404:
+            self._set_cached("lyrics", track_id, None, True)
             return None
         self._check_response(response)
-        return response.json()
+        lyrics = response.json()
+        self._set_cached("lyrics", track_id, lyrics)
+        return lyrics
 
     def get_pssh(self, file_id: str) -> str:
-        response = requests.get(self.PSSH_API_URL.format(file_id=file_id))
+        response = self._request(
+            "GET",
+            self.PSSH_API_URL.format(file_id=file_id),
+            session=self.public_session,
+        )
         self._check_response(response)
         return response.json()["pssh"]
 
     def get_stream_url(self, file_id: str) -> str:
-        response = self.session.get(self.STREAM_URL_API_URL.format(file_id=file_id))
+        response = self._request("GET", self.STREAM_URL_API_URL.format(file_id=file_id))
         self._check_response(response)
         return response.json()["cdnurl"][0]
 
     def get_track(self, track_id: str) -> dict:
-        response = self.session.get(
-            self.METADATA_API_URL.format(type="tracks", track_id=track_id)
+        track = self._get_cached("track", track_id)
+        if track is not MetadataCache.MISSING:
+            return track
+        response = self._request(
+            "GET", self.METADATA_API_URL.format(type="tracks", track_id=track_id)
         )
         self._check_response(response)
+        track = response.json()
+        self._set_cached("track", track_id, track)
+        return track
+
+    @staticmethod
+    def get_track_collection_page_urls(track_collection: dict) -> list[str]:
+        tracks = track_collection["tracks"]
+        if tracks["next"] is None:
+            return []
+        next_url = urlsplit(tracks["next"])
+        query = dict(parse_qsl(next_url.query))
+        limit = int(query.get("limit", tracks["limit"]))
+        return [
+            urlunsplit(next_url._replace(query=urlencode({**query, "offset": offset})))
+            for offset in range(int(query["offset"]), tracks["total"], limit)
+        ]
+
+    def _get_track_collection_page(self, page_url: str) -> dict:
+        response = self._request("GET", page_url)
+        self._check_response(response)
         return response.json()
 
     def extend_track_collection(self, track_collection: dict) -> dict:
-        next_url = track_collection["tracks"]["next"]
-        while next_url is not None:
-            response = self.session.get(next_url)
-            self._check_response(response)
-            next_tracks = response.json()
-            track_collection["tracks"]["items"].extend(next_tracks["items"])
-            next_url = next_tracks["next"]
-            time.sleep(self.EXTEND_TRACK_COLLECTION_WAIT_TIME)
+        page_urls = self.get_track_collection_page_urls(track_collection)
+        if not page_urls:
+            return track_collection
+        with ThreadPoolExecutor(self.EXTEND_TRACK_COLLECTION_WORKERS) as executor:
+            for next_tracks in executor.map(self._get_track_collection_page, page_urls):
+                track_collection["tracks"]["items"].extend(next_tracks["items"])
+        track_collection["tracks"]["next"] = None
         return track_collection
 
-    @functools.lru_cache()
     def get_album(
         self,
         album_id: str,
         extend: bool = True,
     ) -> dict:
-        response = self.session.get(
-            self.METADATA_API_URL.format(type="albums", track_id=album_id)
+        # Tracks of the same album are prepared concurrently
+        return self._get_coalesced(
+            ("album", album_id, extend), self._get_album, album_id, extend
+        )
+
+    def _get_album(self, album_id: str, extend: bool) -> dict:
+        if extend:
+            album = self._get_cached("album", album_id)
+            if album is not MetadataCache.MISSING:
+                return album
+        response = self._request(
+            "GET", self.METADATA_API_URL.format(type="albums", track_id=album_id)
         )
         self._check_response(response)
         album = response.json()
         if extend:
             album = self.extend_track_collection(album)
+            self._set_cached("album", album_id, album)
         return album
 
     def get_playlist(
         self,
         playlist_id: str,
         extend: bool = True,
-    ) -> dict:
-        response = self.session.get(
-            self.METADATA_API_URL.format(type="playlists", track_id=playlist_id)
+        etag: str = None,
+    ) -> dict | None:
+        response = self._request(
+            "GET",
+            self.METADATA_API_URL.format(type="playlists", track_id=playlist_id),
+            headers={"If-None-Match": etag} if etag else {},
         )
+        if etag and response.status_code == 304:
+            return None
         self._check_response(response)
         playlist = response.json()
+        playlist["etag"] = response.headers.get("ETag")
         if extend:
             playlist = self.extend_track_collection(playlist)
         return playlist
 
     def get_now_playing_view(self, track_id: str, artist_id: str) -> dict:
-        response = self.session.get(
+        response = self._request(
+            "GET",
             self.PATHFINDER_API_URL,
             params={
                 "operationName": "queryNpvArtist",
@@ -195,8 +411,13 @@ class SpotifyApi:
         return response.json()
 
     def get_track_credits(self, track_id: str) -> dict:
-        response = self.session.get(
-            self.TRACK_CREDITS_API_URL.format(track_id=track_id)
+        track_credits = self._get_cached("track_credits", track_id)
+        if track_credits is not MetadataCache.MISSING:
+            return track_credits
+        response = self._request(
+            "GET", self.TRACK_CREDITS_API_URL.format(track_id=track_id)
         )
         self._check_response(response)
-        return response.json()
+        track_credits = response.json()
+        self._set_cached("track_credits", track_id, track_credits)
+        return track_credits
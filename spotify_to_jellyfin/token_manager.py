@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import threading
+import time
+from pathlib import Path
+
+import requests
+
+
+class TokenManager:
+    SPOTIFY_HOME_PAGE_URL = "https://open.spotify.com/"
+    REFRESH_MARGIN = 5 * 60
+    REFRESH_RETRY_INTERVAL = 30
+    DEFAULT_TOKEN_LIFETIME = 60 * 60
+    REQUEST_TIMEOUT = 30
+
+    def __init__(
+        self,
+        session: requests.Session,
+        cache_path: Path = None,
+    ):
+        self.session = session
+        self.cache_path = cache_path
+        self.token = None
+        self.is_premium = False
+        self.expires_at = 0.0
+        self._lock = threading.RLock()
+        self._refresh_timer = None
+        self._set_cookie_hash()
+
+    def _set_cookie_hash(self):
+        self.cookie_hash = hashlib.sha256(
+            (self.session.cookies.get("sp_dc") or "").encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def parse_home_page(home_page: str) -> tuple[str, bool, float]:
+        token = re.search(r'accessToken":"(.*?)"', home_page).group(1)
+        is_premium = re.search(r'isPremium":(.*?),', home_page).group(1) == "true"
+        expiration = re.search(r'accessTokenExpirationTimestampMs":(\d+)', home_page)
+        expires_at = (
+            int(expiration.group(1)) / 1000
+            if expiration
+            else time.time() + TokenManager.DEFAULT_TOKEN_LIFETIME
+        )
+        return token, is_premium, expires_at
+
+    def setup(self):
+        with self._lock:
+            if not self._load():
+                self.refresh()
+            else:
+                self._schedule_refresh()
+
+    def _load(self) -> bool:
+        if self.cache_path is None or not self.cache_path.exists():
+            return False
+        try:
+            cached_token = json.loads(self.cache_path.read_text())
+        except ValueError:
+            return False
+        if (
+            cached_token.get("cookie_hash") != self.cookie_hash
+            or cached_token["expires_at"] - self.REFRESH_MARGIN < time.time()
+        ):
+            return False
+        self.token = cached_token["token"]
+        self.is_premium = cached_token["is_premium"]
+        self.expires_at = cached_token["expires_at"]
+        return True
+
+    def _save(self):
+        if self.cache_path is None:
+            return
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.cache_path.touch(mode=0o600, exist_ok=True)
+        self.cache_path.write_text(
+            json.dumps(
+                {
+                    "cookie_hash": self.cookie_hash,
+                    "token": self.token,
+                    "is_premium": self.is_premium,
+                    "expires_at": self.expires_at,
+                },
+                indent=4,
+            )
+        )
+
+    def refresh(self):
+        with self._lock:
+            response = self.session.get(
+                self.SPOTIFY_HOME_PAGE_URL,
+                timeout=self.REQUEST_TIMEOUT,
+            )
+            response.raise_for_status()
+            self.token, self.is_premium, self.expires_at = self.parse_home_page(
+                response.text
+            )
+            self._save()
+            self._schedule_refresh()
+
+    def _schedule_refresh(self, delay: float = None):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+        if delay is None:
+            delay = max(
+                self.expires_at - self.REFRESH_MARGIN - time.time(),
+                self.REFRESH_RETRY_INTERVAL,
+            )
+        self._refresh_timer = threading.Timer(delay, self._refresh_in_background)
+        self._refresh_timer.daemon = True
+        self._refresh_timer.start()
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        except Exception:
+            self._schedule_refresh(self.REFRESH_RETRY_INTERVAL)
+
+    def is_expired(self) -> bool:
+        return self.token is None or self.expires_at <= time.time()
+
+    def get_token(self) -> str:
+        with self._lock:
+            if self.is_expired():
+                self.refresh()
+            return self.token
+
+    def invalidate(self, token: str):
+        with self._lock:
+            if token == self.token:
+                self.refresh()
+
+    def close(self):
+        if self._refresh_timer is not None:
+            self._refresh_timer.cancel()
+            self._refresh_timer = None
@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import random
+
+import pytest
+
+from spotify_to_jellyfin.jellyfin import JellyfinApi
+
+
+def get_entries(songs: list[str], first_entry: int = 0) -> list[tuple[str, str]]:
+    return [(f"entry{index}", song) for index, song in enumerate(songs, first_entry)]
+
+
+def apply_diff(
+    entries: list[tuple[str, str]], songs: list[str]
+) -> list[tuple[str, str]]:
+    removed, added = JellyfinApi.get_playlist_diff(entries, songs)
+    entries = [entry for entry in entries if entry[0] not in removed]
+    # Jellyfin appends added items to the end of the playlist
+    return entries + get_entries(added, len(entries) + len(removed))
+
+
+def apply_moves(
+    entries: list[tuple[str, str]], moves: list[tuple[str, int]]
+) -> list[tuple[str, str]]:
+    entries = list(entries)
+    for entry_id, index in moves:
+        entry = next(entry for entry in entries if entry[0] == entry_id)
+        entries.remove(entry)
+        entries.insert(index, entry)
+    return entries
+
+
+def test_playlist_diff_unchanged():
+    songs = ["a", "b", "a", "c"]
+    entries = get_entries(songs)
+    assert JellyfinApi.get_playlist_diff(entries, songs) == ([], [])
+    assert JellyfinApi.get_playlist_moves(entries, songs) == []
+
+
+def test_playlist_diff_keeps_duplicates():
+    entries = get_entries(["a", "b", "a", "a"])
+    removed, added = JellyfinApi.get_playlist_diff(entries, ["a", "c", "b", "c"])
+    assert removed == ["entry2", "entry3"]
+    assert added == ["c", "c"]
+
+
+def test_playlist_moves_single_entry():
+    entries = get_entries(["a", "b", "c", "d", "e"])
+    moves = JellyfinApi.get_playlist_moves(entries, ["a", "e", "b", "c", "d"])
+    assert moves == [("entry4", 1)]
+
+
+def test_playlist_moves_needs_same_songs():
+    entries = get_entries(["a", "b", "c"])
+    assert JellyfinApi.get_playlist_moves(entries, ["a", "b", "d"]) == []
+    assert JellyfinApi.get_playlist_moves(entries, ["a", "b", "c", "c"]) == []
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_playlist_diff_and_moves_reach_target_order(seed):
+    rng = random.Random(seed)
+    pool = [f"song{index}" for index in range(rng.randint(1, 12))]
+    current = [rng.choice(pool) for _ in range(rng.randint(0, 20))]
+    target = [rng.choice(pool) for _ in range(rng.randint(0, 20))]
+    entries = apply_diff(get_entries(current), target)
+    assert sorted(song for _, song in entries) == sorted(target)
+    moves = JellyfinApi.get_playlist_moves(entries, target)
+    assert [song for _, song in apply_moves(entries, moves)] == target
+    assert len(moves) <= len(target)
@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from spotify_to_jellyfin.metadata_cache import MetadataCache
+
+
+def test_size_tracks_replaced_and_expired_entries(tmp_path):
+    cache = MetadataCache(tmp_path / "metadata_cache.db")
+    for index in range(10):
+        cache.set("track", "replaced", {"name": "x" * index})
+    cache.set("track", "expired", {"name": "expired"}, ttl=-1)
+    assert cache.get("track", "expired") is MetadataCache.MISSING
+    assert cache.size == cache._get_total_size() == len('{"name":"xxxxxxxxx"}')
+
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import io
+import os
+import struct
+
+import pytest
+from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
+
+from benchmarks.fake_mp4 import build_encrypted_mp4
+from spotify_to_jellyfin.downloader import Downloader
+from spotify_to_jellyfin.mp4 import Mp4Remuxer
+
+KEY = bytes(range(16))
+SAMPLE_SIZE = 256
+SAMPLES_PER_FRAGMENT = 4
+FRAGMENT_COUNT = 3
+SUBSAMPLES = ((16, 100), (20, 120))
+TAGS = {
+    "\xa9nam": ["Title"],
+    "\xa9ART": ["Artist"],
+    "trkn": [(3, 12)],
+    "----:com.apple.iTunes:ISRC": [MP4FreeForm(b"USRC17607839")],
+    "covr": [MP4Cover(b"\xff\xd8\xff\xe0cover", imageformat=MP4Cover.FORMAT_JPEG)],
+}
+
+
+def get_top_level_boxes(data: bytes) -> list[tuple[bytes, bytes]]:
+    boxes = []
+    for box_type, offset, header_size, size in Mp4Remuxer.iter_boxes(
+        data, 0, len(data)
+    ):
+        boxes.append((box_type, data[offset + header_size : offset + size]))
+    return boxes
+
+
+@pytest.mark.parametrize("iv_size", [8, 16])
+@pytest.mark.parametrize("subsamples", [(), SUBSAMPLES], ids=["full", "subsamples"])
+@pytest.mark.parametrize(
+    "absolute_offsets", [False, True], ids=["moof_relative", "absolute"]
+)
+@pytest.mark.parametrize(
+    "ilst", [None, Downloader.get_ilst(TAGS)], ids=["untagged", "tagged"]
+)
+def test_remux_decrypts_samples(tmp_path, iv_size, subsamples, absolute_offsets, ilst):
+    plaintext = [
+        os.urandom(SAMPLE_SIZE) for _ in range(FRAGMENT_COUNT * SAMPLES_PER_FRAGMENT)
+    ]
+    encrypted = build_encrypted_mp4(
+        KEY, plaintext, SAMPLES_PER_FRAGMENT, iv_size, subsamples, absolute_offsets
+    )
+    output_file = io.BytesIO()
+    Mp4Remuxer(KEY.hex(), ilst).remux(io.BytesIO(encrypted), output_file)
+    output = output_file.getvalue()
+    boxes = get_top_level_boxes(output)
+    assert b"".join(payload for box_type, payload in boxes if box_type == b"mdat") == (
+        b"".join(plaintext)
+    )
+    assert b"pssh" not in [box_type for box_type, _ in boxes]
+    if absolute_offsets:
+        # Base data offsets are absolute, so they have to follow the grown moov
+        remuxer = Mp4Remuxer(KEY.hex())
+        fragment_size = SAMPLE_SIZE * SAMPLES_PER_FRAGMENT
+        fragment_index = 0
+        for box_type, offset, header_size, size in remuxer.iter_boxes(
+            output, 0, len(output)
+        ):
+            if box_type != b"moof":
+                continue
+            traf_offset, traf_header_size, traf_size = remuxer.find_box(
+                output, offset + header_size, offset + size, b"traf"
+            )
+            tfhd_offset, tfhd_header_size, _ = remuxer.find_box(
+                output,
+                traf_offset + traf_header_size,
+                traf_offset + traf_size,
+                b"tfhd",
+            )
+            base_data_offset = struct.unpack_from(
+                ">Q", output, tfhd_offset + tfhd_header_size + 8
+            )[0]
+            first_sample = fragment_index * SAMPLES_PER_FRAGMENT
+            assert output[base_data_offset : base_data_offset + fragment_size] == (
+                b"".join(plaintext[first_sample : first_sample + SAMPLES_PER_FRAGMENT])
+            )
+            fragment_index += 1
+        assert fragment_index == FRAGMENT_COUNT
+    output_path = tmp_path / "remuxed.m4a"
+    output_path.write_bytes(output)
+    mp4 = MP4(output_path)
+    if ilst is None:
+        assert not mp4.tags
+    else:
+        assert dict(mp4.tags) == TAGS
+
+
+def test_remux_rejects_samples_outside_mdat():
+    plaintext = [os.urandom(SAMPLE_SIZE) for _ in range(SAMPLES_PER_FRAGMENT)]
+    encrypted = bytearray(build_encrypted_mp4(KEY, plaintext, SAMPLES_PER_FRAGMENT))
+    # Cut the last sample off the mdat while the moof still references it
+    mdat_offset, _, mdat_size = Mp4Remuxer(KEY.hex()).find_box(
+        encrypted, 0, len(encrypted), b"mdat"
+    )
+    struct.pack_into(">I", encrypted, mdat_offset, mdat_size - SAMPLE_SIZE)
+    with pytest.raises(ValueError):
+        Mp4Remuxer(KEY.hex()).remux(
+            io.BytesIO(encrypted[: len(encrypted) - SAMPLE_SIZE]), io.BytesIO()
+        )